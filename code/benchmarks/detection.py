@@ -0,0 +1,542 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Motion detection benchmark with synthetic footage
+
+    A video and an image sequence are generated with moving objects injected at known times,
+    then every detection mode runs in a fresh process, which measures the throughput, the cost of the detectors,
+    the peak RSS and the recall of the events against the ground truth.
+    peakRssMB is the peak total RSS of the mode process and its worker processes, sampled from /proc,
+    peakSelfRssMB and peakChildRssMB are the peaks of the mode process and of its largest worker by getrusage
+
+    Usage:
+        python benchmarks/detection.py [--width 640] [--height 360] [--fps 25] [--duration 60]
+                                       [--events 10:14,30:33,50:52] [--modes exact,coarse,images]
+                                       [--output result.json] [--baseline old.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+# 代码根目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 检测方式，{名称: (类型, Motion的参数)}
+MODES = {
+    'exact': ('video', {}),
+    'read': ('video', {'samplingMode': 'read'}),
+    'seek': ('video', {'samplingMode': 'seek'}),
+    'coarse': ('video', {'scan': 'coarse'}),
+    'refine': ('video', {'refine': True}),
+    'analysis-320': ('video', {'analysisWidth': 320}),
+    'absdiff-phash': ('video', {'detector': ['absdiff', 'phash']}),
+    'heatmap': ('video', {'heatmap': 2}),
+    'segments': ('video', {'segments': 0}),
+    'images': ('images', {}),
+    'images-full-decode': ('images', {'reducedDecode': False}),
+    'images-parallel': ('images', {'workers': 0}),
+}
+
+# 默认注入的运动，(开始秒, 结束秒)
+DEFAULT_EVENTS = [(10, 14), (30, 33), (50, 52)]
+
+
+def parseEvents(text):
+    """
+        Parse the events of the command line
+
+        Parameters
+        ----------
+        text : string
+                    The events, e.g. '10:14,30:33'
+
+        Returns
+        -------
+        events : array_like
+                    (start, end) in seconds
+    """
+
+    events = []
+    for item in text.split(','):
+        start, end = item.split(':')
+        events.append((float(start), float(end)))
+    return events
+
+
+def createBackground(width, height, seed):
+    """
+        Create a textured static background
+
+        Parameters
+        ----------
+        width : int
+                    The width of frame
+        height : int
+                    The height of frame
+        seed : int
+                    The random seed
+
+        Returns
+        -------
+        background : ndarray
+                    The BGR background
+    """
+
+    noise = (np.random.default_rng(seed).random((height, width, 3)) * 255).astype(np.uint8)
+    return cv2.GaussianBlur(noise, (31, 31), 0)
+
+
+def renderFrame(background, seconds, events):
+    """
+        Render the frame at the time, an object moves across the frame during every event
+
+        Parameters
+        ----------
+        background : ndarray
+                    The static background
+        seconds : float
+                    The time of frame
+        events : array_like
+                    (start, end) in seconds
+
+        Returns
+        -------
+        frame : ndarray
+                    The BGR frame
+    """
+
+    frame = background.copy()
+    height, width = frame.shape[0:2]
+    size = max(height // 2, 8)
+    for (start, end) in events:
+        if start <= seconds < end:
+            x = int((seconds - start) / (end - start) * (width - size))
+            y = (height - size) // 2
+            cv2.rectangle(frame, (x, y), (x + size, y + size), (255, 255, 255), -1)
+            cv2.rectangle(frame, (x, y), (x + size, y + size), (0, 0, 255), max(size // 10, 1))
+    return frame
+
+
+def generateVideo(fileName, width, height, fps, duration, events, seed=0):
+    """
+        Generate the synthetic video
+
+        Parameters
+        ----------
+        fileName : string
+                    The mp4 file
+        width : int
+                    The width of frame
+        height : int
+                    The height of frame
+        fps : int
+                    The frame rate
+        duration : float
+                    The length of video in seconds
+        events : array_like
+                    (start, end) in seconds
+        seed : int, optional
+                    The random seed of the background
+                    Default value is 0
+
+        Returns
+        -------
+        frameCount : int
+                    The number of frames
+    """
+
+    background = createBackground(width, height, seed)
+    writer = cv2.VideoWriter(fileName, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    frameCount = int(duration * fps)
+    for i in range(frameCount):
+        writer.write(renderFrame(background, i / float(fps), events))
+    writer.release()
+    return frameCount
+
+
+def generateImages(imageDir, width, height, duration, events, seed=0):
+    """
+        Generate the synthetic image sequence, one JPEG image per second
+
+        Parameters
+        ----------
+        imageDir : string
+                    The directory of images
+        width : int
+                    The width of image
+        height : int
+                    The height of image
+        duration : float
+                    The length of sequence in seconds
+        events : array_like
+                    (start, end) in seconds
+        seed : int, optional
+                    The random seed of the background
+                    Default value is 0
+
+        Returns
+        -------
+        imageFiles : array_like
+                    The image files in order
+    """
+
+    os.makedirs(imageDir, exist_ok=True)
+    background = createBackground(width, height, seed)
+    imageFiles = []
+    for i in range(int(duration)):
+        imageFile = os.path.join(imageDir, '{0:06d}.jpg'.format(i))
+        cv2.imwrite(imageFile, renderFrame(background, float(i), events), [int(cv2.IMWRITE_JPEG_QUALITY), 90])
+        imageFiles.append(imageFile)
+    return imageFiles
+
+
+class Collector(object):
+    """
+        Keep the messages of Motion
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(dict(msg))
+
+
+class TreeMemorySampler(object):
+    """
+        Sample the total RSS of the process and all its descendants in a background thread
+        The worker processes of the segments and the parallel images modes are included
+    """
+
+    def __init__(self, interval=0.02):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            interval : float, optional
+                        The seconds between two samples
+                        Default value is 0.02
+
+            Returns
+            -------
+        """
+        self.interval = interval
+        # 采样到的最大总RSS(KB)，不能读取/proc时为None
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='MemorySampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            total = getTreeRss(os.getpid())
+            if total is not None:
+                self.peak = max(self.peak or 0, total)
+            if self.stopped.wait(self.interval):
+                break
+
+
+def getTreeRss(pid):
+    """
+        Get the total RSS of the process and its descendants from /proc
+
+        Parameters
+        ----------
+        pid : int
+                    The root process
+
+        Returns
+        -------
+        rss : int
+                    The total RSS in KB, None if /proc can not be read
+    """
+
+    # {父进程: [子进程]}
+    children = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                # 进程名可能包含空格，父进程号在最后一个括号之后
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+
+    total = 0
+    pending = [pid]
+    while len(pending) > 0:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open('/proc/{0}/status'.format(current)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except (OSError, ValueError):
+            if current == pid:
+                return None
+    return total
+
+
+def runMode(kind, options, sources):
+    """
+        Run one detection mode, be called in a fresh worker process
+
+        Parameters
+        ----------
+        kind : string
+                    'video' or 'images'
+        options : dict
+                    The parameters of Motion
+        sources : array_like
+                    The video file or the image files
+
+        Returns
+        -------
+        result : dict
+                    seconds : The wall time of the detection
+                    peakRssMB : The peak total RSS of the mode process and its workers,
+                                the sum of peakSelfRssMB and peakChildRssMB if /proc can not be read
+                    peakSelfRssMB : The peak RSS of the mode process
+                    peakChildRssMB : The peak RSS of the largest worker process of the mode
+                    detections : The seconds of the detected motion
+                    events : The refined (start, end) in seconds
+                    detectors : The cost of the detectors
+                    stages : The cumulative time and count of every stage
+    """
+
+    from services.detection.motion import motion
+
+    collector = Collector()
+    detector = motion.Motion(msger=collector, sleepTimes=0.0001, heatmapDir=tempfile.gettempdir(), **options)
+    sampler = TreeMemorySampler()
+    sampler.start()
+    started = time.perf_counter()
+    # 检测过程的输出写入stderr，stdout只输出结果
+    with contextlib.redirect_stdout(sys.stderr):
+        asyncio.run(detector.motionDetect(sources))
+    seconds = time.perf_counter() - started
+    sampler.stop()
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # 采样的间隔内的峰值可能漏掉，至少是getrusage的结果
+    peakRss = max(sampler.peak or 0, selfRss + (childRss if sampler.peak is None else 0))
+
+    detections = []
+    events = []
+    detectors = None
+    stages = None
+    for msg in collector.messages:
+        if msg.get('status') == 'process':
+            if kind == 'video':
+                detections.append(msg['index'] / 1000.0)
+            else:
+                detections.append(float(sources.index(msg['index'])))
+        elif msg.get('status') == 'event':
+            events.append((msg['start'] / 1000.0, msg['end'] / 1000.0))
+        elif msg.get('status') == 'finish':
+            detectors = msg.get('detectors')
+            stages = msg.get('stages')
+    return {'seconds': seconds, 'peakRssMB': round(peakRss / 1024.0, 1), 'peakSelfRssMB': round(selfRss / 1024.0, 1),
+            'peakChildRssMB': round(childRss / 1024.0, 1), 'detections': detections, 'events': events, 'detectors': detectors, 'stages': stages}
+
+
+def score(detections, events, truth, tolerance):
+    """
+        Compare the detections with the ground truth
+
+        Parameters
+        ----------
+        detections : array_like
+                    The seconds of the detected motion
+        events : array_like
+                    The refined (start, end) in seconds, empty if the mode does not refine
+        truth : array_like
+                    The injected (start, end) in seconds
+        tolerance : float
+                    The seconds a detection may lag behind the event, usually the sampling interval
+
+        Returns
+        -------
+        score : dict
+                    recall : The fraction of the injected events which are detected
+                    falsePositives : The number of detections outside every event
+                    onsetErrorMs : The mean delay between the start of event and its first detection
+    """
+
+    detected = 0
+    onsetErrors = []
+    for (start, end) in truth:
+        hits = [t for t in detections if start - tolerance <= t <= end + tolerance]
+        if len(hits) == 0:
+            continue
+        detected += 1
+        onsets = [s for (s, e) in events if start - tolerance <= s <= end]
+        onsetErrors.append(abs((min(onsets) if len(onsets) > 0 else min(hits)) - start) * 1000)
+    falsePositives = len([t for t in detections if
+                          not any(start - tolerance <= t <= end + tolerance for (start, end) in truth)])
+    return {'recall': round(detected / float(len(truth)), 3) if len(truth) > 0 else None,
+            'falsePositives': falsePositives,
+            'onsetErrorMs': round(sum(onsetErrors) / len(onsetErrors), 1) if len(onsetErrors) > 0 else None}
+
+
+def summarize(name, kind, result, frameCount, truth, tolerance):
+    """
+        Build the record of one mode
+
+        Parameters
+        ----------
+        name : string
+                    The name of mode
+        kind : string
+                    'video' or 'images'
+        result : dict
+                    The result of runMode
+        frameCount : int
+                    The number of frames or images
+        truth : array_like
+                    The injected (start, end) in seconds
+        tolerance : float
+                    The seconds a detection may lag behind the event
+
+        Returns
+        -------
+        record : dict
+                    The measurements of the mode
+    """
+
+    seconds = result['seconds']
+    detectors = result['detectors'] or []
+    samples = max([detector['samples'] for detector in detectors] or [0]) + 1
+    detectorMs = sum(detector['totalMs'] for detector in detectors)
+    record = {'mode': name, 'kind': kind, 'seconds': round(seconds, 4),
+              'framesPerSecond': round(frameCount / seconds, 1), 'samplesPerSecond': round(samples / seconds, 1),
+              'stages': {'detectorsMs': round(detectorMs, 3), 'otherMs': round(seconds * 1000 - detectorMs, 3)},
+              'stageMs': {name: stage['totalMs'] for (name, stage) in (result['stages'] or {}).items()},
+              'peakRssMB': result['peakRssMB'], 'peakSelfRssMB': result['peakSelfRssMB'],
+              'peakChildRssMB': result['peakChildRssMB'], 'detections': len(result['detections']), 'detectors': detectors}
+    record.update(score(result['detections'], result['events'], truth, tolerance))
+    return record
+
+
+def compare(records, baseline):
+    """
+        Compare the records with the records of a previous run
+
+        Parameters
+        ----------
+        records : array_like
+                    The records of the current run
+        baseline : dict
+                    The result of a previous run
+
+        Returns
+        -------
+        comparison : dict
+                    {mode: {'speedup', 'rssRatio', 'recallChange'}}
+    """
+
+    previous = {record['mode']: record for record in baseline.get('results', [])}
+    comparison = {}
+    for record in records:
+        old = previous.get(record['mode'])
+        if old is None:
+            continue
+        comparison[record['mode']] = {
+            'speedup': round(old['seconds'] / record['seconds'], 3) if record['seconds'] > 0 else None,
+            'rssRatio': round(record['peakRssMB'] / old['peakRssMB'], 3) if old['peakRssMB'] else None,
+            'recallChange': round(record['recall'] - old['recall'], 3)
+            if (record['recall'] is not None and old['recall'] is not None) else None}
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Motion detection benchmark with synthetic footage')
+    parser.add_argument('--width', type=int, default=640, help='frame width')
+    parser.add_argument('--height', type=int, default=360, help='frame height')
+    parser.add_argument('--fps', type=int, default=25, help='frame rate of video')
+    parser.add_argument('--duration', type=float, default=60, help='length in seconds')
+    parser.add_argument('--events', type=parseEvents, default=DEFAULT_EVENTS,
+                        help='injected motion, start:end seconds separated by commas')
+    parser.add_argument('--modes', default=','.join(MODES.keys()), help='detection modes separated by commas')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='seconds a detection may lag behind the event')
+    parser.add_argument('--workdir', help='keep the generated footage in the directory')
+    parser.add_argument('--output', help='write the JSON result to the file')
+    parser.add_argument('--baseline', help='compare with the JSON result of a previous run')
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(',') if mode]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('Unknown mode: {0}'.format(mode))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ss-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    footage = {'width': args.width, 'height': args.height, 'fps': args.fps, 'duration': args.duration,
+               'events': args.events}
+    videoFile = os.path.join(workdir, 'synthetic.mp4')
+    imageFiles = []
+    started = time.perf_counter()
+    frameCount = generateVideo(videoFile, args.width, args.height, args.fps, args.duration, args.events)
+    if any(MODES[mode][0] == 'images' for mode in modes):
+        imageFiles = generateImages(os.path.join(workdir, 'images'), args.width, args.height, args.duration,
+                                    args.events)
+    footage['generateSeconds'] = round(time.perf_counter() - started, 3)
+
+    # 每种方式在新的进程中运行，分别统计内存峰值
+    context = multiprocessing.get_context('spawn')
+    records = []
+    for mode in modes:
+        kind, options = MODES[mode]
+        sources = [videoFile] if kind == 'video' else imageFiles
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(runMode, kind, options, sources).result()
+        records.append(summarize(mode, kind, result, frameCount if kind == 'video' else len(imageFiles),
+                                 args.events, args.tolerance))
+        print('{0}: {1}s'.format(mode, records[-1]['seconds']), file=sys.stderr)
+
+    report = {'python': sys.version.split()[0], 'platform': sys.platform, 'machine': platform.machine(),
+              'cpus': os.cpu_count(), 'opencv': cv2.__version__, 'numpy': np.__version__, 'footage': footage,
+              'results': records}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            report['comparison'] = compare(records, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
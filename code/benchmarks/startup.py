@@ -0,0 +1,174 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Cold start benchmark of the server
+
+    Every run starts a fresh python process which imports ssServer, listens on a free port and optionally warms up
+    the analysis backends, the parent process measures the time until the usage endpoint answers
+    and the time until the backends are imported
+
+    Usage:
+        python benchmarks/startup.py [--runs 5] [--no-warm-up] [--output result.json]
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+# 代码根目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程中运行的服务，输出各阶段相对于进程启动的时间
+SERVER = """
+import time
+started = time.time()
+import json, sys
+import tornado.ioloop
+import ssServer
+imported = time.time()
+app = ssServer.make_app()
+app.listen(int(sys.argv[1]), '127.0.0.1')
+listening = time.time()
+print(json.dumps({'import': imported - started, 'listen': listening - started}), flush=True)
+
+async def warmUp():
+    await ssServer.warmUp()
+    print(json.dumps({'warmUp': time.time() - started}), flush=True)
+
+tornado.ioloop.IOLoop.current().spawn_callback(warmUp)
+tornado.ioloop.IOLoop.current().start()
+"""
+
+
+def getFreePort():
+    """
+        Get a free TCP port
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        port : int
+                    The port number
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def runOnce(warmUp, timeout=60):
+    """
+        Start the server once and measure the startup time
+
+        Parameters
+        ----------
+        warmUp : bool
+                    Whether the analysis backends are warmed up
+        timeout : float, optional
+                    The maximum seconds to wait for the server
+                    Default value is 60
+
+        Returns
+        -------
+        result : dict
+                    The seconds from the process start to every stage
+                    import : ssServer is imported
+                    listen : The server is listening
+                    firstResponse : The usage endpoint answered the first request
+                    warmUp : The analysis backends are imported, None if warm-up is disabled
+    """
+
+    port = getFreePort()
+    env = dict(os.environ, SS_WARM_UP='1' if warmUp else '0', PYTHONDONTWRITEBYTECODE='1')
+    started = time.time()
+    process = subprocess.Popen([sys.executable, '-c', SERVER, str(port)], cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    result = {'import': None, 'listen': None, 'firstResponse': None, 'warmUp': None}
+    try:
+        # 轮询直到服务返回usage
+        while time.time() - started < timeout:
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:{0}/'.format(port), timeout=1) as response:
+                    response.read()
+                result['firstResponse'] = time.time() - started
+                break
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError('The server exited with code {0}'.format(process.returncode))
+                time.sleep(0.005)
+
+        # 在线程中读取子进程输出的各阶段时间，避免子进程没有输出时一直阻塞
+        lines = queue.Queue()
+        threading.Thread(target=lambda: [lines.put(line) for line in process.stdout], daemon=True).start()
+        while time.time() - started < timeout:
+            try:
+                line = lines.get(timeout=max(timeout - (time.time() - started), 0))
+            except queue.Empty:
+                break
+            try:
+                stage = json.loads(line)
+            except ValueError:
+                continue
+            result.update(stage)
+            if (not warmUp) or ('warmUp' in stage):
+                break
+    finally:
+        process.kill()
+        process.wait()
+    return result
+
+
+def summarize(results):
+    """
+        Summarize the stage times of every run
+
+        Parameters
+        ----------
+        results : array_like
+                    The results of runOnce
+
+        Returns
+        -------
+        summary : dict
+                    {stage: {'min', 'median', 'max'}} in seconds
+    """
+
+    summary = {}
+    for stage in ('import', 'listen', 'firstResponse', 'warmUp'):
+        values = [result[stage] for result in results if result.get(stage) is not None]
+        if len(values) > 0:
+            summary[stage] = {'min': round(min(values), 4), 'median': round(statistics.median(values), 4),
+                              'max': round(max(values), 4)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the server')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs')
+    parser.add_argument('--no-warm-up', dest='warmUp', action='store_false', help='disable the backend warm-up')
+    parser.add_argument('--output', help='write the JSON result to the file')
+    args = parser.parse_args()
+
+    results = [runOnce(args.warmUp) for i in range(args.runs)]
+    report = {'python': sys.version.split()[0], 'platform': sys.platform, 'runs': args.runs,
+              'warmUp': args.warmUp, 'summary': summarize(results), 'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,10 @@
 
 from abc import ABCMeta, abstractmethod
 import asyncio
+import collections
 import json
+import time
+import zlib
 
 
 class Messager(object):
@@ -143,17 +146,412 @@ class TornadoSender(Messager):
             kwargs : params
                         taskId : The task id
                         msger : messager
+                        outbound : OutboundQueue of the connection, optional
 
             Returns
             -------
         """
         super(TornadoSender, self).__init__(**kwargs)
+        self.outbound = kwargs.get("outbound")
 
     def send(self, msg):
         msg['taskId'] = self.taskId
+        # if (self.msger.ws_connection is not None):
+        # print('id', id(self.msger))
+        self.write(json.dumps(msg), droppable=msg.get('status') == 'progress')
+
+    def write(self, data, binary=False, droppable=False):
+        """
+            Write the data to websocket, through the outbound queue if there is one
+
+            Parameters
+            ----------
+            data : string or bytes
+                        The data to be sent
+            binary : bool, optional
+                        Send as binary message
+                        Default value is False
+            droppable : bool, optional
+                        The data is a progress message which can be coalesced
+                        Default value is False
+
+            Returns
+            -------
+        """
+
+        try:
+            if self.outbound is not None:
+                if not self.outbound.put(data, binary, droppable):
+                    raise Exception('WebSocketClosedError')
+            else:
+                self.msger.write_message(data, binary=binary)
+        except Exception as ex:
+            raise Exception('WebSocketClosedError')
+
+    async def drain(self):
+        """
+            Wait until the outbound queue has free space
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        if self.outbound is not None:
+            await self.outbound.drain()
+
+
+class BatchSender(TornadoSender):
+    """
+        WebSocket Messager Class
+        Be used for tornado lib, the motion messages are buffered and sent as one array message,
+        the progress messages are throttled to a maximum rate
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        taskId : The task id
+                        msger : messager
+                        window : The time window to buffer the messages in milliseconds
+                                    Default value is 200
+                        size : The maximum number of buffered messages
+                                    Default value is 50
+                        progressRate : The maximum number of progress messages per second
+                                    Default value is 2
+                        encoding : The encoding of messages
+                                    Default value is 'json'
+                                        json: JSON text message
+                                        deflate: Compact JSON compressed by zlib, sent as binary message
+
+            Returns
+            -------
+        """
+        super(BatchSender, self).__init__(**kwargs)
+        self.window = kwargs.get('window') or 200
+        self.size = kwargs.get('size') or 50
+        self.progressRate = kwargs.get('progressRate') or 2
+        self.encoding = kwargs.get('encoding') or 'json'
+        # 缓存的motion消息
+        self.events = []
+        # 最新的进度消息
+        self.progress = None
+        # 上一次发送进度消息的时间
+        self.progressTime = 0
+        # 定时发送
+        self.timer = None
+
+    def send(self, msg):
+        msg['taskId'] = self.taskId
+        status = msg.get('status')
+        if status == 'process':
+            self.events.append(msg)
+            if len(self.events) >= self.size:
+                self.flush()
+            else:
+                self.schedule()
+        elif status == 'progress':
+            # 只保留最新的进度
+            self.progress = msg
+            if time.time() - self.progressTime >= 1.0 / self.progressRate:
+                self.flush()
+            else:
+                self.schedule()
+        else:
+            # 其它消息(结束、错误)与缓存的消息一起立即发送
+            self.flush([msg])
+
+    def end(self, msg):
+        self.send(msg)
+
+    def schedule(self):
+        """
+            Flush the buffered messages after the time window
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window / 1000.0, self.onTimer)
+
+    def onTimer(self):
+        self.timer = None
         try:
-            # if (self.msger.ws_connection is not None):
-            # print('id', id(self.msger))
-            self.msger.write_message(json.dumps(msg))
+            self.flush()
         except Exception as ex:
+            print('Error:', ex)
+
+    def flush(self, extra=None):
+        """
+            Send the buffered messages as one array message
+
+            Parameters
+            ----------
+            extra : array_like, optional
+                        The messages sent after the buffered messages
+                        Default value is None
+
+            Returns
+            -------
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        msgs = self.events
+        if self.progress is not None:
+            msgs.append(self.progress)
+            self.progressTime = time.time()
+        if extra is not None:
+            msgs.extend(extra)
+        self.events = []
+        self.progress = None
+        if len(msgs) < 1:
+            return
+
+        # 只有进度消息时可以被合并
+        droppable = all(msg.get('status') == 'progress' for msg in msgs)
+        if self.encoding == 'deflate':
+            data = json.dumps(msgs, separators=(',', ':')).encode('utf-8')
+            self.write(zlib.compress(data), binary=True, droppable=droppable)
+        else:
+            self.write(json.dumps(msgs), droppable=droppable)
+
+
+class QueueSender(Messager):
+    """
+        Queue Messager Class
+        Be used to send messages from a worker process to the parent process
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        taskId : The task id
+                        msger : queue, a multiprocessing manager queue
+
+            Returns
+            -------
+        """
+        super(QueueSender, self).__init__(**kwargs)
+
+    def send(self, msg):
+        self.msger.put(msg)
+
+    def end(self, msg):
+        self.msger.put(msg)
+
+
+class LoopSender(Messager):
+    """
+        Thread-safe Messager Class
+        Be used to send messages from a worker thread through a messager of the event loop
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        taskId : The task id
+                        msger : messager, which is only used in the event loop thread
+                        loop : The event loop
+
+            Returns
+            -------
+        """
+        super(LoopSender, self).__init__(**kwargs)
+        self.loop = kwargs.get("loop")
+        # 消息发送失败后不再发送
+        self.closed = False
+
+    def send(self, msg):
+        if self.closed:
             raise Exception('WebSocketClosedError')
+        # 等待消息进入发送队列，发送队列已满时阻塞工作线程
+        asyncio.run_coroutine_threadsafe(self.dispatch(msg), self.loop).result()
+
+    def end(self, msg):
+        self.send(msg)
+
+    async def dispatch(self, msg):
+        try:
+            self.msger.send(msg)
+            drain = getattr(self.msger, 'drain', None)
+            if drain is not None:
+                await drain()
+        except Exception as ex:
+            self.closed = True
+            print('Error:', ex)
+
+
+class OutboundQueue(object):
+    """
+        Outbound Queue Class
+        The bounded outbound queue of a tornado websocket connection,
+        the messages are written one after another and every write is awaited
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        websocket : The tornado websocket connection
+                        maxBytes : The maximum bytes of queued messages
+                                    Default value is 1048576
+                        maxMessages : The maximum number of queued messages
+                                    Default value is 1000
+                        timer : The StageTimer which records the time of writes as 'websocket.write'
+                                    Default value is None
+
+            Returns
+            -------
+        """
+        self.websocket = kwargs.get("websocket")
+        self.maxBytes = kwargs.get("maxBytes") or 1048576
+        self.maxMessages = kwargs.get("maxMessages") or 1000
+        self.timer = kwargs.get("timer")
+        # 待发送的消息，[(数据, 是否二进制, 是否可合并)]
+        self.items = collections.deque()
+        # 待发送消息的字节数
+        self.size = 0
+        # 发送队列有空闲时设置
+        self.space = asyncio.Event()
+        self.space.set()
+        # 发送消息的协程
+        self.writer = None
+        self.closed = False
+
+    def isFull(self):
+        """
+            Check whether the queue has reached the cap
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            m : bool
+                        True if the queue is full
+        """
+
+        return len(self.items) >= self.maxMessages or self.size >= self.maxBytes
+
+    def put(self, data, binary=False, droppable=False):
+        """
+            Put the data into the queue
+            When the queue is full, the progress data replaces the queued progress data or is dropped,
+            the other data is always queued and the producer should wait by drain()
+
+            Parameters
+            ----------
+            data : string or bytes
+                        The data to be sent
+            binary : bool, optional
+                        Send as binary message
+                        Default value is False
+            droppable : bool, optional
+                        The data is a progress message which can be coalesced
+                        Default value is False
+
+            Returns
+            -------
+            m : bool
+                        False if the connection has been closed
+        """
+
+        if self.closed:
+            return False
+
+        if droppable and self.isFull():
+            # 合并进度消息，用最新的进度替换队列中最后一个进度消息
+            for i in range(len(self.items) - 1, -1, -1):
+                if self.items[i][2]:
+                    self.size += len(data) - len(self.items[i][0])
+                    self.items[i] = (data, binary, droppable)
+                    break
+            return True
+
+        self.items.append((data, binary, droppable))
+        self.size += len(data)
+        if self.isFull():
+            self.space.clear()
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.write())
+        return True
+
+    async def drain(self):
+        """
+            Wait until the queue has free space or the connection is closed
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        while self.isFull() and not self.closed:
+            await self.space.wait()
+
+    async def write(self):
+        """
+            Write the queued data to websocket one after another
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        try:
+            while len(self.items) > 0 and not self.closed:
+                (data, binary, droppable) = self.items.popleft()
+                self.size -= len(data)
+                if not self.isFull():
+                    self.space.set()
+                started = time.perf_counter()
+                await self.websocket.write_message(data, binary=binary)
+                if self.timer is not None:
+                    self.timer.add('websocket.write', started)
+        except Exception as ex:
+            print('Error:', ex)
+            self.close()
+        finally:
+            self.writer = None
+
+    def close(self):
+        """
+            Close the queue, the queued data is discarded and the waiting producers are released
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        self.closed = True
+        self.items.clear()
+        self.size = 0
+        self.space.set()
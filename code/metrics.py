@@ -0,0 +1,153 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Metrics
+"""
+
+import time
+
+
+class StageTimer(object):
+    """
+        Stage Timer Class
+        Keep the cumulative time and count of every stage of the analysis
+        The hot path only calls time.perf_counter() and updates a dict entry, so it can stay on in production.
+        A timer is used by one thread at a time
+    """
+
+    def __init__(self):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+        # {阶段: [次数, 秒数]}
+        self.stages = {}
+
+    def add(self, name, started):
+        """
+            Add the time since started to the stage
+
+            Parameters
+            ----------
+            name : string
+                        The name of stage
+            started : float
+                        The time.perf_counter() when the stage started
+
+            Returns
+            -------
+            now : float
+                        The current time.perf_counter(), can be the start of the next stage
+        """
+
+        now = time.perf_counter()
+        self.record(name, 1, now - started)
+        return now
+
+    def record(self, name, count, seconds):
+        """
+            Add the count and time to the stage
+
+            Parameters
+            ----------
+            name : string
+                        The name of stage
+            count : int
+                        The number of calls
+            seconds : float
+                        The time of the calls
+
+            Returns
+            -------
+        """
+
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [count, seconds]
+        else:
+            stage[0] += count
+            stage[1] += seconds
+
+    def merge(self, report):
+        """
+            Merge the report of another timer, e.g. of a worker process
+
+            Parameters
+            ----------
+            report : dict
+                        The result of report()
+
+            Returns
+            -------
+        """
+
+        for (name, stage) in (report or {}).items():
+            self.record(name, stage['count'], stage['totalMs'] / 1000.0)
+
+    def report(self):
+        """
+            Get the cumulative time and count of every stage
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            report : dict
+                        {stage: {'count', 'totalMs'}}
+        """
+
+        return {name: {'count': count, 'totalMs': round(seconds * 1000, 3)}
+                for (name, (count, seconds)) in self.stages.items()}
+
+
+def formatLabels(labels):
+    """
+        Format the labels of a sample
+
+        Parameters
+        ----------
+        labels : dict
+                    {name: value}
+
+        Returns
+        -------
+        text : string
+                    e.g. {stage="decode"}, empty if there is no label
+    """
+
+    if not labels:
+        return ''
+    items = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for (name, value) in labels.items()]
+    return '{' + ','.join(items) + '}'
+
+
+def formatMetrics(metrics):
+    """
+        Format the metrics in the Prometheus text format
+
+        Parameters
+        ----------
+        metrics : array_like
+                    [(name, type, help, [(labels, value)])], type is 'counter' or 'gauge'
+
+        Returns
+        -------
+        text : string
+                    The metrics text
+    """
+
+    lines = []
+    for (name, metricType, description, samples) in metrics:
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} {1}'.format(name, metricType))
+        for (labels, value) in samples:
+            lines.append('{0}{1} {2}'.format(name, formatLabels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
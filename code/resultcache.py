@@ -0,0 +1,244 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Result Cache
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from messager import Messager
+
+# 不影响分析结果的任务参数，分段检测时每段的背景模型重新开始，heatmap不同，segments不能忽略
+IGNORED_PARAMS = ['taskId', 'status', 'priority', 'cache', 'sleepTimes', 'workers', 'samplingMode',
+                  'batch', 'batchWindow', 'batchSize', 'progressRate', 'encoding']
+
+
+class ResultCache(object):
+    """
+        Result Cache Class
+        Store the messages of finished tasks on disk, keyed by the task parameters and the size and mtime of sources,
+        the entries are evicted by age, number and total size
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        cacheDir : The directory of cache files
+                                    Default value is the cache directory of current directory
+                        maxEntries : The maximum number of entries
+                                    Default value is 256
+                        maxBytes : The maximum total size of entries
+                                    Default value is 64MB
+                        maxAge : The maximum age of entries in seconds
+                                    Default value is 7 days
+
+            Returns
+            -------
+        """
+        self.cacheDir = kwargs.get('cacheDir') or os.path.join(os.getcwd(), 'cache')
+        self.maxEntries = kwargs.get('maxEntries') or 256
+        self.maxBytes = kwargs.get('maxBytes') or 64 * 1024 * 1024
+        self.maxAge = kwargs.get('maxAge') or 7 * 24 * 3600
+
+    def buildKey(self, params):
+        """
+            Build the cache key of task
+
+            Parameters
+            ----------
+            params : dict
+                        The task parameters
+
+            Returns
+            -------
+            key : string
+                        The cache key
+        """
+
+        params = {k: v for k, v in params.items() if k not in IGNORED_PARAMS}
+        # 源文件的大小和修改时间
+        sources = []
+        for source in params.get('sources') or []:
+            try:
+                stat = os.stat(source)
+                sources.append([os.path.abspath(source), stat.st_size, stat.st_mtime])
+            except (OSError, TypeError):
+                sources.append([source, None, None])
+        text = json.dumps({'params': params, 'sources': sources}, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def getCacheFile(self, key):
+        return os.path.join(self.cacheDir, key + '.json')
+
+    def get(self, key):
+        """
+            Get the messages of the cached task
+
+            Parameters
+            ----------
+            key : string
+                        The cache key
+
+            Returns
+            -------
+            messages : array_like
+                        None if it is not cached
+        """
+
+        fileName = self.getCacheFile(key)
+        try:
+            with open(fileName, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # 过期或者heatmap文件已经被删除
+        expired = time.time() - entry.get('created', 0) > self.maxAge
+        missing = any(isinstance(msg.get('heatmapImg'), str) and not msg['heatmapImg'].startswith('data:') and
+                      not os.path.exists(msg['heatmapImg']) for msg in entry['messages'])
+        if expired or missing:
+            self.remove(fileName)
+            return None
+
+        # 更新访问时间，用于LRU淘汰
+        try:
+            os.utime(fileName)
+        except OSError:
+            pass
+        return entry['messages']
+
+    def find(self, params):
+        """
+            Build the cache key of task and get its cached messages, which reads the disk
+
+            Parameters
+            ----------
+            params : dict
+                        The task parameters
+
+            Returns
+            -------
+            key : string
+                        The cache key
+            messages : array_like
+                        None if it is not cached
+        """
+
+        key = self.buildKey(params)
+        return key, self.get(key)
+
+    def put(self, key, messages):
+        """
+            Store the messages of the finished task
+
+            Parameters
+            ----------
+            key : string
+                        The cache key
+            messages : array_like
+                        The messages of task
+
+            Returns
+            -------
+        """
+
+        try:
+            if not os.path.exists(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            fileName = self.getCacheFile(key)
+            # 先写入临时文件再替换，避免留下不完整的缓存
+            tempFile = fileName + '.tmp'
+            with open(tempFile, 'w', encoding='utf-8') as f:
+                json.dump({'created': time.time(), 'messages': messages}, f)
+            os.replace(tempFile, fileName)
+            self.evict()
+        except Exception as ex:
+            print('Failed to save the result cache:', ex)
+
+    def evict(self):
+        """
+            Remove the expired entries and the least recently used entries over the limits
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.json'):
+                continue
+            fileName = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(fileName)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fileName))
+
+        # 按访问时间从新到旧排序
+        entries.sort(reverse=True)
+        now = time.time()
+        total = 0
+        for (count, (mtime, size, fileName)) in enumerate(entries, 1):
+            total += size
+            if count > self.maxEntries or total > self.maxBytes or now - mtime > self.maxAge:
+                self.remove(fileName)
+
+    def remove(self, fileName):
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+
+class CacheRecorder(Messager):
+    """
+        Recorder Messager Class
+        Record the messages sent by the wrapped messager, be used to fill the result cache
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        taskId : The task id
+                        msger : The wrapped messager
+
+            Returns
+            -------
+        """
+        super(CacheRecorder, self).__init__(**kwargs)
+        self.messages = []
+        # 消息发送失败时结果不完整，不进行缓存
+        self.failed = False
+
+    def send(self, msg):
+        record = dict(msg)
+        record.pop('taskId', None)
+        self.messages.append(record)
+        try:
+            self.msger.send(msg)
+        except Exception:
+            self.failed = True
+            raise
+
+    def end(self, msg):
+        self.send(msg)
+
+    async def drain(self):
+        drain = getattr(self.msger, 'drain', None)
+        if drain is not None:
+            await drain()
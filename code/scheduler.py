@@ -0,0 +1,181 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Task Scheduler
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+
+
+class TaskScheduler(object):
+    """
+        Task Scheduler Class
+        Run a bounded number of analysis tasks concurrently, the other tasks wait in a priority queue
+    """
+
+    def __init__(self, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            kwargs : params
+                        maxTasks : The number of slots shared by the running tasks,
+                                    a task takes one slot per process it runs
+                                    Default value is the number of CPU cores
+                        maxWaiting : The maximum number of waiting tasks
+                                    Default value is 32
+
+            Returns
+            -------
+        """
+        self.maxTasks = kwargs.get('maxTasks') or os.cpu_count() or 1
+        self.maxWaiting = kwargs.get('maxWaiting') if kwargs.get('maxWaiting') is not None else 32
+        # 正在运行的任务数
+        self.running = 0
+        # 正在运行的任务占用的位置数
+        self.used = 0
+        # 等待中的任务，[(优先级, 序号, 任务)]
+        self.waiting = []
+        # 优先级相同时按先进先出排序
+        self.counter = itertools.count()
+
+    def isFull(self):
+        """
+            Check whether the waiting queue is full
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            m : bool
+                        True if no more task can be added
+        """
+
+        return self.used >= self.maxTasks and len(self.waiting) >= self.maxWaiting
+
+    async def run(self, func, owner=None, priority=0, onQueued=None, slots=1):
+        """
+            Run the task when there is a free slot
+
+            Parameters
+            ----------
+            func : callable
+                        The coroutine function of the task
+            owner : object, optional
+                        The owner of the task, be used to cancel the waiting tasks
+                        Default value is None
+            priority : int, optional
+                        The task with the higher priority runs first
+                        Default value is 0
+            onQueued : callable, optional
+                        Be called with the queue position (start with 1) when the task is waiting
+                        Default value is None
+            slots : int, optional
+                        The number of slots the task takes, e.g. the number of its worker processes,
+                        at most maxTasks
+                        Default value is 1
+
+            Returns
+            -------
+            m : bool
+                        True if the task has been run, False if it was cancelled before running
+        """
+
+        slots = max(1, min(slots or 1, self.maxTasks))
+        if self.used + slots > self.maxTasks or len(self.waiting) > 0:
+            # 加入等待队列
+            task = {'owner': owner, 'onQueued': onQueued, 'slots': slots,
+                    'future': asyncio.get_event_loop().create_future()}
+            heapq.heappush(self.waiting, (-priority, next(self.counter), task))
+            self.notifyPositions()
+            # 等待空闲的位置
+            if not await task['future']:
+                return False
+        else:
+            self.running += 1
+            self.used += slots
+
+        try:
+            await func()
+        finally:
+            self.release(slots)
+        return True
+
+    def release(self, slots=1):
+        """
+            Release the slots of a finished task and start the next waiting tasks in order,
+            a task waits until there are enough free slots for it
+
+            Parameters
+            ----------
+            slots : int, optional
+                        The number of slots of the finished task
+                        Default value is 1
+
+            Returns
+            -------
+        """
+
+        self.running -= 1
+        self.used -= slots
+        while len(self.waiting) > 0:
+            task = self.waiting[0][2]
+            if task['future'].done():
+                heapq.heappop(self.waiting)
+                continue
+            if self.used + task['slots'] > self.maxTasks:
+                break
+            heapq.heappop(self.waiting)
+            self.running += 1
+            self.used += task['slots']
+            task['future'].set_result(True)
+        self.notifyPositions()
+
+    def cancel(self, owner):
+        """
+            Cancel the waiting tasks of the owner
+
+            Parameters
+            ----------
+            owner : object
+                        The owner of the tasks
+
+            Returns
+            -------
+        """
+
+        remains = [item for item in self.waiting if item[2]['owner'] is not owner]
+        for item in self.waiting:
+            if (item[2]['owner'] is owner) and (not item[2]['future'].done()):
+                item[2]['future'].set_result(False)
+        heapq.heapify(remains)
+        self.waiting = remains
+        self.notifyPositions()
+
+    def notifyPositions(self):
+        """
+            Send the queue position to every waiting task whose position has changed
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        for (position, item) in enumerate(sorted(self.waiting), 1):
+            task = item[2]
+            if task.get('position') == position:
+                continue
+            task['position'] = position
+            if task['onQueued'] is not None:
+                try:
+                    task['onQueued'](position)
+                except Exception as ex:
+                    print('Error:', ex)
@@ -1,4 +1 @@
-__all__ = ['motion', 'motionutils']
-
-from services.detection.motion import motion
-from services.detection.motion import motionutils
+__all__ = ['motion', 'motionutils', 'motionindex', 'heatmap', 'live', 'detectors', 'refine']
@@ -0,0 +1,485 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Motion Detector Strategies
+
+"""
+
+import time
+from abc import ABCMeta, abstractmethod
+
+import cv2
+import numpy as np
+
+from services.detection.motion import motionutils
+
+# 默认的检测策略
+DEFAULT_DETECTOR = 'phash'
+
+# 检测策略，{名称: 类}
+DETECTORS = {}
+
+
+def registerDetector(name):
+    """
+        Register the detector class by name, be used as class decorator
+
+        Parameters
+        ----------
+        name : string
+                    The name of the detector
+
+        Returns
+        -------
+        decorator : callable
+                    The class decorator
+    """
+
+    def decorator(cls):
+        cls.name = name
+        DETECTORS[name] = cls
+        return cls
+
+    return decorator
+
+
+def getGray(image, width=None):
+    """
+        Downsample the image and convert it to gray, the image is resized first so the conversion is cheap
+
+        Parameters
+        ----------
+        image : ndarray
+                    The image
+        width : int, optional
+                    The maximum width
+                    Default value is None, keep the size
+
+        Returns
+        -------
+        gray : ndarray
+                    The gray image
+    """
+
+    height, imageWidth = image.shape[0:2]
+    if (width is not None) and (imageWidth > width):
+        image = cv2.resize(image, (width, max(int(round(height * width / float(imageWidth))), 1)))
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+class Detector(object, metaclass=ABCMeta):
+    """
+        Detector Abstract Class
+        compare() returns the degree of change between two frames, the frames whose degree reaches
+        the threshold have motion. Every detector measures its own cost per compared sample
+        The signature of the current frame, e.g. its hash, is kept for the next comparison,
+        so the last frame is not analysed again
+    """
+
+    name = None
+    # 默认的阈值
+    defaultThreshold = 10
+
+    def __init__(self, threshold=None, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            threshold : float, optional
+                        The degree which the motion reaches
+                        Default value is None, defaultThreshold of the detector
+            kwargs : params
+                        The options of the detector
+
+            Returns
+            -------
+        """
+        self.threshold = threshold if threshold is not None else self.defaultThreshold
+        # 比较的次数、检测到变化的次数和总耗时(秒)
+        self.samples = 0
+        self.passed = 0
+        self.seconds = 0.0
+        # 上一次比较的当前帧的签名
+        self.lastSignature = None
+
+    def start(self, frame):
+        """
+            Be called with the first frame, the stateful detectors learn it
+
+            Parameters
+            ----------
+            frame : ndarray
+                        The first frame
+
+            Returns
+            -------
+        """
+
+        self.lastSignature = None
+
+    def skip(self):
+        """
+            Be called when the frame is not compared by the detector, the kept signature is outdated
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        self.lastSignature = None
+
+    @abstractmethod
+    def signature(self, frame):
+        """
+            Get the compact data of frame which is compared
+
+            Parameters
+            ----------
+            frame : ndarray
+                        The frame
+
+            Returns
+            -------
+            signature : object
+                        The signature of frame
+        """
+        pass
+
+    @abstractmethod
+    def distance(self, lastSignature, currentSignature):
+        """
+            Calculate the degree of change between the signatures
+
+            Parameters
+            ----------
+            lastSignature : object
+                        The signature of the last frame
+            currentSignature : object
+                        The signature of the current frame
+
+            Returns
+            -------
+            degree : float
+                        The degree of change
+        """
+        pass
+
+    def compare(self, lastFrame, currentFrame):
+        """
+            Calculate the degree of change, the signature of the last frame is reused if it is kept
+
+            Parameters
+            ----------
+            lastFrame : ndarray
+                        The last frame
+            currentFrame : ndarray
+                        The current frame
+
+            Returns
+            -------
+            degree : float
+                        The degree of change
+        """
+
+        lastSignature = self.lastSignature
+        if lastSignature is None:
+            lastSignature = self.signature(lastFrame)
+        self.lastSignature = self.signature(currentFrame)
+        return self.distance(lastSignature, self.lastSignature)
+
+    def detect(self, lastFrame, currentFrame):
+        """
+            Compare the frames and measure the cost
+
+            Parameters
+            ----------
+            lastFrame : ndarray
+                        The last frame
+            currentFrame : ndarray
+                        The current frame
+
+            Returns
+            -------
+            motion : bool
+                        True if the degree reaches the threshold
+            degree : float
+                        The degree of change
+        """
+
+        started = time.perf_counter()
+        degree = self.compare(lastFrame, currentFrame)
+        self.seconds += time.perf_counter() - started
+        self.samples += 1
+        motion = degree >= self.threshold
+        if motion:
+            self.passed += 1
+        return motion, degree
+
+    def report(self):
+        """
+            Get the cost of the detector
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            cost : dict
+                        name, threshold, samples, passed, totalMs, avgMs
+        """
+
+        return {'name': self.name, 'threshold': self.threshold, 'samples': self.samples, 'passed': self.passed,
+                'totalMs': round(self.seconds * 1000, 3),
+                'avgMs': round(self.seconds * 1000 / self.samples, 4) if self.samples > 0 else None}
+
+
+@registerDetector('phash')
+class PHashDetector(Detector):
+    """
+        Hamming distance of the perceptual hash
+    """
+
+    def __init__(self, threshold=None, **kwargs):
+        super(PHashDetector, self).__init__(threshold, **kwargs)
+        self.hashBackend = kwargs.get('hashBackend') or motionutils.HASH_BACKEND_NUMPY
+
+    def signature(self, frame):
+        return motionutils.calculatePHash(frame, self.hashBackend)
+
+    def distance(self, lastSignature, currentSignature):
+        return motionutils.calculateHammingDistance(lastSignature, currentSignature)
+
+
+@registerDetector('dhash')
+class DHashDetector(Detector):
+    """
+        Hamming distance of the difference hash, the sign of the horizontal gradient of the 9 * 8 gray image
+    """
+
+    def signature(self, frame):
+        gray = getGray(cv2.resize(frame, (9, 8)))
+        return motionutils.packHash(gray[:, 1:] > gray[:, :-1])
+
+    def distance(self, lastSignature, currentSignature):
+        return motionutils.calculateHammingDistance(lastSignature, currentSignature)
+
+
+@registerDetector('ahash')
+class AHashDetector(Detector):
+    """
+        Hamming distance of the average hash, the 8 * 8 gray image compared with its mean
+    """
+
+    def signature(self, frame):
+        gray = getGray(cv2.resize(frame, (8, 8)))
+        return motionutils.packHash(gray > gray.mean())
+
+    def distance(self, lastSignature, currentSignature):
+        return motionutils.calculateHammingDistance(lastSignature, currentSignature)
+
+
+@registerDetector('absdiff')
+class AbsDiffDetector(Detector):
+    """
+        Percentage of the changed pixels of the downsampled gray images
+    """
+
+    defaultThreshold = 1
+
+    def __init__(self, threshold=None, **kwargs):
+        super(AbsDiffDetector, self).__init__(threshold, **kwargs)
+        # 缩小后的宽度
+        self.width = kwargs.get('width') or 64
+        # 像素值变化超过pixelThreshold的像素被认为发生了变化
+        self.pixelThreshold = kwargs.get('pixelThreshold') if kwargs.get('pixelThreshold') is not None else 25
+
+    def signature(self, frame):
+        return getGray(frame, self.width)
+
+    def distance(self, lastSignature, currentSignature):
+        diff = cv2.absdiff(lastSignature, currentSignature)
+        return round(100.0 * int(np.count_nonzero(diff > self.pixelThreshold)) / diff.size, 2)
+
+
+class ForegroundDetector(Detector):
+    """
+        Percentage of the foreground pixels given by a background subtractor of the downsampled images
+        The subtractor learns the first frame several times before the comparison, otherwise it reports
+        almost every pixel as foreground on the first samples
+    """
+
+    defaultThreshold = 1
+
+    def __init__(self, threshold=None, **kwargs):
+        super(ForegroundDetector, self).__init__(threshold, **kwargs)
+        self.width = kwargs.get('width') or 160
+        # 学习第一帧的次数
+        self.warmUpFrames = kwargs.get('warmUpFrames') if kwargs.get('warmUpFrames') is not None else 5
+        self.backgroundSubtractor = self.createBackgroundSubtractor()
+
+    @abstractmethod
+    def createBackgroundSubtractor(self):
+        """
+            Create the background subtractor
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            backgroundSubtractor : BackgroundSubtractor
+                        The background subtractor
+        """
+        pass
+
+    def start(self, frame):
+        gray = getGray(frame, self.width)
+        for i in range(max(self.warmUpFrames, 1)):
+            self.backgroundSubtractor.apply(gray)
+
+    def skip(self):
+        pass
+
+    def signature(self, frame):
+        return getGray(frame, self.width)
+
+    def distance(self, lastSignature, currentSignature):
+        foreground = self.backgroundSubtractor.apply(currentSignature)
+        return round(100.0 * int(np.count_nonzero(foreground)) / foreground.size, 2)
+
+    def compare(self, lastFrame, currentFrame):
+        # 背景模型代替了上一帧
+        return self.distance(None, self.signature(currentFrame))
+
+
+@registerDetector('mog')
+class MOGDetector(ForegroundDetector):
+    def createBackgroundSubtractor(self):
+        return cv2.bgsegm.createBackgroundSubtractorMOG()
+
+
+@registerDetector('knn')
+class KNNDetector(ForegroundDetector):
+    def createBackgroundSubtractor(self):
+        return cv2.createBackgroundSubtractorKNN(detectShadows=False)
+
+
+class DetectorChain(object):
+    """
+        Run the detectors one after another, a cheap detector in front rejects the static samples
+        before the more expensive detectors run, the degree of the last detector is reported
+    """
+
+    def __init__(self, detectors):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            detectors : array_like
+                        The detectors in order
+
+            Returns
+            -------
+        """
+        self.detectors = detectors
+
+    def start(self, frame):
+        for detector in self.detectors:
+            detector.start(frame)
+
+    def detect(self, lastFrame, currentFrame):
+        """
+            Compare the frames by the detectors in order, stop at the first detector without motion
+
+            Parameters
+            ----------
+            lastFrame : ndarray
+                        The last frame
+            currentFrame : ndarray
+                        The current frame
+
+            Returns
+            -------
+            motion : bool
+                        True if every detector finds the motion
+            degree : float
+                        The degree of the last run detector
+        """
+
+        motion, degree = False, 0
+        for (i, detector) in enumerate(self.detectors):
+            motion, degree = detector.detect(lastFrame, currentFrame)
+            if not motion:
+                # 之后的检测策略没有比较当前帧
+                for skipped in self.detectors[i + 1:]:
+                    skipped.skip()
+                break
+        return motion, degree
+
+    def isPHash(self):
+        """
+            Check whether the chain is the p-hash detector only, which the index and segments are based on
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            m : bool
+                        True if it is the p-hash detector only
+        """
+
+        return len(self.detectors) == 1 and isinstance(self.detectors[0], PHashDetector)
+
+    def report(self):
+        return [detector.report() for detector in self.detectors]
+
+
+def createDetectorChain(spec=None, degree=10, hashBackend=None):
+    """
+        Create the detectors of the task
+
+        Parameters
+        ----------
+        spec : string or array_like, optional
+                    The name of detector, or a list of names or {'name': name, 'threshold': threshold, ...}
+                    in the running order, e.g. ['absdiff', 'phash']
+                    Default value is None, 'phash'
+        degree : int, optional
+                    The threshold of the hash detectors whose threshold is not given
+                    Default value is 10
+        hashBackend : string, optional
+                    The p-hash backend
+                    Default value is None, 'numpy'
+
+        Returns
+        -------
+        chain : DetectorChain
+                    The detectors
+    """
+
+    if not spec:
+        spec = DEFAULT_DETECTOR
+    if isinstance(spec, (str, dict)):
+        spec = [spec]
+    if not isinstance(spec, (list, tuple)):
+        raise ValueError('Unsupported detector: {0}'.format(spec))
+    detectors = []
+    for item in spec:
+        options = dict(item) if isinstance(item, dict) else {'name': item}
+        name = options.pop('name', None)
+        if name not in DETECTORS:
+            raise ValueError('Unsupported detector: {0}'.format(name))
+        # hash的距离与degree的含义一致
+        if (options.get('threshold') is None) and (name in ('phash', 'dhash', 'ahash')):
+            options['threshold'] = degree
+        options.setdefault('hashBackend', hashBackend)
+        detectors.append(DETECTORS[name](**options))
+    return DetectorChain(detectors)
@@ -0,0 +1,372 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Motion Heatmap
+
+"""
+
+import atexit
+import hashlib
+import os
+import queue
+import re
+import threading
+
+import cv2
+import numpy as np
+
+# 颜色值的上限，累加值超过上限时按最大值归一化
+MAX_COLOR_VALUE = 255
+# PNG的默认压缩级别
+DEFAULT_COMPRESSION = 3
+# heatmap目录中保留的文件数量和总大小的上限
+STORE_MAX_FILES = 1000
+STORE_MAX_BYTES = 256 * 1024 * 1024
+# 按内容命名的heatmap文件
+STORE_FILE_PATTERN = re.compile(r'^[0-9a-f]{40}\.png$')
+
+# 每个目录的heatmap存储
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+class HeatmapAccumulator(object):
+    """
+        Accumulate the foreground of the images into a float32 buffer, so it does not saturate at 255
+        An optional decay fades the older foreground, the recent motion is hotter
+    """
+
+    def __init__(self, backgroundSubtractor=None, threshold=2, maxValue=2, decay=None):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            backgroundSubtractor : BackgroundSubtractor, optional
+                        The background subtractor, None if the accumulator only merges the data of others
+                        Default value is None
+            threshold : int, optional
+                        The threshold of the foreground
+                        Default value is 2
+            maxValue : float, optional
+                        The value added to the foreground pixels
+                        Default value is 2
+            decay : float, optional
+                        The fraction of the accumulated data which fades out at every added image, 0 ~ 1
+                        Default value is None, the data does not fade out
+
+            Returns
+            -------
+        """
+        self.backgroundSubtractor = backgroundSubtractor
+        self.threshold = threshold
+        self.maxValue = maxValue
+        self.decay = decay if (decay is not None) and (0 < decay < 1) else None
+        # 累加的数据
+        self.data = None
+        # 累加的图片数量，用于合并时计算衰减
+        self.count = 0
+
+    def add(self, image):
+        """
+            Accumulate the foreground of image
+
+            Parameters
+            ----------
+            image : ndarray
+                        The current image
+
+            Returns
+            -------
+        """
+
+        # [高|宽|像素值]
+        if self.data is None:
+            self.data = np.zeros(image.shape[0:2], np.float32)
+        elif self.decay is not None:
+            self.data *= 1 - self.decay
+        # 移除背景
+        filter = self.backgroundSubtractor.apply(image)
+        # 二值化
+        ret, thresh = cv2.threshold(filter, self.threshold, self.maxValue, cv2.THRESH_BINARY)
+        # 累加到浮点数据中
+        cv2.accumulate(thresh, self.data)
+        self.count += 1
+
+    def merge(self, data, count):
+        """
+            Merge the data accumulated after the current data, e.g. by the next segment of video
+
+            Parameters
+            ----------
+            data : ndarray
+                        The accumulated data
+            count : int
+                        The number of images of data
+
+            Returns
+            -------
+        """
+
+        if data is None:
+            return
+        if self.data is None:
+            self.data = data.astype(np.float32)
+        else:
+            # 之前的数据按之后的图片数量衰减
+            if self.decay is not None:
+                self.data *= (1 - self.decay) ** count
+            self.data += data
+        self.count += count
+
+    def render(self, colorMap, alpha):
+        """
+            Render the accumulated data into a BGRA image in one pass
+
+            Parameters
+            ----------
+            colorMap : int
+                        The color map of heatmap, cv2.COLORMAP_*
+            alpha : int
+                        The value subtracted from the alpha channel of the colored pixels
+
+            Returns
+            -------
+            pngImage : ndarray
+                        The BGRA heatmap image, the black pixels are transparent
+        """
+
+        # 超过颜色值上限时按最大值归一化，否则保留原始值
+        peak = float(self.data.max())
+        if peak > MAX_COLOR_VALUE:
+            values = cv2.convertScaleAbs(self.data, alpha=MAX_COLOR_VALUE / peak)
+        else:
+            values = cv2.convertScaleAbs(self.data)
+        return buildColorTable(colorMap, alpha)[values]
+
+
+def buildColorTable(colorMap, alpha):
+    """
+        Build the BGRA color of every value
+
+        Parameters
+        ----------
+        colorMap : int
+                    The color map of heatmap, cv2.COLORMAP_*
+        alpha : int
+                    The value subtracted from the alpha channel of the colored pixels
+
+        Returns
+        -------
+        table : ndarray
+                    256 * 4 colors, the black color is transparent
+    """
+
+    colors = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape((256, 1)), colorMap).reshape((256, 3))
+    # 黑色透明，其它颜色调整透明度
+    opacity = np.where(colors.any(axis=1), MAX_COLOR_VALUE - alpha, 0).astype(np.uint8)
+    return np.concatenate([colors, opacity.reshape((256, 1))], axis=1)
+
+
+def encodeHeatmap(pngImage, compression=None):
+    """
+        Encode the heatmap image into PNG in memory
+
+        Parameters
+        ----------
+        pngImage : ndarray
+                    The BGRA heatmap image
+        compression : int, optional
+                    The PNG compression level, 0 ~ 9
+                    Default value is None, DEFAULT_COMPRESSION
+
+        Returns
+        -------
+        data : bytes
+                    The PNG data
+    """
+
+    compression = DEFAULT_COMPRESSION if compression is None else min(max(int(compression), 0), 9)
+    ret, data = cv2.imencode('.png', pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), compression])
+    if not ret:
+        raise ValueError('Failed to encode the heatmap image')
+    return data.tobytes()
+
+
+def getHeatmapStore(heatmapDir):
+    """
+        Get the shared heatmap store of the directory
+
+        Parameters
+        ----------
+        heatmapDir : string
+                    The directory of heatmap files
+
+        Returns
+        -------
+        store : HeatmapStore
+                    The heatmap store
+    """
+
+    heatmapDir = os.path.abspath(heatmapDir)
+    with STORES_LOCK:
+        store = STORES.get(heatmapDir)
+        if store is None:
+            store = HeatmapStore(heatmapDir, STORE_MAX_FILES, STORE_MAX_BYTES)
+            STORES[heatmapDir] = store
+        return store
+
+
+def flushHeatmapStores():
+    """
+        Wait until all the pending heatmap files are written, e.g. before a worker process exits
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+    """
+
+    with STORES_LOCK:
+        stores = list(STORES.values())
+    for store in stores:
+        store.flush()
+
+
+class HeatmapStore(object):
+    """
+        Content-addressed heatmap files written by a background thread
+        The files are named by the sha1 of the PNG data, the least recently used files are removed
+        when the directory holds more than maxFiles files or maxBytes bytes
+    """
+
+    def __init__(self, heatmapDir, maxFiles, maxBytes):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            heatmapDir : string
+                        The directory of heatmap files, it must exist
+            maxFiles : int
+                        The maximum number of heatmap files
+            maxBytes : int
+                        The maximum total size of heatmap files
+
+            Returns
+            -------
+        """
+        self.heatmapDir = heatmapDir
+        self.maxFiles = maxFiles
+        self.maxBytes = maxBytes
+        # 等待写入的文件
+        self.pending = queue.Queue()
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        """
+            Store the PNG data, the file is written in the background
+
+            Parameters
+            ----------
+            data : bytes
+                        The PNG data
+
+            Returns
+            -------
+            fileName : string
+                        The file path of heatmap image
+        """
+
+        fileName = os.path.join(self.heatmapDir, hashlib.sha1(data).hexdigest() + '.png')
+        # 相同内容的文件已经存在时只更新访问时间
+        if os.path.exists(fileName):
+            try:
+                os.utime(fileName)
+                return fileName
+            except OSError:
+                pass
+        with self.lock:
+            if (self.writer is None) or (not self.writer.is_alive()):
+                # 退出前等待文件写入完成
+                if self.writer is None:
+                    atexit.register(self.flush)
+                self.writer = threading.Thread(target=self.write, name='HeatmapWriter', daemon=True)
+                self.writer.start()
+        self.pending.put((fileName, data))
+        return fileName
+
+    def write(self):
+        """
+            Write the pending files, runs in the writer thread
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        while True:
+            (fileName, data) = self.pending.get()
+            try:
+                # 先写入临时文件再替换，避免读到不完整的图片
+                tempFile = fileName + '.tmp'
+                with open(tempFile, 'wb') as f:
+                    f.write(data)
+                os.replace(tempFile, fileName)
+                self.evict()
+            except Exception as ex:
+                print('Failed to save the heatmap({0}): {1}'.format(fileName, ex))
+            finally:
+                self.pending.task_done()
+
+    def flush(self):
+        """
+            Wait until all the pending files are written
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        self.pending.join()
+
+    def evict(self):
+        """
+            Remove the least recently used heatmap files over the limits
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        entries = []
+        for name in os.listdir(self.heatmapDir):
+            # 只清理按内容命名的文件
+            if not STORE_FILE_PATTERN.match(name):
+                continue
+            fileName = os.path.join(self.heatmapDir, name)
+            try:
+                stat = os.stat(fileName)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fileName))
+
+        # 按访问时间从新到旧排序
+        entries.sort(reverse=True)
+        total = 0
+        for (count, (mtime, size, fileName)) in enumerate(entries, 1):
+            total += size
+            if count > self.maxFiles or total > self.maxBytes:
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
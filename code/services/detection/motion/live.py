@@ -0,0 +1,504 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Live Motion Detection
+
+"""
+
+import base64
+import collections
+import json
+import os
+import stat
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from services.detection.motion import motionutils
+
+# 本地测试流的前缀
+TEST_SOURCE = 'test://'
+# 支持的网络流协议
+STREAM_SCHEMES = ('rtsp://', 'rtsps://', 'rtmp://', 'http://', 'https://', 'udp://', 'tcp://')
+
+# 正在检测的直播流，{参数: LiveStream}
+STREAMS = {}
+
+
+class TestStream(object):
+    """
+        Local test stream generator, a square jumps to another place every few seconds
+        It has the same read interface as cv2.VideoCapture
+    """
+
+    def __init__(self, width=320, height=240, fps=25, period=3):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            width : int, optional
+                        The width of frame
+                        Default value is 320
+            height : int, optional
+                        The height of frame
+                        Default value is 240
+            fps : int, optional
+                        The frame rate
+                        Default value is 25
+            period : float, optional
+                        The seconds between two jumps of the square
+                        Default value is 3
+
+            Returns
+            -------
+        """
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.period = period
+        self.started = time.time()
+        self.count = 0
+        # 渐变的背景
+        self.background = np.tile(np.linspace(40, 200, width, dtype=np.uint8), (height, 1))
+        self.background = cv2.cvtColor(self.background, cv2.COLOR_GRAY2BGR)
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        # 按帧率输出
+        delay = self.started + self.count / float(self.fps) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.count += 1
+        return True
+
+    def retrieve(self):
+        frame = self.background.copy()
+        jump = int(self.count / float(self.fps) / self.period)
+        size = min(self.width, self.height) // 3
+        x = (jump * 97) % (self.width - size)
+        y = (jump * 61) % (self.height - size)
+        cv2.rectangle(frame, (x, y), (x + size, y + size), (255, 255, 255), -1)
+        return True, frame
+
+    def release(self):
+        pass
+
+
+def openSource(source):
+    """
+        Open the live source
+
+        Parameters
+        ----------
+        source : string
+                    RTSP or other network URL, named pipe, or test:// for the local test stream
+
+        Returns
+        -------
+        capture : VideoCapture or TestStream
+                    The opened source, None if it can not be opened
+    """
+
+    if source.startswith(TEST_SOURCE):
+        return TestStream()
+    if source.startswith(STREAM_SCHEMES):
+        capture = cv2.VideoCapture(source, cv2.CAP_FFMPEG)
+    elif os.path.exists(source) and stat.S_ISFIFO(os.stat(source).st_mode):
+        capture = cv2.VideoCapture(source, cv2.CAP_FFMPEG)
+    else:
+        raise ValueError('Unsupported live source: {0}'.format(source))
+    if not capture.isOpened():
+        capture.release()
+        return None
+    return capture
+
+
+def isLiveSource(source):
+    """
+        Check whether the source is a live source
+
+        Parameters
+        ----------
+        source : string
+                    The source
+
+        Returns
+        -------
+        m : bool
+                    True if it is a live source
+    """
+
+    if not isinstance(source, str):
+        return False
+    if source.startswith(TEST_SOURCE) or source.startswith(STREAM_SCHEMES):
+        return True
+    return os.path.exists(source) and stat.S_ISFIFO(os.stat(source).st_mode)
+
+
+class LiveStream(object):
+    """
+        Detect the motion of a live source in a background thread and push the events to the subscribers
+        The frames are sampled at a fixed rate, the recent sampled frames are kept in a bounded ring buffer
+        at low resolution and sent with the event as the pre-event context
+    """
+
+    def __init__(self, source, loop, **kwargs):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            source : string
+                        RTSP or other network URL, named pipe, or test:// for the local test stream
+            loop : AbstractEventLoop
+                        The event loop of the subscribers
+            kwargs : params
+                        degree : Threshold of image similarity
+                                    Default value is 10
+                        regions : Vertex coordinates of the detection area, one polygon or a list of polygons
+                                    Default value is None
+                        sampleInterval : Sampling interval in milliseconds
+                                    Default value is 1000
+                        bufferSize : The number of the recent sampled frames kept in the ring buffer
+                                    Default value is 10
+                        bufferWidth : The width of the frames in the ring buffer
+                                    Default value is 160
+                        contextFrames : The number of the buffered frames sent with the event
+                                    Default value is 3
+                        reconnectInterval : The seconds to wait before reopening the source
+                                    Default value is 5
+                        hashBackend : The p-hash backend
+                                    Default value is 'numpy'
+                        analysisWidth : The frames wider than analysisWidth are downsampled to it right after decoding
+                                    Default value is None, the original resolution
+
+            Returns
+            -------
+        """
+        self.source = source
+        self.loop = loop
+        self.degree = kwargs.get('degree') if kwargs.get('degree') is not None else 10
+        self.regions = kwargs.get('regions')
+        self.roi = motionutils.ROI(self.regions) if self.regions is not None else None
+        self.sampleInterval = kwargs.get('sampleInterval') or 1000
+        self.bufferSize = kwargs.get('bufferSize') if kwargs.get('bufferSize') is not None else 10
+        self.bufferWidth = kwargs.get('bufferWidth') or 160
+        self.contextFrames = min(kwargs.get('contextFrames') if kwargs.get('contextFrames') is not None else 3,
+                                 self.bufferSize)
+        self.reconnectInterval = kwargs.get('reconnectInterval') or 5
+        self.hashBackend = kwargs.get('hashBackend') or motionutils.HASH_BACKEND_NUMPY
+        self.analysisWidth = kwargs.get('analysisWidth')
+        # 缩小后图像的检测区域
+        self.scaledROI = None
+        # 最近采样的低分辨率帧，[(时间, JPEG数据)]
+        self.buffer = collections.deque(maxlen=max(self.bufferSize, 1))
+        # 订阅的客户端
+        self.subscribers = []
+        # 客户端接收太慢时丢弃的事件数
+        self.dropped = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def subscribe(self, msger):
+        """
+            Add a subscriber, the detection starts with the first subscriber
+
+            Parameters
+            ----------
+            msger : Messager
+                        The messager of the subscriber
+
+            Returns
+            -------
+        """
+
+        if msger not in self.subscribers:
+            self.subscribers.append(msger)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='LiveStream', daemon=True)
+            self.thread.start()
+
+    def unsubscribe(self, msger):
+        """
+            Remove a subscriber, the detection stops after the last subscriber is removed
+
+            Parameters
+            ----------
+            msger : Messager
+                        The messager of the subscriber
+
+            Returns
+            -------
+            count : int
+                        The number of remaining subscribers
+        """
+
+        if msger in self.subscribers:
+            self.subscribers.remove(msger)
+        self.dropped.pop(id(msger), None)
+        if len(self.subscribers) == 0:
+            self.stop()
+        return len(self.subscribers)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        """
+            Read and detect the frames until stopped, runs in the background thread
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        capture = None
+        lastHash = None
+        lastSample = 0
+        while not self.stopped.is_set():
+            # 打开或者重新打开直播源
+            if capture is None:
+                try:
+                    capture = openSource(self.source)
+                except Exception as ex:
+                    self.publish({'source': self.source, 'status': 'error', 'message': str(ex)})
+                    # 停止并在事件循环中移除，释放直播流的名额
+                    # 之后的订阅重新创建直播流
+                    self.stop()
+                    try:
+                        self.loop.call_soon_threadsafe(removeStream, self)
+                    except RuntimeError:
+                        pass
+                    return
+                if capture is None:
+                    self.publish({'source': self.source, 'status': 'reconnecting'})
+                    self.stopped.wait(self.reconnectInterval)
+                    continue
+                lastHash = None
+
+            # 读取所有的帧，只解码采样的帧
+            if not capture.grab():
+                capture.release()
+                capture = None
+                self.publish({'source': self.source, 'status': 'reconnecting'})
+                self.stopped.wait(self.reconnectInterval)
+                continue
+            now = time.time()
+            if (now - lastSample) * 1000 < self.sampleInterval:
+                continue
+            lastSample = now
+            ret, frame = capture.retrieve()
+            if not ret or frame is None:
+                continue
+            frame = self.downsample(frame)
+
+            # 保存低分辨率的帧
+            context = list(self.buffer)[-self.contextFrames:] if self.contextFrames > 0 else []
+            if self.bufferSize > 0:
+                self.buffer.append((now * 1000, self.encodeFrame(frame)))
+
+            # 计算上一帧与当前帧的相似度
+            if self.roi is not None:
+                frame = (self.scaledROI or self.roi).apply(frame)
+            currentHash = motionutils.calculatePHash(frame, self.hashBackend)
+            if lastHash is not None:
+                degree = motionutils.calculateHammingDistance(lastHash, currentHash)
+                if degree >= self.degree:
+                    self.publish({'source': self.source, 'index': now * 1000, 'degree': degree, 'heatmapImg': None,
+                                  'progress': None, 'status': 'process',
+                                  'context': [{'index': index, 'image': 'data:image/jpeg;base64,' +
+                                                                        base64.b64encode(data).decode()}
+                                              for (index, data) in context]})
+            lastHash = currentHash
+
+        if capture is not None:
+            capture.release()
+
+    def downsample(self, frame):
+        """
+            Downsample the frame to the analysis resolution
+
+            Parameters
+            ----------
+            frame : ndarray
+                        The decoded frame
+
+            Returns
+            -------
+            frame : ndarray
+                        The downsampled frame, or the frame itself if it is not downsampled
+        """
+
+        height, width = frame.shape[0:2]
+        if (not self.analysisWidth) or (self.analysisWidth >= width):
+            return frame
+        size = (int(self.analysisWidth), max(int(round(height * self.analysisWidth / float(width))), 1))
+        # 直播源的分辨率不变，检测区域只需要缩放一次
+        if (self.roi is not None) and (self.scaledROI is None):
+            self.scaledROI = self.roi.scale(size[0] / float(width), size[1] / float(height))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def encodeFrame(self, frame):
+        """
+            Encode the low resolution frame of the ring buffer
+
+            Parameters
+            ----------
+            frame : ndarray
+                        The whole frame
+
+            Returns
+            -------
+            data : bytes
+                        The JPEG data
+        """
+
+        height, width = frame.shape[0:2]
+        if width > self.bufferWidth:
+            frame = cv2.resize(frame, (self.bufferWidth, max(int(height * self.bufferWidth / width), 1)),
+                               interpolation=cv2.INTER_AREA)
+        ret, data = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
+        return data.tobytes()
+
+    def publish(self, msg):
+        """
+            Send the message to the subscribers on the event loop, can be called from any thread
+
+            Parameters
+            ----------
+            msg : dict
+                        The message
+
+            Returns
+            -------
+        """
+
+        try:
+            self.loop.call_soon_threadsafe(self.dispatch, msg)
+        except RuntimeError:
+            # 事件循环已经关闭
+            self.stop()
+
+    def dispatch(self, msg):
+        """
+            Send the message to every subscriber, runs on the event loop
+            The event is dropped for the subscriber whose outbound queue is full,
+            the number of dropped events is sent with the next event
+
+            Parameters
+            ----------
+            msg : dict
+                        The message
+
+            Returns
+            -------
+        """
+
+        for msger in list(self.subscribers):
+            outbound = getattr(msger, 'outbound', None)
+            if (outbound is not None) and outbound.isFull():
+                self.dropped[id(msger)] = self.dropped.get(id(msger), 0) + 1
+                continue
+            data = dict(msg)
+            if self.dropped.get(id(msger)):
+                data['dropped'] = self.dropped.pop(id(msger))
+            try:
+                msger.send(data)
+            except Exception as ex:
+                print('Exception:', ex.__doc__)
+                self.unsubscribe(msger)
+
+
+def buildStreamKey(source, **kwargs):
+    """
+        Build the key of the stream, the subscribers with the same source and parameters share one stream
+
+        Parameters
+        ----------
+        source : string
+                    The live source
+        kwargs : params
+                    The parameters of LiveStream
+
+        Returns
+        -------
+        key : string
+                    The key of stream
+    """
+
+    return json.dumps({'source': source, 'params': kwargs}, sort_keys=True)
+
+
+def subscribe(source, msger, loop, **kwargs):
+    """
+        Subscribe the motion events of a live source
+
+        Parameters
+        ----------
+        source : string
+                    The live source
+        msger : Messager
+                    The messager of the subscriber
+        loop : AbstractEventLoop
+                    The event loop of the subscriber
+        kwargs : params
+                    The parameters of LiveStream
+
+        Returns
+        -------
+        stream : LiveStream
+                    The stream which the subscriber is added to
+    """
+
+    key = buildStreamKey(source, **kwargs)
+    stream = STREAMS.get(key)
+    if (stream is None) or stream.stopped.is_set():
+        stream = LiveStream(source, loop, **kwargs)
+        STREAMS[key] = stream
+    stream.subscribe(msger)
+    return stream
+
+
+def unsubscribe(stream, msger):
+    """
+        Unsubscribe the motion events of a live stream
+
+        Parameters
+        ----------
+        stream : LiveStream
+                    The stream returned by subscribe
+        msger : Messager
+                    The messager of the subscriber
+
+        Returns
+        -------
+    """
+
+    if stream.unsubscribe(msger) == 0:
+        removeStream(stream)
+
+
+def removeStream(stream):
+    """
+        Remove the stream from STREAMS, be called in the event loop
+
+        Parameters
+        ----------
+        stream : LiveStream
+                    The stopped stream
+
+        Returns
+        -------
+    """
+
+    for (key, value) in list(STREAMS.items()):
+        if value is stream:
+            STREAMS.pop(key)
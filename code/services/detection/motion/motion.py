@@ -6,17 +6,58 @@
 """
 import asyncio
 import json
+import multiprocessing
+import queue
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import cv2
-import copy
 import numpy as np
-from matplotlib import pyplot as plt
 import os
 import time
 import math
 import base64
 
+# PyAV可以只解码关键帧，没有安装时通过跳转读取关键帧
+try:
+    import av
+except ImportError:
+    av = None
+
 from services.detection.motion import motionutils
+from services.detection.motion import motionindex
+from services.detection.motion import heatmap
+from services.detection.motion import detectors
+from services.detection.motion import refine
+from messager import QueueSender, LoopSender
+from metrics import StageTimer
+
+# 跳过未采样帧的方式
+# 读取并解码所有帧
+SAMPLING_READ = 'read'
+# 只解封装未采样的帧，不进行解码
+SAMPLING_GRAB = 'grab'
+# 直接跳转到采样的帧
+SAMPLING_SEEK = 'seek'
+
+# 视频的扫描方式
+# 按采样间隔检测
+SCAN_EXACT = 'exact'
+# 只解码关键帧，快速得到粗略的结果
+SCAN_COARSE = 'coarse'
+
+# 缩小解码图片的比例，只需要灰度图时使用
+REDUCED_GRAYSCALE_FLAGS = [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)]
+# 缩小解码后图片的最小宽度，不小于检测策略使用的宽度
+REDUCED_MIN_WIDTH = 160
+
+# 图片的p-hash缓存，{(文件, 修改时间, 大小, 检测参数): (hash, 形状)}
+IMAGE_HASHES = OrderedDict()
+IMAGE_HASHES_LOCK = threading.Lock()
+# 缓存的图片数量上限
+IMAGE_HASHES_MAX = 100000
 
 
 class Motion():
@@ -34,27 +75,116 @@ class Motion():
                         Threshold of image similarity
                         Default value is 10
             regions : array_like, optional
-                        Vertex coordinates of the detection area
+                        Vertex coordinates of the detection area, one polygon or a list of polygons
                         Default value is None
+            detector : string or array_like, optional
+                        The detector strategy, or a chain of strategies run in order,
+                        e.g. ['absdiff', 'phash'] rejects the static samples by absdiff before p-hash
+                        An item can be {'name': name, 'threshold': threshold, ...} to set the options
+                        Default value is 'phash'
+                            phash, dhash, ahash: Hamming distance of the hash, the threshold is degree
+                            absdiff: Percentage of the changed pixels of the downsampled gray images
+                            mog, knn: Percentage of the foreground pixels given by the background subtractor
             msger : Messager, optional
                         Send the detected data to caller
                         Default value is None
+            executor : Executor, optional
+                        The executor which runs the detection
+                        Default value is None, the default executor of the event loop
             heatmap : int, optional
                         Does it need to generate a heatmap?
                         Default value is 0
                             0: Do not generate heatmap
                             1: Generate heatmap and return the file path of image
                             2: Generate heatmap and return the base64 string of image
+            heatmapCompression : int, optional
+                        The PNG compression level of heatmap image, 0 ~ 9
+                        Default value is 3
+            heatmapDecay : float, optional
+                        The fraction of the heatmap data which fades out at every accumulated frame, 0 ~ 1
+                        Default value is None, the heatmap data does not fade out
+            sampleInterval : int, optional
+                        Sampling interval of video in milliseconds
+                        Default value is None, one frame per second
+            analysisWidth : int, optional
+                        The frames wider than analysisWidth are downsampled to it right after decoding,
+                        the hash, background subtraction and heatmap run at the reduced size
+                        Default value is None, the original resolution
+            scan : string, optional
+                        'exact' detects the frames sampled by sampleInterval,
+                        'coarse' decodes only the keyframes of video, at most one per sampleInterval,
+                        which gives a rough answer quickly for long recordings.
+                        The video messages are labelled with the scan
+                        Default value is 'exact'
+            refine : bool, optional
+                        Find the frame-accurate onset and end of every motion event by bisecting the sampling interval,
+                        an 'event' message with the start and end is sent when the event ends.
+                        The bisection compares p-hashes, so it is ignored unless the detector is 'phash'
+                        Default value is False
+            prefetch : int, optional
+                        Number of images read and decoded ahead of the comparison by the reader threads
+                        Default value is 8
+            reducedDecode : bool, optional
+                        Decode the images at 1/2, 1/4 or 1/8 size in gray when only the gray image is analysed,
+                        i.e. there is no heatmap and no detection area
+                        Default value is True
+            samplingMode : string, optional
+                        How to skip the frames which are not sampled
+                        Default value is 'grab'
+                            read: Decode every frame (legacy behavior)
+                            grab: Grab the frames without decoding them
+                            seek: Seek to the sampled frames directly
+            workers : int, optional
+                        Number of worker processes to scan video files in parallel,
+                        the image files are hashed in parallel and compared in one vectorized pass
+                        Default value is 1
+                            0: One worker per CPU core
+                            1: Scan the video files one after another
+            segments : int, optional
+                        Number of time segments which one video is split into and scanned in parallel
+                        Default value is 1
+                            0: One segment per CPU core
+                            1: Scan the video in one serial pass
+            maxWorkers : int, optional
+                        The maximum number of worker processes of the task, which limits workers and segments
+                        Default value is None, the number of CPU cores
+            progressStep : int, optional
+                        Send a progress message every progressStep percent
+                        Default value is None, only the motion messages carry the progress
+            index : bool, optional
+                        Build a signature index of every video on the first scan,
+                        and answer the later queries without heatmap from the index
+                        Default value is False
+            indexRegions : bool, optional
+                        Answer the queries with regions from the index, the regions are approximated
+                        by a 16 * 16 grid, so the messages are marked with 'approximate'
+                        Default value is False, the video is scanned again when regions are given
+            indexDir : string, optional
+                        The directory of index files
+                        Default value is the index directory of current directory
+            hashBackend : string, optional
+                        The p-hash backend
+                        Default value is 'numpy'
+                            numpy: Vectorized p-hash based on numpy
+                            opencv: cv2.img_hash.PHash of opencv-contrib
                     
             Returns
             -------
         """
+        # 初始化参数，用于在工作进程中重建检测器
+        self.options = {k: v for k, v in kwargs.items() if k not in ('msger', 'executor')}
+        # 工作进程或者时间段检测失败时结果不完整
+        self.failed = False
         self.regions = kwargs.get('regions')
+        # 检测区域，在整个任务中复用
+        self.roi = motionutils.ROI(self.regions) if self.regions is not None else None
         self.degree = kwargs.get('degree', 10) if kwargs.get('degree', 10) is not None else 10
         # 对图像进行二值化处理所需要的一些阈值
         self.threshold = kwargs.get('threshold', 2) if kwargs.get('threshold', 2) is not None else 2
         self.maxValue = kwargs.get('maxValue', 2) if kwargs.get('maxValue', 2) is not None else 2
-        # 睡眠时间
+        # 执行检测的线程池，为空时使用事件循环默认的线程池
+        self.executor = kwargs.get('executor')
+        # 并行检测时查询工作进程消息的间隔
         self.sleepTimes = kwargs.get('sleepTimes', 0.1) if kwargs.get('sleepTimes', 0.1) is not None and kwargs.get(
             'sleepTimes', 0.1) != 0 else 0.1
         # 消息发送器
@@ -66,6 +196,48 @@ class Motion():
         self.heatmapDir = kwargs.get('heatmapDir', self.defaultHeatmapDir) or self.defaultHeatmapDir
         # 生成heatmap的标识
         self.heatmapTags = [1, 2]
+        # heatmap图片的压缩级别
+        self.heatmapCompression = kwargs.get('heatmapCompression')
+        # heatmap数据的衰减系数
+        self.heatmapDecay = kwargs.get('heatmapDecay')
+        # 是否使用视频的签名索引
+        self.index = kwargs.get('index', False) or False
+        # 是否由索引近似回答带检测区域的查询
+        self.indexRegions = kwargs.get('indexRegions', False) or False
+        # 索引文件的存储目录
+        self.indexDir = kwargs.get('indexDir') or os.path.join(os.getcwd(), 'index')
+        # pHash的计算后端
+        self.hashBackend = kwargs.get('hashBackend') or motionutils.HASH_BACKEND_NUMPY
+        # 检测策略
+        self.detector = kwargs.get('detector') or detectors.DEFAULT_DETECTOR
+        # 工作进程消息队列的上限
+        self.maxQueuedMessages = 1000
+        # 并行检测视频的进程数
+        self.workers = kwargs.get('workers', 1) if kwargs.get('workers', 1) is not None else 1
+        # 单个视频拆分的时间段数
+        self.segments = kwargs.get('segments', 1) if kwargs.get('segments', 1) is not None else 1
+        # 任务最多使用的进程数
+        self.maxWorkers = kwargs.get('maxWorkers') or os.cpu_count() or 1
+        # 发送进度消息的间隔(百分比)
+        self.progressStep = kwargs.get('progressStep')
+        # 视频的采样间隔(毫秒)，为空时每秒采样一帧
+        self.sampleInterval = kwargs.get('sampleInterval')
+        # 跳过未采样帧的方式
+        self.samplingMode = kwargs.get('samplingMode') or SAMPLING_GRAB
+        # 预先读取的图片数量
+        self.prefetch = kwargs.get('prefetch') or 8
+        # 是否缩小解码图片
+        self.reducedDecode = kwargs.get('reducedDecode', True) is not False
+        # 视频的扫描方式
+        self.scan = kwargs.get('scan') or SCAN_EXACT
+        # 是否细化motion的开始和结束时间
+        self.refine = kwargs.get('refine', False) or False
+        # 分析的分辨率(宽度)，为空时使用原始分辨率
+        self.analysisWidth = kwargs.get('analysisWidth')
+        # 缩小后图像的检测区域，{(原始宽度, 原始高度): ROI}
+        self.scaledROIs = {}
+        # 各阶段的累计耗时和次数
+        self.timer = StageTimer()
         # 支持的视频格式
         self.supportedVideoFormats = ['.mp4', '.avi']
         # 支持的图片格式
@@ -152,6 +324,12 @@ class Motion():
             print('Empty video files')
             return
 
+        # 多个视频时使用进程池并行处理
+        workers = self.getWorkers(len(videoFiles))
+        if workers > 1:
+            await self.motionDetect4VideosParallel(videoFiles, workers)
+            return
+
         # 遍历进行处理
         for videoFile in videoFiles:
             # 检查视频路径是否真实存在
@@ -160,11 +338,201 @@ class Motion():
                 continue
 
             # 进行视频检测
-            await self.motionDetect4Video(videoFile)
+            if self.getSegments() > 1:
+                await self.motionDetect4VideoSegments(videoFile, self.getSegments())
+            else:
+                await self.motionDetect4Video(videoFile)
+
+    async def motionDetect4VideosParallel(self, videoFiles, workers):
+        """
+            Motion detection based on videos file, the videos are spread across a process pool
+            The messages of workers are sent by msger as they arrive, with the overall progress
+
+            Parameters
+            ----------
+            videoFiles : array_like
+                        The video files to be detected
+            workers : int
+                        The number of worker processes
+
+            Returns
+            -------
+            source : string, optional
+                        The source name
+            degree : int, optional
+                        The value of similarity
+            index : int, optional
+                        The time or index of the motion
+            heatmapImg : string, optional
+                        heat map image
+			progress : int
+						Motion detection progress of the source
+			totalProgress : int
+						Motion detection progress of all sources
+        """
+
+        # 过滤不存在的视频
+        videoFiles = [videoFile for videoFile in videoFiles if (videoFile is not None) and os.path.exists(videoFile)]
+        if len(videoFiles) < 1:
+            print('Empty video files')
+            return
+
+        # 每个视频的检测进度
+        progresses = dict.fromkeys(videoFiles, 0)
+        loop = asyncio.get_event_loop()
+        # 使用spawn方式创建进程，避免复制父进程中的线程和事件循环
+        context = multiprocessing.get_context('spawn')
+        manager = context.Manager()
+        try:
+            # 工作进程通过有上限的队列返回消息，发送不及时时工作进程会等待
+            messages = manager.Queue(self.maxQueuedMessages)
+            options = dict(self.options, progressStep=self.progressStep or 1)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [loop.run_in_executor(executor, detectVideoInProcess, options, videoFile, messages)
+                           for videoFile in videoFiles]
+                while True:
+                    finished = all(future.done() for future in futures)
+                    # 转发工作进程的消息
+                    self.forwardMessages(messages, progresses)
+                    await self.drain()
+                    if finished:
+                        break
+                    await asyncio.sleep(self.sleepTimes)
+
+                for (videoFile, future) in zip(videoFiles, futures):
+                    if future.exception() is not None:
+                        self.failed = True
+                        print('The video file({0}) failed: {1}'.format(videoFile, future.exception()))
+        finally:
+            manager.shutdown()
+
+    async def drain(self):
+        """
+            Wait until the messager can accept more messages
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        drain = getattr(self.msger, 'drain', None)
+        if drain is not None:
+            await drain()
+
+    def forwardMessages(self, messages, progresses):
+        """
+            Send the messages of worker processes with the overall progress
+
+            Parameters
+            ----------
+            messages : Queue
+                        The messages of worker processes
+            progresses : dict
+                        The progress of every source
+
+            Returns
+            -------
+        """
+
+        while True:
+            try:
+                msg = messages.get_nowait()
+            except queue.Empty:
+                return
+
+            # 合并工作进程各阶段的耗时
+            if msg.get('status') == 'finish':
+                self.timer.merge(msg.get('stages'))
+            # 计算所有视频的总进度
+            if msg.get('source') in progresses:
+                progresses[msg.get('source')] = msg.get('progress') or 0
+            msg['totalProgress'] = int(sum(progresses.values()) / len(progresses))
+            if self.msger is not None:
+                try:
+                    self.msger.send(msg)
+                except Exception as ex:
+                    # 发生异常时
+                    print('Exception:', ex.__doc__)
+
+    def getWorkers(self, count):
+        """
+            Get the number of worker processes
+
+            Parameters
+            ----------
+            count : int
+                        The number of files to be detected
+
+            Returns
+            -------
+            workers : int
+                        The number of worker processes
+        """
+
+        workers = self.workers if self.workers > 0 else (os.cpu_count() or 1)
+        return min(workers, count, self.maxWorkers)
+
+    def getProcesses(self, count):
+        """
+            Get the number of processes the detection may run at the same time
+
+            Parameters
+            ----------
+            count : int
+                        The number of files to be detected
+
+            Returns
+            -------
+            processes : int
+                        The number of processes, at most maxWorkers
+        """
+
+        return max(self.getWorkers(count), min(self.getSegments(), self.maxWorkers), 1)
+
+    def getSegments(self):
+        """
+            Get the number of time segments which one video is split into
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            segments : int
+                        The number of segments
+        """
+
+        return self.segments if self.segments > 0 else (os.cpu_count() or 1)
+
+    def sendProgress(self, source, progress):
+        """
+            Send the progress message
+
+            Parameters
+            ----------
+            source : string
+                        The source name
+            progress : int
+                        Motion detection progress
+
+            Returns
+            -------
+        """
+
+        if self.msger is not None:
+            try:
+                self.msger.send({'source': source, 'index': None, 'degree': None, 'heatmapImg': None,
+                                 'progress': progress, 'status': 'progress'})
+            except Exception as ex:
+                # 发生异常时
+                print('Exception:', ex.__doc__)
 
     async def motionDetect4Video(self, videoFile):
         """
             Motion detection based on video file
+            The detection runs in the executor, the messages are sent in the event loop
 
             Parameters
             ----------
@@ -185,6 +553,21 @@ class Motion():
 						Motion detection progress
         """
 
+        await self.runInExecutor(self.detectVideo, videoFile)
+
+    def detectVideo(self, videoFile):
+        """
+            Motion detection based on video file, which blocks until the detection is finished
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file to be detected
+
+            Returns
+            -------
+        """
+
         # 参数检查
         if (videoFile is None) or (not os.path.exists(videoFile)):
             print('The video({0}) does not exist'.format(videoFile))
@@ -194,7 +577,7 @@ class Motion():
         capture = cv2.VideoCapture(videoFile)
 
         # 视频不存在
-        if not capture.isOpened:
+        if not capture.isOpened():
             print(r'The video file({0}) does not exist'.format(videoFile))
             return
 
@@ -220,372 +603,1693 @@ class Motion():
         # 参数检查
         if fps <= 0 or frameCount <= 0 or width <= 0 or height <= 0:
             print('Invalid video')
+            capture.release()
             return
 
-        # 背景剪裁器
-        backgroundSubtractor = None
-        accumulatedImage = None
+        # 采样间隔
+        step = self.getSampleStep(fps)
+        # 签名索引
+        motionIndex = None
+        indexBuilder = None
+        if self.index and self.scan != SCAN_COARSE:
+            motionIndex = motionindex.MotionIndex(self.indexDir)
+            # 不需要heatmap时直接从索引中查询
+            index = self.loadIndex(motionIndex, videoFile, step)
+            if index is not None:
+                capture.release()
+                self.detectVideoFromIndex(videoFile, motionIndex, index)
+                return
+            indexBuilder = motionindex.IndexBuilder(frameCount, width, height, self.hashBackend)
+
+        # 缩小后图像的检测区域
+        roi = self.getROI(width, height)
+        # 检测策略
+        detectorChain = self.createDetectorChain()
+        # 细化motion的开始和结束，二分查找基于p-hash，其他检测策略不细化
+        refiner = None
+        if self.refine and not detectorChain.isPHash():
+            print('Refine is only supported by the p-hash detector, the events are not refined')
+        elif self.refine:
+            refiner = refine.BoundaryRefiner(videoFile, self.degree, roi, self.downsample, self.hashBackend)
+        # 上一个采样帧
+        lastIndex = None
+        # 正在进行的motion的开始，(帧, 时间)
+        eventStart = None
+        # 最后一个有motion的采样帧之前的采样帧，motion在它之后结束
+        eventLastIndex = None
+
+        # heatmap数据
+        accumulator = None
 
         # 生成heatmap
         if self.heatmap in self.heatmapTags:
             # 获取背景剪裁器
-            backgroundSubtractor = cv2.bgsegm.createBackgroundSubtractorMOG()
-            # 没有指定检测区域，则默认检测整个图像区域
-            if self.regions is None:
-                accumulatedImage = np.zeros((height, width), np.uint8)
+            accumulator = self.createHeatmapAccumulator(cv2.bgsegm.createBackgroundSubtractorMOG())
 
-        # 遍历所有的帧
-        for i in range(1, frameCount + 1):
+        # 上一次发送的进度
+        lastProgress = 0
+        # 是否检测完所有的帧
+        completed = True
 
-            # 读取一帧数据
-            (ret, currentFrame) = capture.read()
+        # 复用的帧数据，上一帧保留在另一组数据中
+        buffers = motionutils.FrameBuffers()
+        # 采样的帧
+        if self.scan == SCAN_COARSE:
+            frames = self.readKeyframes(videoFile, capture, frameCount, step, buffers)
+        else:
+            frames = self.readSampledFrames(capture, frameCount, step, buffers=buffers)
 
-            # 判断是否是有效帧
-            if not ret:
-                continue
-            if currentFrame is None:
-                continue
+        # 遍历所有采样的帧
+        for (i, currentFrame) in frames:
 
             # 计算检测进度
             progress = int(i / frameCount * 100)
 
+            # 发送进度消息
+            if (self.progressStep is not None) and (progress - lastProgress >= self.progressStep):
+                lastProgress = progress
+                self.sendProgress(videoFile, progress)
+
+            # 记录索引数据
+            if indexBuilder is not None:
+                started = time.perf_counter()
+                indexBuilder.add(capture.get(cv2.CAP_PROP_POS_MSEC), i, currentFrame)
+                self.timer.add('index', started)
+
             # 裁剪图片
-            if self.regions is not None:
-                currentFrame = motionutils.getROI(currentFrame, self.regions)
+            if roi is not None:
+                started = time.perf_counter()
+                currentFrame = buffers.put('roi', roi.apply(currentFrame, buffers.get('roi')))
+                self.timer.add('roi', started)
 
             # 是否是第一帧
             if lastFrame is None:
-                # 设置上一帧
-                lastFrame = copy.deepcopy(currentFrame)
+                # 设置上一帧，不需要复制
+                lastFrame = currentFrame
+                detectorChain.start(currentFrame)
+                lastIndex = i
                 # 生成heatmap
-                if self.heatmap in self.heatmapTags:
-                    # [高|宽|像素值]
-                    if accumulatedImage is None:
-                        roiHeight, roiWidth = currentFrame.shape[0:2]
-                        accumulatedImage = np.zeros((roiHeight, roiWidth), np.uint8)
+                if accumulator is not None:
                     # 为计算热力图做数据准备
-                    # 移除背景
-                    filter = backgroundSubtractor.apply(currentFrame)
-                    # 二值化
-                    ret, thresh = cv2.threshold(filter, self.threshold, self.maxValue, cv2.THRESH_BINARY)
-                    # 去除图像噪声,先腐蚀再膨胀
-                    # iterations的值越高，模糊程度（腐蚀程度）就越高 呈正相关
-                    # thresh = cv2.erode(thresh, None, iterations=1)
-                    # thresh = cv2.dilate(thresh, None, iterations=2)
-                    # 相加
-                    accumulatedImage = cv2.add(accumulatedImage, thresh)
-                continue
-
-            # 只处理每秒内第一帧的数据
-            if i % fps != 0:
+                    self.accumulate(accumulator, currentFrame)
                 continue
 
             # 计算上一帧与当前帧的相似度
-            degree = motionutils.calculateDegreeBasePHash(lastFrame, currentFrame)
+            (moved, degree) = detectorChain.detect(lastFrame, currentFrame)
 
             # 大于指定阈值
-            if degree >= self.degree:
+            if moved:
                 # 生成heatmap
-                if self.heatmap in self.heatmapTags:
-                    # [高|宽|像素值]
-                    if accumulatedImage is None:
-                        roiHeight, roiWidth = currentFrame.shape[0:2]
-                        accumulatedImage = np.zeros((roiHeight, roiWidth), np.uint8)
+                if accumulator is not None:
                     # 为计算热力图做数据准备
-                    # 移除背景
-                    filter = backgroundSubtractor.apply(currentFrame)
-                    # 二值化
-                    ret, thresh = cv2.threshold(filter, self.threshold, self.maxValue, cv2.THRESH_BINARY)
-                    # 去除图像噪声,先腐蚀再膨胀
-                    # iterations的值越高，模糊程度（腐蚀程度）就越高 呈正相关
-                    # thresh = cv2.erode(thresh, None, iterations=1) 
-                    # thresh = cv2.dilate(thresh, None, iterations=2) 
-                    # 相加
-                    accumulatedImage = cv2.add(accumulatedImage, thresh)
+                    self.accumulate(accumulator, currentFrame)
 
                 # 获取当前帧的所对应的时间
-                milliseconds = capture.get(cv2.CAP_PROP_POS_MSEC)
+                if self.scan == SCAN_COARSE:
+                    milliseconds = (i - 1) * 1000.0 / capture.get(cv2.CAP_PROP_FPS)
+                else:
+                    milliseconds = capture.get(cv2.CAP_PROP_POS_MSEC)
                 motionTimes.append(milliseconds)
                 print('Changed: ', milliseconds, ' degree: ', degree)
+                msg = {'source': videoFile, 'index': milliseconds, 'degree': degree, 'heatmapImg': None,
+                       'progress': progress, 'status': 'process', 'scan': self.scan}
+                # 在两个采样帧之间查找motion开始的帧
+                if (refiner is not None) and (eventStart is None):
+                    started = time.perf_counter()
+                    lastHash = motionutils.calculatePHash(lastFrame, self.hashBackend)
+                    eventStart = refiner.findOnset(lastIndex, lastHash, i)
+                    msg['startFrame'], msg['start'] = eventStart
+                    self.timer.add('refine', started)
+                eventLastIndex = lastIndex
                 # 发送消息
                 if self.msger is not None:
                     try:
-                        self.msger.send(
-                            {'source': videoFile, 'index': milliseconds, 'degree': degree, 'heatmapImg': None,
-                             'progress': progress, 'status': 'process'})
+                        started = time.perf_counter()
+                        self.msger.send(msg)
+                        self.timer.add('send', started)
                     except Exception as ex:
                         # 发生异常时，释放打开的文件句柄
                         capture.release()
-
-            # 设置上一帧
-            lastFrame = copy.deepcopy(currentFrame)
-
-            # sleep
-            await asyncio.sleep(self.sleepTimes)
+                        completed = False
+                        break
+            elif eventStart is not None:
+                # 在两个采样帧之间查找motion结束的帧
+                started = time.perf_counter()
+                currentHash = motionutils.calculatePHash(currentFrame, self.hashBackend)
+                eventEnd = refiner.findEnd(eventLastIndex, i, currentHash)
+                self.timer.add('refine', started)
+                if not self.sendEvent(videoFile, eventStart, eventEnd, progress):
+                    capture.release()
+                    completed = False
+                    break
+                eventStart = None
+
+            # 设置上一帧，下一帧读取到另一组数据中，不需要复制
+            lastFrame = currentFrame
+            lastIndex = i
+
+        # 视频结束时motion还没有结束
+        if (eventStart is not None) and completed:
+            self.sendEvent(videoFile, eventStart, (lastIndex, refiner.getTime(lastIndex)), 100)
+        if refiner is not None:
+            refiner.release()
+
+        # 保存索引
+        if (indexBuilder is not None) and completed:
+            started = time.perf_counter()
+            motionIndex.save(videoFile, step, self.hashBackend, indexBuilder, self.analysisWidth)
+            self.timer.add('index', started)
+        self.recordDetectors(detectorChain)
 
         # 生成heatmap
-        if (self.heatmap in self.heatmapTags) and (accumulatedImage is not None):
-            # 计算热点图
-            colorMapImage = cv2.applyColorMap(accumulatedImage, cv2.COLORMAP_HOT)
-            # 转换成PNG图像，相对于其它图像，PNG图像多了一个透明通道
-            pngImage = cv2.cvtColor(colorMapImage, cv2.COLOR_BGR2BGRA)
-            # 将255改变成0
-            pngImage[np.all(pngImage == [0, 0, 0, 255], axis=2)] = [0, 0, 0, 0]
-            # 调整透明度
-            pngImage[np.any(pngImage != [0, 0, 0, 0], axis=2)] = np.subtract(
-                pngImage[np.any(pngImage != [0, 0, 0, 0], axis=2)], [0, 0, 0, 55])
-
-            # regions不为空，则进行重新resize
-            if (self.regions is not None) and (pngImage.shape[0:2] != (width, height)):
-                pngImage = cv2.resize(pngImage, (width, height))
-
-            # 根据指定返回heat map的方式进行处理
-            if not os.path.exists(self.heatmapDir):
-                try:
-                    os.mkdir(self.heatmapDir)
-                    heatmapImg = self.buildHeatmapFileName()
-                    cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
-                except BaseException:
-                    try:
-                        if not os.path.exists(self.defaultHeatmapDir):
-                            os.mkdir(self.defaultHeatmapDir)
-                            heatmapImg = self.buildHeatmapFileName()
-                            cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
-                    except BaseException:
-                        print('Invalid heat map directory')
-            else:
-                heatmapImg = self.buildHeatmapFileName()
-                cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
-
-            # 以Base64格式返回生成的heatmap
-            if self.heatmap == 2:
-                with open(heatmapImg, "rb") as f:
-                    heatmapImg = 'data:image/png;base64,' + base64.b64encode(f.read()).decode()
+        if (accumulator is not None) and (accumulator.data is not None):
+            heatmapImg = self.buildHeatmap(accumulator, width, height, cv2.COLORMAP_HOT, 55)
 
-            # 显示热力图
-            plt.imshow(pngImage)
-            plt.show()
+        # 释放打开的文件句柄
+        capture.release()
 
         # 结束消息
         if self.msger is not None:
             try:
                 self.msger.send(
                     {'source': videoFile, 'index': None, 'degree': None, 'heatmapImg': heatmapImg, 'progress': 100,
-                     'status': 'finish'})
+                     'status': 'finish', 'scan': self.scan, 'detectors': detectorChain.report(),
+                     'refinedFrames': refiner.decoded if refiner is not None else None,
+                     'stages': self.timer.report()})
             except Exception as ex:
                 # 发生异常时，释放打开的文件句柄
                 capture.release()
 
-    async def motionDetect4Images(self, imageFiles):
+    def sendEvent(self, videoFile, eventStart, eventEnd, progress):
         """
-            Motion detection based on images
+            Send the refined motion event
 
             Parameters
             ----------
-            imageFiles : imageFiles
-                        The image files to be detected
-                    
+            videoFile : String
+                        The video file
+            eventStart : tuple
+                        (frame, time) of the first frame of the motion
+            eventEnd : tuple
+                        (frame, time) of the last frame of the motion
+            progress : int
+                        Motion detection progress
+
             Returns
             -------
-            source : string, optional
-                        The source name
-            degree : int, optional
-                        The value of similarity
-            index : string, optional
-                        The time or index of the motion
-            heatmapImg : string, optional
-                        heat map image
-			progress : int
-						Motion detection progress
+            m : bool
+                        False if the message can not be sent
         """
 
-        # 参数检查
-        if imageFiles is None or len(imageFiles) < 1:
-            print('Empty image files')
-            return
+        print('Event: ', eventStart[1], ' - ', eventEnd[1])
+        if self.msger is not None:
+            try:
+                self.msger.send(
+                    {'source': videoFile, 'index': eventStart[1], 'degree': None, 'heatmapImg': None,
+                     'progress': progress, 'status': 'event', 'scan': self.scan,
+                     'startFrame': eventStart[0], 'start': eventStart[1], 'endFrame': eventEnd[0], 'end': eventEnd[1]})
+            except Exception as ex:
+                print('Exception:', ex.__doc__)
+                return False
+        return True
 
-        # 背景剪裁器
-        backgroundSubtractor = None
-        accumulatedImage = None
+    def createDetectorChain(self):
+        """
+            Create the detector strategies of a scan
 
-        # 生成heatmap
-        if self.heatmap in self.heatmapTags:
-            # 获取背景剪裁器
-            # backgroundSubtractor = cv2.bgsegm.createBackgroundSubtractorMOG()
-            backgroundSubtractor = cv2.createBackgroundSubtractorKNN(detectShadows=False)
+            Parameters
+            ----------
 
-        # 上一张图片
-        lastImage = None
-        # 当前图片
-        currentImage = None
-        # 生成的heatmap
-        heatmapImg = None
+            Returns
+            -------
+            chain : DetectorChain
+                        The detectors
+        """
 
-        # 原始图片的大小
-        originalHeight = None
-        originalWidth = None
+        return detectors.createDetectorChain(self.detector, self.degree, self.hashBackend)
 
-        # 发生motion的图片
-        motionFiles = []
+    def recordDetectors(self, detectorChain):
+        """
+            Add the cost of the detectors to the stages, e.g. 'detector.phash'
 
-        # 图片的总数
-        imageCount = len(imageFiles)
+            Parameters
+            ----------
+            detectorChain : DetectorChain
+                        The detectors of a finished scan
 
-        self.maxValue = 255 / imageCount
+            Returns
+            -------
+        """
 
-        # 遍历进行处理
-        for i in range(0, imageCount):
-            # 计算进度
-            progress = int(i / imageCount * 100)
-            # 图片路径
-            imageFile = imageFiles[i]
-            # 检查图片是否真实存在
-            if (imageFile is None) or (not os.path.exists(imageFile)):
-                print('The image file({0}) does not exist'.format(imageFile))
-                continue
+        for detector in detectorChain.detectors:
+            self.timer.record('detector.' + detector.name, detector.samples, detector.seconds)
 
-            # 读取图片
-            currentImage = cv2.imread(imageFile)
-            # 获取图片的高度、宽度
-            height, width = currentImage.shape[0:2]
-            originalHeight = height
-            originalWidth = width
+    def accumulate(self, accumulator, image):
+        """
+            Accumulate the image into the heatmap data, the background subtraction is timed
 
-            # 没有指定检测区域，则默认检测整个图像区域，否则则获取指定区域的图像
-            if self.regions is not None:
-                # 裁剪图片
-                currentImage = motionutils.getROI(currentImage, self.regions)
-                height, width = currentImage.shape[0:2]
+            Parameters
+            ----------
+            accumulator : HeatmapAccumulator
+                        The heatmap data
+            image : ndarray
+                        The analysed image
 
-            # 检查图片的形状是否一样
-            if (lastImage is not None) and (lastImage.shape != currentImage.shape):
-                print('The image file({0}) not the same shape'.format(imageFile))
-                continue
+            Returns
+            -------
+        """
 
-            # 初始化第一张图像
-            if lastImage is None:
-                lastImage = copy.deepcopy(currentImage)
-                if self.heatmap in self.heatmapTags:
-                    # 初始化accumulatedImage
-                    if accumulatedImage is None:
-                        accumulatedImage = np.zeros((height, width), np.uint8)
-                    # 为计算热力图做数据准备
-                    # 移除背景
-                    filter = backgroundSubtractor.apply(currentImage)
-                    # 二值化
-                    ret, thresh = cv2.threshold(filter, self.threshold, self.maxValue, cv2.THRESH_BINARY)
-                    # 去除图像噪声,先腐蚀再膨胀
-                    # thresh = cv2.erode(thresh,None, iterations=1)
-                    # thresh = cv2.dilate(thresh, None, iterations=2)
-                    # 相加
-                    accumulatedImage = cv2.add(accumulatedImage, thresh)
-                continue
+        started = time.perf_counter()
+        accumulator.add(image)
+        self.timer.add('heatmap.accumulate', started)
 
-            # 计算上一帧与当前帧的相似度
-            degree = motionutils.calculateDegreeBasePHash(lastImage, currentImage)
+    def getAnalysisSize(self, width, height):
+        """
+            Get the size of the frames to be analysed
 
-            # 大于指定阈值
-            if degree >= self.degree:
-                # 生成heatmap
-                if self.heatmap in self.heatmapTags:
-                    # 初始化accumulatedImage
-                    if accumulatedImage is None:
-                        accumulatedImage = np.zeros((height, width), np.uint8)
-                    # 为计算热力图做数据准备
-                    # 移除背景
-                    filter = backgroundSubtractor.apply(currentImage)
-                    # 二值化
-                    ret, thresh = cv2.threshold(filter, self.threshold, self.maxValue, cv2.THRESH_BINARY)
-                    # 去除图像噪声,先腐蚀再膨胀
-                    # thresh = cv2.erode(thresh,None, iterations=1)
-                    # thresh = cv2.dilate(thresh, None, iterations=2)
-                    # 相加
-                    accumulatedImage = cv2.add(accumulatedImage, thresh)
+            Parameters
+            ----------
+            width : int
+                        The width of the original frame
+            height : int
+                        The height of the original frame
 
-                motionFiles.append(imageFile)
-                # print('Changed: ', milliseconds, ' degree: ', degree)
-                # 发送消息
-                if self.msger is not None:
-                    try:
-                        self.msger.send({'source': imageFile, 'index': imageFile, 'degree': degree, 'heatmapImg': None,
-                                         'progress': progress, 'status': 'process'})
-                    except Exception as ex:
-                        # 发生异常时
-                        print('Exception:', ex.__doc__)
+            Returns
+            -------
+            size : tuple
+                        (width, height), None if the frame is not downsampled
+        """
 
-            # 设置上一幅图片
-            lastImage = copy.deepcopy(currentImage)
+        if (not self.analysisWidth) or (self.analysisWidth >= width):
+            return None
+        return int(self.analysisWidth), max(int(round(height * self.analysisWidth / float(width))), 1)
 
-            # sleep
-            await asyncio.sleep(self.sleepTimes)
+    def downsample(self, frame, buffers=None):
+        """
+            Downsample the frame to the analysis resolution
 
-        # 生成heatmap
-        if (self.heatmap in self.heatmapTags) and (accumulatedImage is not None):
-            # 计算热点图
-            colorMapImg = cv2.applyColorMap(accumulatedImage, cv2.COLORMAP_JET)
-            # 转换成PNG图像，相对于其它图像，PNG图像多了一个透明通道
-            pngImage = cv2.cvtColor(colorMapImg, cv2.COLOR_BGR2BGRA)
-            # 将255改变成0
-            pngImage[np.all(pngImage == [0, 0, 0, 255], axis=2)] = [0, 0, 0, 0]
-            # 调整透明度
-            pngImage[np.any(pngImage != [0, 0, 0, 0], axis=2)] = np.subtract(
-                pngImage[np.any(pngImage != [0, 0, 0, 0], axis=2)], [0, 0, 0, 200])
-            # regions不为空，则进行重新resize
-            if (self.regions is not None) and (pngImage.shape[0:2] != (originalWidth, originalHeight)):
-                pngImage = cv2.resize(pngImage, (originalWidth, originalHeight))
-
-            # 根据指定返回heat map的方式进行处理
-            if not os.path.exists(self.heatmapDir):
-                try:
-                    os.mkdir(self.heatmapDir)
-                    heatmapImg = self.buildHeatmapFileName()
-                    cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
-                except BaseException:
-                    try:
-                        if not os.path.exists(self.defaultHeatmapDir):
-                            os.mkdir(self.defaultHeatmapDir)
-                            heatmapImg = self.buildHeatmapFileName()
-                            cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
-                    except BaseException:
-                        print('Invalid heat map directory')
-            else:
-                heatmapImg = self.buildHeatmapFileName()
-                cv2.imwrite(heatmapImg, pngImage, [int(cv2.IMWRITE_PNG_COMPRESSION), 9])
+            Parameters
+            ----------
+            frame : ndarray
+                        The decoded frame
+            buffers : FrameBuffers, optional
+                        The reused output arrays
+                        Default value is None
 
-            if self.heatmap == 2:
-                with open(heatmapImg, "rb") as f:
-                    heatmapImg = 'data:image/png;base64,' + base64.b64encode(f.read()).decode()
+            Returns
+            -------
+            frame : ndarray
+                        The downsampled frame, or the frame itself if it is not downsampled
+        """
 
-            # 显示热力图
-            plt.imshow(pngImage)
-            plt.show()
+        size = self.getAnalysisSize(frame.shape[1], frame.shape[0])
+        if size is None:
+            return frame
+        started = time.perf_counter()
+        if buffers is None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        else:
+            frame = buffers.put('analysis', cv2.resize(frame, size, dst=buffers.get('analysis'),
+                                                       interpolation=cv2.INTER_AREA))
+        self.timer.add('downsample', started)
+        return frame
+
+    def getROI(self, width, height):
+        """
+            Get the ROI of the frames analysed at the reduced resolution
 
-        # 结束消息
-        if self.msger is not None:
-            try:
-                self.msger.send(
-                    {'source': None, 'index': None, 'degree': None, 'heatmapImg': heatmapImg, 'progress': 100,
-                     'status': 'finish'})
-            except Exception as ex:
-                # 发生异常时
-                print('Exception:', ex.__doc__)
+            Parameters
+            ----------
+            width : int
+                        The width of the original frame
+            height : int
+                        The height of the original frame
+
+            Returns
+            -------
+            roi : ROI
+                        None if there is no detection area
+        """
 
-    def buildHeatmapFileName(self, heatmapDir=None):
+        size = self.getAnalysisSize(width, height)
+        if (self.roi is None) or (size is None):
+            return self.roi
+        roi = self.scaledROIs.get((width, height))
+        if roi is None:
+            roi = self.roi.scale(size[0] / float(width), size[1] / float(height))
+            self.scaledROIs[(width, height)] = roi
+        return roi
+
+    def loadIndex(self, motionIndex, videoFile, step):
         """
-            Build the heatmap file name according to time strategy
+            Load the signature index of video which can answer the query
 
             Parameters
             ----------
+            motionIndex : MotionIndex
+                        The signature index
+            videoFile : String
+                        The video file
+            step : int
+                        The sampling step in frames
+
+            Returns
+            -------
+            index : dict
+                        None if the query can not be answered by the index
+        """
+
+        # 索引中没有heatmap需要的数据，并且只有p-hash
+        if (self.heatmap in self.heatmapTags) or self.refine or (not self.createDetectorChain().isPHash()):
+            return None
+        # 检测区域只能由网格近似，需要明确允许
+        if (self.regions is not None) and (not self.indexRegions):
+            return None
+        return motionIndex.load(videoFile, step, self.hashBackend, self.analysisWidth)
+
+    def detectVideoFromIndex(self, videoFile, motionIndex, index):
         """
-        fileName = None
-        # 根据传参目录生成文件名
-        if (heatmapDir is not None) and (os.path.exists(heatmapDir)):
-            fileName = os.path.join(heatmapDir, time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime()) + '.png')
-        # 根据初始化时给的目录生成文件名
-        elif (self.heatmapDir is not None) and (os.path.exists(self.heatmapDir)):
-            fileName = os.path.join(self.heatmapDir, time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime()) + '.png')
-        # 根据初始化时的默认路径生成文件名
-        elif (self.defaultHeatmapDir is not None) and (os.path.exists(self.defaultHeatmapDir)):
-            fileName = os.path.join(self.defaultHeatmapDir,
-                                    time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime()) + '.png')
-        return fileName
+            Motion detection based on the signature index of video
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file
+            motionIndex : MotionIndex
+                        The signature index
+            index : dict
+                        The index of video
+
+            Returns
+            -------
+        """
+
+        started = time.perf_counter()
+        events = list(motionIndex.query(index, self.degree, self.regions, self.hashBackend))
+        # 检测区域由网格近似时结果是近似的
+        approximate = self.regions is not None
+        self.timer.add('index', started)
+        for (milliseconds, degree, frame) in events:
+            print('Changed: ', milliseconds, ' degree: ', degree)
+            if self.msger is not None:
+                try:
+                    self.msger.send(
+                        {'source': videoFile, 'index': milliseconds, 'degree': degree, 'heatmapImg': None,
+                         'progress': int(frame / index['frameCount'] * 100), 'status': 'process',
+                         'scan': self.scan, 'fromIndex': True, 'approximate': approximate})
+                except Exception as ex:
+                    # 发生异常时
+                    print('Exception:', ex.__doc__)
+                    return
+
+        # 结束消息
+        if self.msger is not None:
+            try:
+                self.msger.send(
+                    {'source': videoFile, 'index': None, 'degree': None, 'heatmapImg': None, 'progress': 100,
+                     'status': 'finish', 'scan': self.scan, 'fromIndex': True, 'approximate': approximate,
+                     'stages': self.timer.report()})
+            except Exception as ex:
+                # 发生异常时
+                print('Exception:', ex.__doc__)
+
+    async def motionDetect4VideoSegments(self, videoFile, segments):
+        """
+            Motion detection based on video file, the video is split into time segments
+            which are decoded by worker processes in parallel, each starting from a seek point
+            The comparison across the segment boundaries is stitched by the last hash of the previous segment,
+            the events are sent in timestamp order and the heatmap data of the segments are merged
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file to be detected
+            segments : int
+                        The number of segments
+
+            Returns
+            -------
+            source : string, optional
+                        The source name
+            degree : int, optional
+                        The value of similarity
+            index : int, optional
+                        The time or index of the motion
+            heatmapImg : string, optional
+                        heat map image
+			progress : int
+						Motion detection progress
+        """
+
+        # 打开视频和读取索引会阻塞，在线程池中执行
+        probe = await self.runInExecutor(self.probeSegments, videoFile, segments)
+        if probe is None:
+            return
+        # 可以从索引中查询时直接使用已经读取的索引
+        if probe['index'] is not None:
+            await self.runInExecutor(self.detectVideoFromIndex, videoFile, probe['motionIndex'], probe['index'])
+            return
+        if not self.canSplitSegments(probe['bounds']):
+            await self.motionDetect4Video(videoFile)
+            return
+        bounds = probe['bounds']
+        frameCount = probe['frameCount']
+        width = probe['width']
+        height = probe['height']
+
+        # 生成的heatmap
+        heatmapImg = None
+        accumulator = self.createHeatmapAccumulator()
+        # 上一个时间段最后一个采样帧的hash
+        lastHash = None
+        # 上一次发送的进度
+        lastProgress = 0
+        # 合并所有时间段的检测耗时
+        detectorChain = self.createDetectorChain()
+        detector = detectorChain.detectors[0]
+
+        loop = asyncio.get_event_loop()
+        context = multiprocessing.get_context('spawn')
+        workers = min(len(bounds), self.maxWorkers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [loop.run_in_executor(executor, detectSegmentInProcess, self.options, videoFile, startFrame,
+                                            endFrame) for (startFrame, endFrame) in bounds]
+            # 按时间顺序处理每个时间段的结果
+            for future in futures:
+                try:
+                    result = await future
+                except Exception as ex:
+                    self.failed = True
+                    print('The segment of video file({0}) failed: {1}'.format(videoFile, ex))
+                    continue
+
+                events = result['events']
+                self.timer.merge(result.get('stages'))
+                detector.samples += result['samples']
+                detector.passed += len(events)
+                detector.seconds += result['seconds']
+                # 拼接时间段的边界，比较上一个时间段的最后一帧与本时间段的第一帧
+                if (lastHash is not None) and (result['firstHash'] is not None):
+                    degree = motionutils.calculateHammingDistance(lastHash, result['firstHash'])
+                    detector.samples += 1
+                    if degree >= detector.threshold:
+                        detector.passed += 1
+                        events = [{'index': result['firstIndex'], 'degree': degree,
+                                   'frame': result['firstFrame']}] + events
+                if result['lastHash'] is not None:
+                    lastHash = result['lastHash']
+
+                # 合并heatmap数据
+                accumulator.merge(result['accumulatedImage'], result['accumulatedCount'])
+
+                # 发送消息
+                for event in events:
+                    progress = int(event['frame'] / frameCount * 100)
+                    print('Changed: ', event['index'], ' degree: ', event['degree'])
+                    if self.msger is not None:
+                        try:
+                            self.msger.send(
+                                {'source': videoFile, 'index': event['index'], 'degree': event['degree'],
+                                 'heatmapImg': None, 'progress': progress, 'status': 'process',
+                                 'scan': self.scan})
+                        except Exception as ex:
+                            # 发生异常时
+                            print('Exception:', ex.__doc__)
+                    await self.drain()
+
+                # 发送进度消息
+                progress = int(result['endFrame'] / frameCount * 100)
+                if (self.progressStep is not None) and (progress - lastProgress >= self.progressStep):
+                    lastProgress = progress
+                    self.sendProgress(videoFile, progress)
+
+        # 生成heatmap
+        if (self.heatmap in self.heatmapTags) and (accumulator.data is not None):
+            heatmapImg = await loop.run_in_executor(self.executor, self.buildHeatmap, accumulator, width, height,
+                                                    cv2.COLORMAP_HOT, 55)
+        # 时间段中p-hash的耗时已经合并到detector中
+        self.recordDetectors(detectorChain)
+
+        # 结束消息
+        if self.msger is not None:
+            try:
+                self.msger.send(
+                    {'source': videoFile, 'index': None, 'degree': None, 'heatmapImg': heatmapImg, 'progress': 100,
+                     'status': 'finish', 'scan': self.scan, 'detectors': detectorChain.report(),
+                     'stages': self.timer.report()})
+            except Exception as ex:
+                # 发生异常时
+                print('Exception:', ex.__doc__)
+
+    def probeSegments(self, videoFile, segments):
+        """
+            Read the parameters of video and its index, which blocks until they are read
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file
+            segments : int
+                        The number of segments
+
+            Returns
+            -------
+            probe : dict
+                        None if the video is invalid
+                        bounds : The segments given by splitSegments
+                        frameCount, width, height : The parameters of video
+                        motionIndex : The signature index, None if the index is not used
+                        index : The index which can answer the query, None if it does not exist
+        """
+
+        # 参数检查
+        if (videoFile is None) or (not os.path.exists(videoFile)):
+            print('The video({0}) does not exist'.format(videoFile))
+            return None
+
+        # 获取视频相关的参数
+        capture = cv2.VideoCapture(videoFile)
+        fps = int(capture.get(cv2.CAP_PROP_FPS))
+        frameCount = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        capture.release()
+
+        # 参数检查
+        if fps <= 0 or frameCount <= 0 or width <= 0 or height <= 0:
+            print('Invalid video')
+            return None
+
+        step = self.getSampleStep(fps)
+        probe = {'bounds': self.splitSegments(frameCount, step, segments), 'frameCount': frameCount,
+                 'width': width, 'height': height, 'motionIndex': None, 'index': None}
+        # 只扫描关键帧时不使用索引
+        if self.index and self.scan != SCAN_COARSE:
+            probe['motionIndex'] = motionindex.MotionIndex(self.indexDir)
+            probe['index'] = self.loadIndex(probe['motionIndex'], videoFile, step)
+        return probe
+
+    def canSplitSegments(self, bounds):
+        """
+            Check whether the video is scanned in time segments
+
+            Parameters
+            ----------
+            bounds : array_like
+                        The segments given by splitSegments
+
+            Returns
+            -------
+            m : bool
+                        False if the video is scanned in one serial pass
+        """
+
+        # 视频太短、只扫描关键帧、细化motion或者不是p-hash检测时不拆分，可以从索引中查询时已经由索引回答
+        if len(bounds) < 2:
+            return False
+        if self.scan == SCAN_COARSE:
+            return False
+        if self.refine:
+            return False
+        if not self.createDetectorChain().isPHash():
+            return False
+        return True
+
+    def splitSegments(self, frameCount, step, segments):
+        """
+            Split the frames of video into time segments aligned to the sampling step
+
+            Parameters
+            ----------
+            frameCount : int
+                        The total number of frames
+            step : int
+                        The sampling step in frames
+            segments : int
+                        The number of segments
+
+            Returns
+            -------
+            bounds : array_like
+                        (startFrame, endFrame) of every segment, the segment reads the frames
+                        after startFrame up to endFrame, the first sampled frame is startFrame + 1
+        """
+
+        # 每个时间段的帧数，取采样间隔的整数倍
+        length = int(math.ceil(frameCount / float(segments) / step)) * step
+        bounds = []
+        for begin in range(0, frameCount, length):
+            # 第一个时间段从第一帧开始，其它时间段从第一个采样帧开始
+            startFrame = 0 if begin == 0 else begin + step - 1
+            endFrame = min(begin + length, frameCount)
+            if startFrame < endFrame:
+                bounds.append((startFrame, endFrame))
+        return bounds
+
+    def detectSegment(self, videoFile, startFrame, endFrame):
+        """
+            Motion detection of a time segment of video
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file to be detected
+            startFrame : int
+                        The frames after startFrame are read
+            endFrame : int
+                        The last frame to be read
+
+            Returns
+            -------
+            result : dict
+                        events : The motion events, [{'index', 'degree', 'frame'}]
+                        firstHash, firstIndex, firstFrame : The hash, time and index of the first sampled frame
+                        lastHash : The hash of the last sampled frame
+                        samples, seconds : The number of compared samples and the seconds of hashing
+                        accumulatedImage, accumulatedCount : The heatmap data of the segment and its number of frames
+                        endFrame : The last frame of the segment
+                        stages : The cumulative time and count of every stage
+        """
+
+        result = {'events': [], 'firstHash': None, 'firstIndex': None, 'firstFrame': None, 'lastHash': None,
+                  'accumulatedImage': None, 'accumulatedCount': 0, 'endFrame': endFrame, 'samples': 0, 'seconds': 0.0}
+
+        capture = cv2.VideoCapture(videoFile)
+        if not capture.isOpened():
+            print(r'The video file({0}) does not exist'.format(videoFile))
+            return result
+        fps = int(capture.get(cv2.CAP_PROP_FPS))
+        # 缩小后图像的检测区域
+        roi = self.getROI(int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+        # heatmap数据
+        accumulator = None
+        if self.heatmap in self.heatmapTags:
+            accumulator = self.createHeatmapAccumulator(cv2.bgsegm.createBackgroundSubtractorMOG())
+
+        lastHash = None
+        buffers = motionutils.FrameBuffers()
+        for (i, currentFrame) in self.readSampledFrames(capture, endFrame, self.getSampleStep(fps), startFrame,
+                                                        buffers):
+            # 裁剪图片
+            if roi is not None:
+                started = time.perf_counter()
+                currentFrame = buffers.put('roi', roi.apply(currentFrame, buffers.get('roi')))
+                self.timer.add('roi', started)
+            started = time.perf_counter()
+            currentHash = motionutils.calculatePHash(currentFrame, self.hashBackend)
+            result['seconds'] += time.perf_counter() - started
+
+            # 是否是第一帧
+            if lastHash is None:
+                result['firstHash'] = currentHash
+                result['firstIndex'] = capture.get(cv2.CAP_PROP_POS_MSEC)
+                result['firstFrame'] = i
+                if accumulator is not None:
+                    self.accumulate(accumulator, currentFrame)
+            else:
+                # 计算上一帧与当前帧的相似度
+                degree = motionutils.calculateHammingDistance(lastHash, currentHash)
+                result['samples'] += 1
+                if degree >= self.degree:
+                    if accumulator is not None:
+                        self.accumulate(accumulator, currentFrame)
+                    result['events'].append(
+                        {'index': capture.get(cv2.CAP_PROP_POS_MSEC), 'degree': degree, 'frame': i})
+            lastHash = currentHash
+
+        capture.release()
+        result['lastHash'] = lastHash
+        if accumulator is not None:
+            result['accumulatedImage'] = accumulator.data
+            result['accumulatedCount'] = accumulator.count
+        result['stages'] = self.timer.report()
+        return result
+
+    def getSampleStep(self, fps):
+        """
+            Get the number of frames between two sampled frames
+
+            Parameters
+            ----------
+            fps : int
+                        The frame rate of video
+
+            Returns
+            -------
+            step : int
+                        The sampling step in frames
+        """
+
+        if self.sampleInterval is None or self.sampleInterval <= 0:
+            return fps
+        return max(1, int(round(self.sampleInterval * fps / 1000.0)))
+
+    def readSampledFrames(self, capture, frameCount, step, startFrame=0, buffers=None):
+        """
+            Read the sampled frames of video, the first valid frame and every step-th frame
+            The frames between them are skipped according to the sampling mode
+
+            Parameters
+            ----------
+            capture : VideoCapture
+                        The opened video
+            frameCount : int
+                        The last frame to be read
+            step : int
+                        The sampling step in frames
+            startFrame : int, optional
+                        Seek to startFrame and read the frames after it,
+                        only every step-th frame is read when it is not 0
+                        Default value is 0
+            buffers : FrameBuffers, optional
+                        The reused arrays which the frames are read into,
+                        a returned frame is valid until the next but one frame is read
+                        Default value is None, every frame is a new array
+
+            Returns
+            -------
+            index : int
+                        The index of the frame, start with 1
+            frame : ndarray
+                        The decoded frame, downsampled to the analysis resolution
+        """
+
+        # 是否已经读取到第一帧
+        started = startFrame > 0
+        # 下一个将被读取的帧(从0开始)
+        position = 0
+        # 跳转到开始帧
+        # 解码的开始时间，跳过的帧也计入解码耗时
+        decodeStarted = time.perf_counter()
+        if startFrame > 0:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, startFrame)
+            position = startFrame
+        for i in range(startFrame + 1, frameCount + 1):
+            # 跳过未采样的帧
+            if started and i % step != 0:
+                if self.samplingMode == SAMPLING_READ:
+                    capture.read()
+                    position = i
+                elif self.samplingMode == SAMPLING_GRAB:
+                    capture.grab()
+                    position = i
+                continue
+
+            # 跳转到采样的帧
+            if self.samplingMode == SAMPLING_SEEK and position != i - 1:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, i - 1)
+
+            # 读取一帧数据
+            (ret, frame) = self.readFrame(capture, buffers)
+            position = i
+
+            # 判断是否是有效帧
+            if not ret:
+                continue
+
+            started = True
+            self.timer.add('decode', decodeStarted)
+            yield i, self.downsample(frame, buffers)
+            decodeStarted = time.perf_counter()
+
+    def readFrame(self, capture, buffers=None):
+        """
+            Read the next frame of video into the reused arrays
+
+            Parameters
+            ----------
+            capture : VideoCapture
+                        The opened video
+            buffers : FrameBuffers, optional
+                        The reused arrays, they are switched only when the frame is read,
+                        so the last returned frame is never overwritten
+                        Default value is None, the frame is a new array
+
+            Returns
+            -------
+            ret : bool
+                        False if the frame can not be read
+            frame : ndarray
+                        The decoded frame
+        """
+
+        if buffers is None:
+            (ret, frame) = capture.read()
+            return (ret and frame is not None), frame
+
+        buffers.swap()
+        (ret, frame) = capture.read(buffers.get('frame'))
+        if (not ret) or (frame is None):
+            # 读取失败时切换回来，否则下一帧会写入上一帧的数组
+            buffers.swap()
+            return False, None
+        buffers.put('frame', frame)
+        return True, frame
+
+    def findKeyframes(self, videoFile, frameCount, step):
+        """
+            Find the keyframes of video by demuxing the packets without decoding them
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file
+            frameCount : int
+                        The last frame to be checked
+            step : int
+                        The minimum number of frames between two returned keyframes
+
+            Returns
+            -------
+            keyframes : array_like
+                        The index of keyframes, start with 1, None if the packets can not be read
+        """
+
+        started = time.perf_counter()
+        capture = cv2.VideoCapture(videoFile, cv2.CAP_FFMPEG)
+        try:
+            # 只读取数据包，不解码
+            if (not capture.isOpened()) or (not capture.set(cv2.CAP_PROP_FORMAT, -1)):
+                return None
+            keyframes = []
+            for i in range(1, frameCount + 1):
+                if not capture.grab():
+                    break
+                if capture.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) and (len(keyframes) == 0 or i - keyframes[-1] >= step):
+                    keyframes.append(i)
+            return keyframes if len(keyframes) > 0 else None
+        finally:
+            capture.release()
+            self.timer.add('demux', started)
+
+    def decodeKeyframes(self, videoFile, fps, frameCount, step):
+        """
+            Decode only the keyframes of video by PyAV, the decoder skips the other frames
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file
+            fps : float
+                        The frame rate of video
+            frameCount : int
+                        The last frame to be read
+            step : int
+                        The minimum number of frames between two keyframes
+
+            Returns
+            -------
+            index : int
+                        The index of the frame, start with 1
+            frame : ndarray
+                        The decoded frame, downsampled to the analysis resolution
+        """
+
+        with av.open(videoFile) as container:
+            stream = container.streams.video[0]
+            stream.codec_context.skip_frame = 'NONKEY'
+            lastIndex = None
+            decodeStarted = time.perf_counter()
+            for frame in container.decode(stream):
+                if frame.time is None:
+                    continue
+                i = int(round(frame.time * fps)) + 1
+                if i > frameCount:
+                    break
+                if (lastIndex is not None) and (i - lastIndex < step):
+                    continue
+                lastIndex = i
+                image = frame.to_ndarray(format='bgr24')
+                self.timer.add('decode', decodeStarted)
+                yield i, self.downsample(image)
+                decodeStarted = time.perf_counter()
+
+    def readKeyframes(self, videoFile, capture, frameCount, step, buffers=None):
+        """
+            Read the keyframes of video, at most one every step frames
+            The keyframes are decoded by PyAV if it is installed, otherwise they are found by demuxing
+            and read by seeking, which decodes a few frames before every keyframe.
+            The sampled frames are read instead if the keyframes can not be found
+
+            Parameters
+            ----------
+            videoFile : String
+                        The video file
+            capture : VideoCapture
+                        The opened video
+            frameCount : int
+                        The last frame to be read
+            step : int
+                        The sampling step in frames
+            buffers : FrameBuffers, optional
+                        The reused arrays which the frames are read into
+                        Default value is None, every frame is a new array
+
+            Returns
+            -------
+            index : int
+                        The index of the frame, start with 1
+            frame : ndarray
+                        The decoded frame, downsampled to the analysis resolution
+        """
+
+        if av is not None:
+            yield from self.decodeKeyframes(videoFile, capture.get(cv2.CAP_PROP_FPS), frameCount, step)
+            return
+
+        keyframes = self.findKeyframes(videoFile, frameCount, step)
+        if keyframes is None:
+            print('The keyframes of video({0}) can not be found'.format(videoFile))
+            yield from self.readSampledFrames(capture, frameCount, step, buffers=buffers)
+            return
+
+        decodeStarted = time.perf_counter()
+        for i in keyframes:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, i - 1)
+            (ret, frame) = self.readFrame(capture, buffers)
+            if not ret:
+                continue
+            self.timer.add('decode', decodeStarted)
+            yield i, self.downsample(frame, buffers)
+            decodeStarted = time.perf_counter()
+
+    async def motionDetect4Images(self, imageFiles):
+        """
+            Motion detection based on images
+            The detection runs in the executor, the messages are sent in the event loop
+
+            Parameters
+            ----------
+            imageFiles : imageFiles
+                        The image files to be detected
+                    
+            Returns
+            -------
+            source : string, optional
+                        The source name
+            degree : int, optional
+                        The value of similarity
+            index : string, optional
+                        The time or index of the motion
+            heatmapImg : string, optional
+                        heat map image
+			progress : int
+						Motion detection progress
+        """
+
+        # 只有p-hash时，并行计算所有图片的hash后再比较相邻的hash
+        if (imageFiles is not None) and (self.getWorkers(len(imageFiles)) > 1) and \
+                self.createDetectorChain().isPHash():
+            await self.motionDetect4ImagesParallel(imageFiles, self.getWorkers(len(imageFiles)))
+            return
+
+        await self.runInExecutor(self.detectImages, imageFiles)
+
+    async def motionDetect4ImagesParallel(self, imageFiles, workers):
+        """
+            Motion detection based on images in two phases
+            The p-hash of the images are calculated across a process pool, or reused from the cache,
+            then the adjacent hashes are compared in one vectorized pass and the events are sent in order.
+            Only the images with motion are read again for the heatmap
+
+            Parameters
+            ----------
+            imageFiles : imageFiles
+                        The image files to be detected
+            workers : int
+                        The number of worker processes
+
+            Returns
+            -------
+            source : string, optional
+                        The source name
+            degree : int, optional
+                        The value of similarity
+            index : string, optional
+                        The time or index of the motion
+            heatmapImg : string, optional
+                        heat map image
+			progress : int
+						Motion detection progress
+        """
+
+        # 图片的总数
+        imageCount = len(imageFiles)
+        loop = asyncio.get_event_loop()
+        # 检测耗时
+        detectorChain = self.createDetectorChain()
+        detector = detectorChain.detectors[0]
+
+        # 第一阶段：计算缓存中没有的hash
+        grayOnly = self.heatmap not in self.heatmapTags
+        flags = await loop.run_in_executor(self.executor, self.getImageFlags, imageFiles, grayOnly)
+        keys = [self.getImageHashKey(imageFile, flags) for imageFile in imageFiles]
+        results = [getImageHash(key) for key in keys]
+        missing = [i for i in range(imageCount) if results[i] is None]
+        if len(missing) > 0:
+            chunkSize = int(math.ceil(len(missing) / float(workers * 4)))
+            chunks = [missing[i:i + chunkSize] for i in range(0, len(missing), chunkSize)]
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context) as executor:
+                futures = [loop.run_in_executor(executor, hashImagesInProcess, self.options,
+                                                [imageFiles[i] for i in chunk], flags) for chunk in chunks]
+                for (chunk, future) in zip(chunks, futures):
+                    try:
+                        result = await future
+                    except Exception as ex:
+                        self.failed = True
+                        print('The images failed: {0}'.format(ex))
+                        continue
+                    detector.seconds += result['seconds']
+                    self.timer.merge(result.get('stages'))
+                    for (i, item) in zip(chunk, result['images']):
+                        results[i] = item
+                        if (item is not None) and (keys[i] is not None):
+                            putImageHash(keys[i], item)
+
+        # 第二阶段：比较相邻的hash，形状与第一张图片不同的图片被跳过
+        frames = []
+        shape = None
+        for i in range(imageCount):
+            if results[i] is None:
+                continue
+            if shape is None:
+                shape = results[i][1]
+            elif results[i][1] != shape:
+                print('The image file({0}) not the same shape'.format(imageFiles[i]))
+                continue
+            frames.append(i)
+        started = time.perf_counter()
+        hashes = np.array([results[i][0] for i in frames], np.uint64)
+        degrees = motionutils.calculateAdjacentDistances(hashes)
+        moved = np.flatnonzero(degrees >= detector.threshold)
+        detector.seconds += time.perf_counter() - started
+        detector.samples += len(degrees)
+        detector.passed += len(moved)
+        self.recordDetectors(detectorChain)
+
+        # 发送消息
+        motionFiles = []
+        for k in moved:
+            i = frames[k + 1]
+            motionFiles.append(imageFiles[i])
+            if self.msger is not None:
+                try:
+                    self.msger.send({'source': imageFiles[i], 'index': imageFiles[i], 'degree': int(degrees[k]),
+                                     'heatmapImg': None, 'progress': int(i / imageCount * 100),
+                                     'status': 'process'})
+                except Exception as ex:
+                    # 发生异常时
+                    print('Exception:', ex.__doc__)
+            await self.drain()
+
+        # 只累加第一张图片和有motion的图片
+        heatmapImg = None
+        if (self.heatmap in self.heatmapTags) and (len(frames) > 0):
+            heatmapImg = await loop.run_in_executor(self.executor, self.buildImagesHeatmap,
+                                                    [imageFiles[frames[0]]] + motionFiles, imageCount)
+
+        # 结束消息
+        if self.msger is not None:
+            try:
+                self.msger.send(
+                    {'source': None, 'index': None, 'degree': None, 'heatmapImg': heatmapImg, 'progress': 100,
+                     'status': 'finish', 'detectors': detectorChain.report(), 'stages': self.timer.report()})
+            except Exception as ex:
+                # 发生异常时
+                print('Exception:', ex.__doc__)
+
+    def getImageHashKey(self, imageFile, flags):
+        """
+            Get the key of the cached p-hash of image
+
+            Parameters
+            ----------
+            imageFile : string
+                        The image file
+            flags : int
+                        The flags of cv2.imread
+
+            Returns
+            -------
+            key : tuple
+                        None if the image does not exist
+        """
+
+        try:
+            stat = os.stat(imageFile)
+        except (OSError, TypeError, ValueError):
+            return None
+        return (os.path.abspath(imageFile), stat.st_mtime_ns, stat.st_size, flags, self.hashBackend,
+                self.analysisWidth, json.dumps(self.regions))
+
+    def hashImages(self, imageFiles, flags):
+        """
+            Calculate the p-hash of images, which are cropped and downsampled as detectImages does
+
+            Parameters
+            ----------
+            imageFiles : array_like
+                        The image files
+            flags : int
+                        The flags of cv2.imread
+
+            Returns
+            -------
+            result : dict
+                        images : (hash, shape) of every image, None if the image can not be read
+                        seconds : The time spent on the hash
+                        stages : The cumulative time and count of every stage
+        """
+
+        images = []
+        seconds = 0.0
+        for (imageFile, image) in self.readImages(imageFiles, flags):
+            if image is None:
+                images.append(None)
+                continue
+            image = self.prepareImage(image)
+            started = time.perf_counter()
+            images.append((motionutils.calculatePHash(image, self.hashBackend), image.shape))
+            seconds += time.perf_counter() - started
+        return {'images': images, 'seconds': seconds, 'stages': self.timer.report()}
+
+    def prepareImage(self, image):
+        """
+            Downsample the image to the analysis resolution and crop the detection area
+
+            Parameters
+            ----------
+            image : ndarray
+                        The decoded image
+
+            Returns
+            -------
+            image : ndarray
+                        The analysed image
+        """
+
+        height, width = image.shape[0:2]
+        # 缩小到分析的分辨率
+        image = self.downsample(image)
+        # 没有指定检测区域，则默认检测整个图像区域，否则则获取指定区域的图像
+        if self.regions is not None:
+            started = time.perf_counter()
+            image = self.getROI(width, height).apply(image)
+            self.timer.add('roi', started)
+        return image
+
+    def buildImagesHeatmap(self, imageFiles, imageCount):
+        """
+            Accumulate the images into the heatmap, which blocks until the heatmap is built
+
+            Parameters
+            ----------
+            imageFiles : array_like
+                        The first image and the images with motion
+            imageCount : int
+                        The total number of the detected images
+
+            Returns
+            -------
+            heatmapImg : string
+                        The file path or base64 string of heatmap image, None if no image can be read
+        """
+
+        accumulator = self.createHeatmapAccumulator(cv2.createBackgroundSubtractorKNN(detectShadows=False))
+        accumulator.maxValue = 255 / imageCount
+        size = None
+        for (imageFile, image) in self.readImages(imageFiles, cv2.IMREAD_COLOR):
+            if image is None:
+                continue
+            size = image.shape[0:2]
+            self.accumulate(accumulator, self.prepareImage(image))
+        if accumulator.data is None:
+            return None
+        return self.buildHeatmap(accumulator, size[1], size[0], cv2.COLORMAP_JET, 200)
+
+    def detectImages(self, imageFiles):
+        """
+            Motion detection based on images, which blocks until the detection is finished
+
+            Parameters
+            ----------
+            imageFiles : imageFiles
+                        The image files to be detected
+
+            Returns
+            -------
+        """
+
+        # 参数检查
+        if imageFiles is None or len(imageFiles) < 1:
+            print('Empty image files')
+            return
+
+        # heatmap数据
+        accumulator = None
+
+        # 生成heatmap
+        if self.heatmap in self.heatmapTags:
+            # 获取背景剪裁器
+            # backgroundSubtractor = cv2.bgsegm.createBackgroundSubtractorMOG()
+            accumulator = self.createHeatmapAccumulator(cv2.createBackgroundSubtractorKNN(detectShadows=False))
+
+        # 检测策略
+        detectorChain = self.createDetectorChain()
+
+        # 上一张图片
+        lastImage = None
+        # 当前图片
+        currentImage = None
+        # 生成的heatmap
+        heatmapImg = None
+
+        # 原始图片的大小
+        originalHeight = None
+        originalWidth = None
+
+        # 发生motion的图片
+        motionFiles = []
+
+        # 图片的总数
+        imageCount = len(imageFiles)
+
+        self.maxValue = 255 / imageCount
+        if accumulator is not None:
+            accumulator.maxValue = self.maxValue
+
+        # 遍历进行处理，图片由读取线程预先读取
+        flags = self.getImageFlags(imageFiles, accumulator is None)
+        for (i, (imageFile, currentImage)) in enumerate(self.readImages(imageFiles, flags)):
+            # 计算进度
+            progress = int(i / imageCount * 100)
+            # 图片不存在或者不能读取
+            if currentImage is None:
+                continue
+
+            # 获取图片的高度、宽度
+            originalHeight, originalWidth = currentImage.shape[0:2]
+            # 缩小并裁剪图片
+            currentImage = self.prepareImage(currentImage)
+
+            # 检查图片的形状是否一样
+            if (lastImage is not None) and (lastImage.shape != currentImage.shape):
+                print('The image file({0}) not the same shape'.format(imageFile))
+                continue
+
+            # 初始化第一张图像
+            if lastImage is None:
+                lastImage = currentImage
+                detectorChain.start(currentImage)
+                if accumulator is not None:
+                    # 为计算热力图做数据准备
+                    self.accumulate(accumulator, currentImage)
+                continue
+
+            # 计算上一帧与当前帧的相似度
+            (moved, degree) = detectorChain.detect(lastImage, currentImage)
+
+            # 大于指定阈值
+            if moved:
+                # 生成heatmap
+                if accumulator is not None:
+                    # 为计算热力图做数据准备
+                    self.accumulate(accumulator, currentImage)
+
+                motionFiles.append(imageFile)
+                # print('Changed: ', milliseconds, ' degree: ', degree)
+                # 发送消息
+                if self.msger is not None:
+                    try:
+                        self.msger.send({'source': imageFile, 'index': imageFile, 'degree': degree, 'heatmapImg': None,
+                                         'progress': progress, 'status': 'process'})
+                    except Exception as ex:
+                        # 发生异常时
+                        print('Exception:', ex.__doc__)
+
+            # 设置上一幅图片，每张图片都是新读取的，不需要复制
+            lastImage = currentImage
+
+        # 生成heatmap
+        if (accumulator is not None) and (accumulator.data is not None):
+            heatmapImg = self.buildHeatmap(accumulator, originalWidth, originalHeight, cv2.COLORMAP_JET, 200)
+        self.recordDetectors(detectorChain)
+
+        # 结束消息
+        if self.msger is not None:
+            try:
+                self.msger.send(
+                    {'source': None, 'index': None, 'degree': None, 'heatmapImg': heatmapImg, 'progress': 100,
+                     'status': 'finish', 'detectors': detectorChain.report(), 'stages': self.timer.report()})
+            except Exception as ex:
+                # 发生异常时
+                print('Exception:', ex.__doc__)
+
+    def getImageFlags(self, imageFiles, grayOnly):
+        """
+            Get the flags of cv2.imread, the images are decoded at a reduced size in gray if possible
+
+            Parameters
+            ----------
+            imageFiles : array_like
+                        The image files, the first readable one decides the reduced size
+            grayOnly : bool
+                        Whether only the gray image is analysed
+
+            Returns
+            -------
+            flags : int
+                        The flags of cv2.imread
+        """
+
+        # 检测区域的坐标基于原始大小
+        if (not self.reducedDecode) or (not grayOnly) or (self.regions is not None):
+            return cv2.IMREAD_COLOR
+        for imageFile in imageFiles:
+            if (imageFile is None) or (not os.path.exists(imageFile)):
+                continue
+            image = cv2.imread(imageFile, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+            if image is None:
+                continue
+            width = image.shape[1] * 2
+            # 缩小后不小于分析的宽度
+            minWidth = max(REDUCED_MIN_WIDTH, self.analysisWidth or 0)
+            for (scale, flags) in REDUCED_GRAYSCALE_FLAGS:
+                if width / scale >= minWidth:
+                    return flags
+            break
+        return cv2.IMREAD_COLOR
+
+    def readImage(self, imageFile, flags):
+        """
+            Read the image, be called by the reader threads
+
+            Parameters
+            ----------
+            imageFile : string
+                        The image file
+            flags : int
+                        The flags of cv2.imread
+
+            Returns
+            -------
+            image : ndarray
+                        The decoded image, None if it can not be read
+        """
+
+        # 检查图片是否真实存在
+        if (imageFile is None) or (not os.path.exists(imageFile)):
+            print('The image file({0}) does not exist'.format(imageFile))
+            return None
+        image = cv2.imread(imageFile, flags)
+        if image is None:
+            print('The image file({0}) can not be read'.format(imageFile))
+        return image
+
+    def readImages(self, imageFiles, flags):
+        """
+            Read and decode the images ahead of the comparison by a pool of reader threads
+            At most prefetch images are waiting, the images are returned in order
+
+            Parameters
+            ----------
+            imageFiles : array_like
+                        The image files
+            flags : int
+                        The flags of cv2.imread
+
+            Returns
+            -------
+            imageFile : string
+                        The image file
+            image : ndarray
+                        The decoded image, None if it can not be read
+        """
+
+        prefetch = max(int(self.prefetch), 1)
+        # 正在读取的图片
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=min(prefetch, os.cpu_count() or 1),
+                                thread_name_prefix='ImageReader') as executor:
+            try:
+                for imageFile in imageFiles:
+                    pending.append((imageFile, executor.submit(self.readImage, imageFile, flags)))
+                    if len(pending) >= prefetch:
+                        (imageFile, future) = pending.popleft()
+                        yield imageFile, self.waitImage(future)
+                while len(pending) > 0:
+                    (imageFile, future) = pending.popleft()
+                    yield imageFile, self.waitImage(future)
+            finally:
+                # 检测中止时取消未开始的读取
+                for (imageFile, future) in pending:
+                    future.cancel()
+
+    def waitImage(self, future):
+        """
+            Wait for the image being read, the time not hidden by the prefetch is the 'read' stage
+
+            Parameters
+            ----------
+            future : Future
+                        The reading of image
+
+            Returns
+            -------
+            image : ndarray
+                        The decoded image, None if it can not be read
+        """
+
+        started = time.perf_counter()
+        image = future.result()
+        self.timer.add('read', started)
+        return image
+
+    async def runInExecutor(self, func, *args):
+        """
+            Run the blocking detection in the executor without blocking the event loop
+            The messages sent by the detection are marshalled back to the event loop
+
+            Parameters
+            ----------
+            func : callable
+                        The blocking detection function
+            args : params
+                        The parameters of func
+
+            Returns
+            -------
+            m : object
+                        The return value of func
+        """
+
+        loop = asyncio.get_event_loop()
+        msger = self.msger
+        if msger is not None:
+            self.msger = LoopSender(msger=msger, loop=loop)
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.msger = msger
+
+    def createHeatmapAccumulator(self, backgroundSubtractor=None):
+        """
+            Create the accumulator of heatmap data
+
+            Parameters
+            ----------
+            backgroundSubtractor : BackgroundSubtractor, optional
+                        The background subtractor
+                        Default value is None, the accumulator only merges the data of segments
+
+            Returns
+            -------
+            accumulator : HeatmapAccumulator
+                        The accumulator of heatmap data
+        """
+
+        return heatmap.HeatmapAccumulator(backgroundSubtractor, self.threshold, self.maxValue, self.heatmapDecay)
+
+    def buildHeatmap(self, accumulator, width, height, colorMap, alpha):
+        """
+            Build the heatmap image from the accumulated data
+
+            Parameters
+            ----------
+            accumulator : HeatmapAccumulator
+                        The accumulated heatmap data
+            width : int
+                        The width of the original image
+            height : int
+                        The height of the original image
+            colorMap : int
+                        The color map of heatmap, cv2.COLORMAP_*
+            alpha : int
+                        The value subtracted from the alpha channel of the colored pixels
+
+            Returns
+            -------
+            heatmapImg : string
+                        The file path or base64 string of heatmap image
+        """
+
+        # 计算热点图，转换成带透明通道的PNG图像
+        started = time.perf_counter()
+        pngImage = accumulator.render(colorMap, alpha)
+
+        # 检测区域或者缩小分析时，放大到原始图像的大小
+        if pngImage.shape[0:2] != (height, width):
+            pngImage = cv2.resize(pngImage, (width, height))
+
+        # 在内存中编码成PNG图像
+        data = heatmap.encodeHeatmap(pngImage, self.heatmapCompression)
+        self.timer.add('heatmap.render', started)
+
+        # 以Base64格式返回生成的heatmap
+        if self.heatmap == 2:
+            return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+        # 返回文件路径，文件在后台写入
+        store = self.getHeatmapStore()
+        if store is None:
+            print('Invalid heat map directory')
+            return None
+        return store.put(data)
+
+    def getHeatmapStore(self):
+        """
+            Get the store of heatmap files, the default directory is used if the heatmap directory is invalid
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+            store : HeatmapStore
+                        None if there is no valid directory
+        """
+
+        for heatmapDir in (self.heatmapDir, self.defaultHeatmapDir):
+            try:
+                if not os.path.exists(heatmapDir):
+                    os.makedirs(heatmapDir)
+                return heatmap.getHeatmapStore(heatmapDir)
+            except OSError:
+                continue
+        return None
+
+
+def detectVideoInProcess(options, videoFile, messages):
+    """
+        Motion detection of one video in a worker process
+
+        Parameters
+        ----------
+        options : dict
+                    The initialization parameters of Motion, without msger
+        videoFile : String
+                    The video file to be detected
+        messages : Queue
+                    The queue used to send the messages to the parent process
+
+        Returns
+        -------
+    """
+
+    Motion(msger=QueueSender(msger=messages), **options).detectVideo(videoFile)
+    # 等待heatmap文件写入完成
+    heatmap.flushHeatmapStores()
+
+
+def detectSegmentInProcess(options, videoFile, startFrame, endFrame):
+    """
+        Motion detection of a time segment of video in a worker process
+
+        Parameters
+        ----------
+        options : dict
+                    The initialization parameters of Motion, without msger
+        videoFile : String
+                    The video file to be detected
+        startFrame : int
+                    The frames after startFrame are read
+        endFrame : int
+                    The last frame to be read
+
+        Returns
+        -------
+        result : dict
+                    The result of Motion.detectSegment
+    """
+
+    return Motion(**options).detectSegment(videoFile, startFrame, endFrame)
+
+
+def hashImagesInProcess(options, imageFiles, flags):
+    """
+        Calculate the p-hash of images in a worker process
+
+        Parameters
+        ----------
+        options : dict
+                    The initialization parameters of Motion, without msger
+        imageFiles : array_like
+                    The image files
+        flags : int
+                    The flags of cv2.imread
+
+        Returns
+        -------
+        result : dict
+                    The result of Motion.hashImages
+    """
+
+    return Motion(**options).hashImages(imageFiles, flags)
+
+
+def getImageHash(key):
+    """
+        Get the cached p-hash of image
+
+        Parameters
+        ----------
+        key : tuple
+                    The key given by Motion.getImageHashKey
+
+        Returns
+        -------
+        item : tuple
+                    (hash, shape), None if it is not cached
+    """
+
+    if key is None:
+        return None
+    with IMAGE_HASHES_LOCK:
+        item = IMAGE_HASHES.get(key)
+        if item is not None:
+            IMAGE_HASHES.move_to_end(key)
+        return item
+
+
+def putImageHash(key, item):
+    """
+        Cache the p-hash of image, the least recently used ones are removed over IMAGE_HASHES_MAX
+
+        Parameters
+        ----------
+        key : tuple
+                    The key given by Motion.getImageHashKey
+        item : tuple
+                    (hash, shape)
+
+        Returns
+        -------
+    """
+
+    with IMAGE_HASHES_LOCK:
+        IMAGE_HASHES[key] = item
+        IMAGE_HASHES.move_to_end(key)
+        while len(IMAGE_HASHES) > IMAGE_HASHES_MAX:
+            IMAGE_HASHES.popitem(last=False)
@@ -0,0 +1,304 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Motion Signature Index
+
+"""
+
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+from services.detection.motion import motionutils
+
+# 索引文件的版本，格式变化时旧的索引失效
+INDEX_VERSION = 1
+# 每个采样帧的网格大小
+GRID_SIZE = 16
+
+
+class MotionIndex(object):
+    """
+        Sidecar index of recordings, built on the first scan and keyed by path, size and mtime
+        It stores the time and p-hash of every sampled frame and the gray means of a coarse grid,
+        so the later queries with another degree or regions are answered without decoding the video
+    """
+
+    def __init__(self, indexDir):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            indexDir : string
+                        The directory of index files
+
+            Returns
+            -------
+        """
+        self.indexDir = indexDir
+
+    def getIndexFile(self, videoFile):
+        """
+            Get the index file name of video
+
+            Parameters
+            ----------
+            videoFile : string
+                        The video file
+
+            Returns
+            -------
+            fileName : string
+                        The index file name
+        """
+
+        name = hashlib.sha1(os.path.abspath(videoFile).encode('utf-8')).hexdigest()
+        return os.path.join(self.indexDir, name + '.npz')
+
+    def buildKey(self, videoFile, step, hashBackend, analysisWidth=None):
+        """
+            Build the key which the index is valid for
+
+            Parameters
+            ----------
+            videoFile : string
+                        The video file
+            step : int
+                        The sampling step in frames
+            hashBackend : string
+                        The p-hash backend
+            analysisWidth : int, optional
+                        The width which the frames are downsampled to
+                        Default value is None, the original resolution
+
+            Returns
+            -------
+            key : string
+                        The key of index
+        """
+
+        stat = os.stat(videoFile)
+        return '{0}|{1}|{2}|{3}|{4}|{5}|{6}'.format(INDEX_VERSION, os.path.abspath(videoFile), stat.st_size,
+                                                    stat.st_mtime, step, hashBackend, analysisWidth)
+
+    def load(self, videoFile, step, hashBackend, analysisWidth=None):
+        """
+            Load the index of video
+
+            Parameters
+            ----------
+            videoFile : string
+                        The video file
+            step : int
+                        The sampling step in frames
+            hashBackend : string
+                        The p-hash backend
+            analysisWidth : int, optional
+                        The width which the frames are downsampled to
+                        Default value is None, the original resolution
+
+            Returns
+            -------
+            index : dict
+                        None if there is no valid index
+                        key : The key of index
+                        frameCount : The total number of frames
+                        times : The time of every sampled frame in milliseconds
+                        frames : The index of every sampled frame
+                        hashes : The uint64 p-hash of every sampled frame
+                        cells : The gray means of GRID_SIZE * GRID_SIZE cells of every sampled frame
+                        width, height : The size of video
+        """
+
+        fileName = self.getIndexFile(videoFile)
+        if not os.path.exists(fileName):
+            return None
+        try:
+            with np.load(fileName) as data:
+                index = {name: data[name] for name in data.files}
+            index['key'] = str(index['key'])
+            if index['key'] != self.buildKey(videoFile, step, hashBackend, analysisWidth):
+                return None
+            for name in ('frameCount', 'width', 'height'):
+                index[name] = int(index[name])
+            return index
+        except Exception as ex:
+            print('Invalid index file({0}): {1}'.format(fileName, ex))
+            return None
+
+    def save(self, videoFile, step, hashBackend, builder, analysisWidth=None):
+        """
+            Save the index of video
+
+            Parameters
+            ----------
+            videoFile : string
+                        The video file
+            step : int
+                        The sampling step in frames
+            hashBackend : string
+                        The p-hash backend
+            builder : IndexBuilder
+                        The data of index
+            analysisWidth : int, optional
+                        The width which the frames are downsampled to
+                        Default value is None, the original resolution
+
+            Returns
+            -------
+        """
+
+        try:
+            if not os.path.exists(self.indexDir):
+                os.makedirs(self.indexDir)
+            fileName = self.getIndexFile(videoFile)
+            # 先写入临时文件再替换，避免留下不完整的索引
+            tempFile = fileName + '.tmp.npz'
+            np.savez_compressed(tempFile, key=self.buildKey(videoFile, step, hashBackend, analysisWidth),
+                                frameCount=builder.frameCount, width=builder.width, height=builder.height,
+                                times=np.array(builder.times, np.float64), frames=np.array(builder.frames, np.int64),
+                                hashes=np.array(builder.hashes, np.uint64),
+                                cells=np.array(builder.cells, np.uint8).reshape((-1, GRID_SIZE, GRID_SIZE)))
+            os.replace(tempFile, fileName)
+        except Exception as ex:
+            print('Failed to save the index of video({0}): {1}'.format(videoFile, ex))
+
+    def query(self, index, degree, regions=None, hashBackend=motionutils.HASH_BACKEND_NUMPY):
+        """
+            Find the motion in the index
+
+            Parameters
+            ----------
+            index : dict
+                        The index of video
+            degree : int
+                        Threshold of image similarity
+            regions : array_like, optional
+                        Vertex coordinates of the detection area, approximated by the grid cells
+                        Default value is None
+            hashBackend : string, optional
+                        The p-hash backend of the region hashes, the same as the index
+                        Default value is 'numpy'
+
+            Returns
+            -------
+            events : array_like
+                        [(time, degree, frame)] of the sampled frames with motion
+        """
+
+        hashes = index['hashes']
+        if regions is not None:
+            hashes = self.calculateRegionHashes(index, regions, hashBackend)
+        if len(hashes) < 2:
+            return []
+        distances = motionutils.calculateAdjacentDistances(hashes)
+        positions = np.nonzero(distances >= degree)[0]
+        return [(float(index['times'][k + 1]), int(distances[k]), int(index['frames'][k + 1])) for k in positions]
+
+    def calculateRegionHashes(self, index, regions, hashBackend=motionutils.HASH_BACKEND_NUMPY):
+        """
+            Calculate the p-hash of the regions from the grid cells of every sampled frame
+
+            Parameters
+            ----------
+            index : dict
+                        The index of video
+            regions : array_like
+                        Vertex coordinates of the detection area, one polygon or a list of polygons
+            hashBackend : string, optional
+                        The p-hash backend
+                        Default value is 'numpy'
+
+            Returns
+            -------
+            hashes : ndarray
+                        The uint64 p-hash of the regions of every sampled frame
+        """
+
+        # 计算检测区域覆盖的网格，网格中心在多边形内即认为被覆盖
+        polygons = regions if motionutils.isPolygonList(regions) else [regions]
+        scale = np.array([GRID_SIZE / float(index['width']), GRID_SIZE / float(index['height'])], np.float32)
+        covered = np.zeros((GRID_SIZE, GRID_SIZE), bool)
+        for polygon in polygons:
+            contour = (np.array(polygon, np.float32).reshape((-1, 2)) * scale).reshape((-1, 1, 2))
+            for row in range(GRID_SIZE):
+                for col in range(GRID_SIZE):
+                    if cv2.pointPolygonTest(contour, (col + 0.5, row + 0.5), False) >= 0:
+                        covered[row, col] = True
+        if not covered.any():
+            return np.zeros((len(index['hashes']),), np.uint64)
+
+        # 裁剪到覆盖的网格，并将区域外的网格置0
+        rows = np.nonzero(covered.any(axis=1))[0]
+        cols = np.nonzero(covered.any(axis=0))[0]
+        cells = np.where(covered, index['cells'], 0)[:, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        # 通过插值矩阵一次性将所有帧缩放到32*32
+        height, width = cells.shape[1:3]
+        size = motionutils.HASH_IMAGE_SIZE
+        rowMatrix = cv2.resize(np.eye(height, dtype=np.float32), (height, size))
+        colMatrix = cv2.resize(np.eye(width, dtype=np.float32), (width, size)).T
+        images = np.matmul(np.matmul(rowMatrix, cells.astype(np.float32)), colMatrix)
+        if hashBackend == motionutils.HASH_BACKEND_OPENCV:
+            # opencv的PHash只接受8位图像
+            images = list(np.clip(np.rint(images), 0, 255).astype(np.uint8))
+        return motionutils.calculatePHashes(images, hashBackend)
+
+
+class IndexBuilder(object):
+    """
+        Collect the index data of the sampled frames during a scan
+    """
+
+    def __init__(self, frameCount, width, height, hashBackend):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            frameCount : int
+                        The total number of frames
+            width : int
+                        The width of video
+            height : int
+                        The height of video
+            hashBackend : string
+                        The p-hash backend
+
+            Returns
+            -------
+        """
+        self.frameCount = frameCount
+        self.width = width
+        self.height = height
+        self.hashBackend = hashBackend
+        self.times = []
+        self.frames = []
+        self.hashes = []
+        self.cells = []
+
+    def add(self, milliseconds, frameIndex, frame):
+        """
+            Add a sampled frame
+
+            Parameters
+            ----------
+            milliseconds : float
+                        The time of frame
+            frameIndex : int
+                        The index of frame
+            frame : ndarray
+                        The whole frame
+
+            Returns
+            -------
+        """
+
+        self.times.append(milliseconds)
+        self.frames.append(frameIndex)
+        self.hashes.append(motionutils.calculatePHash(frame, self.hashBackend))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        self.cells.append(cv2.resize(gray, (GRID_SIZE, GRID_SIZE), interpolation=cv2.INTER_AREA))
@@ -6,11 +6,53 @@
 
 """
 
+import threading
+
 import cv2
 import numpy as np
 
 
-def calculateDegreeBasePHash(image1, image2):
+# pHash计算时图像缩放的尺寸
+HASH_IMAGE_SIZE = 32
+# pHash取DCT左上角低频区域的尺寸
+HASH_DCT_SIZE = 8
+# pHash的计算后端
+HASH_BACKEND_NUMPY = 'numpy'
+HASH_BACKEND_OPENCV = 'opencv'
+
+
+def _buildDCTMatrix(size):
+    """
+        Build the orthonormal DCT-II matrix, same as the one used by cv2.dct
+
+        Parameters
+        ----------
+        size : int
+                    The size of the matrix
+
+        Returns
+        -------
+        m : ndarray
+                    The DCT matrix with shape (size, size)
+    """
+
+    k = np.arange(size).reshape((-1, 1))
+    n = np.arange(size).reshape((1, -1))
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2.0 * size)) * np.sqrt(2.0 / size)
+    matrix[0, :] = np.sqrt(1.0 / size)
+    return matrix.astype(np.float32)
+
+
+# 只保留DCT矩阵的前8行，这样矩阵相乘时直接得到左上角8*8的低频区域
+_DCT_ROWS = _buildDCTMatrix(HASH_IMAGE_SIZE)[0:HASH_DCT_SIZE]
+_DCT_COLS = np.ascontiguousarray(_DCT_ROWS.T)
+# 每个字节中1的个数，用于没有np.bitwise_count的numpy版本
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+# opencv-contrib中的PHash计算器，计算器内部有临时数据，每个线程按需创建一个
+_opencvHashers = threading.local()
+
+
+def calculateDegreeBasePHash(image1, image2, backend=HASH_BACKEND_NUMPY):
     """
         Calculate similarity of two images base on p-hash
 
@@ -20,6 +62,9 @@ def calculateDegreeBasePHash(image1, image2):
                     The numpy data of first image
         image2 : ndarray
                     The numpy data of first image
+        backend : string, optional
+                    The hash backend, 'numpy' or 'opencv'
+                    Default value is 'numpy'
 
         Returns
         -------
@@ -27,26 +72,121 @@ def calculateDegreeBasePHash(image1, image2):
                     Similarity of two images
     """
 
-    image1 = cv2.resize(image1, (32, 32))
-    image2 = cv2.resize(image2, (32, 32))
-    gray1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-    gray2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+    hash1 = calculatePHash(image1, backend)
+    hash2 = calculatePHash(image2, backend)
+    return calculateHammingDistance(hash1, hash2)
+
+
+def getHashImage(image):
+    """
+        Resize the image and convert it to the gray image used by p-hash
+
+        Parameters
+        ----------
+        image : ndarray
+                    The numpy data of image, BGR or gray
+
+        Returns
+        -------
+        m : ndarray
+                    The 32*32 gray image
+    """
+
+    image = cv2.resize(image, (HASH_IMAGE_SIZE, HASH_IMAGE_SIZE))
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def calculatePHash(image, backend=HASH_BACKEND_NUMPY):
+    """
+        Calculate the p-hash of image as a 64-bit packed integer
+
+        Parameters
+        ----------
+        image : ndarray
+                    The numpy data of image, BGR or gray
+        backend : string, optional
+                    The hash backend, 'numpy' or 'opencv'
+                    Default value is 'numpy'
+
+        Returns
+        -------
+        m : int
+                    The 64-bit hash value of image
+    """
+
+    if backend == HASH_BACKEND_OPENCV:
+        return int(calculatePHashesOpenCV([image])[0])
     # 将灰度图转为浮点型，再进行dct变换
-    dct1 = cv2.dct(np.float32(gray1))
-    dct2 = cv2.dct(np.float32(gray2))
+    dct = cv2.dct(np.float32(getHashImage(image)))
     # 取左上角的8*8，这些代表图片的最低频率
-    # 这个操作等价于c++中利用opencv实现的掩码操作
-    # 在python中进行掩码操作，可以直接这样取出图像矩阵的某一部分
-    dct1_roi = dct1[0:8, 0:8]
-    dct2_roi = dct2[0:8, 0:8]
-    hash1 = getHash(dct1_roi)
-    hash2 = getHash(dct2_roi)
-    return calculateHammingDistance(hash1, hash2)
+    return packHash(getHash(dct[0:HASH_DCT_SIZE, 0:HASH_DCT_SIZE]))
+
+
+def calculatePHashes(images, backend=HASH_BACKEND_NUMPY):
+    """
+        Calculate the p-hash of a stack of images in one vectorized call
+
+        Parameters
+        ----------
+        images : array_like
+                    The images, a list of BGR/gray images of any size,
+                    or an ndarray with shape (N, 32, 32) of gray images
+        backend : string, optional
+                    The hash backend, 'numpy' or 'opencv'
+                    Default value is 'numpy'
+
+        Returns
+        -------
+        m : ndarray
+                    The uint64 hash values with shape (N,)
+    """
+
+    if backend == HASH_BACKEND_OPENCV:
+        return calculatePHashesOpenCV(images)
+    if len(images) == 0:
+        return np.zeros((0,), np.uint64)
+    # 已经是缩放好的灰度图时直接使用
+    if isinstance(images, np.ndarray) and images.shape[1:] == (HASH_IMAGE_SIZE, HASH_IMAGE_SIZE):
+        stack = images.astype(np.float32)
+    else:
+        stack = np.stack([getHashImage(image) for image in images]).astype(np.float32)
+    # 通过矩阵相乘一次性计算所有图像左上角8*8的DCT系数
+    dct = np.matmul(np.matmul(_DCT_ROWS, stack), _DCT_COLS)
+    dct = dct.reshape((dct.shape[0], -1))
+    bits = dct > np.mean(dct, axis=1, keepdims=True)
+    return packHashes(bits)
+
+
+def calculatePHashesOpenCV(images):
+    """
+        Calculate the p-hash of images by cv2.img_hash.PHash of opencv-contrib
+
+        Parameters
+        ----------
+        images : array_like
+                    The BGR or gray images
+
+        Returns
+        -------
+        m : ndarray
+                    The uint64 hash values with shape (N,)
+    """
+
+    hasher = getattr(_opencvHashers, 'hasher', None)
+    if hasher is None:
+        hasher = _opencvHashers.hasher = cv2.img_hash.PHash_create()
+    hashes = np.zeros((len(images),), np.uint64)
+    for i in range(len(images)):
+        # compute返回1*8的uint8数组，按大端序合并为64位整数
+        hashes[i] = hasher.compute(images[i]).reshape(-1).view('>u8')[0]
+    return hashes
 
 
 def getHash(image):
     """
-        Calculate the hash value of image
+        Calculate the hash bits of image
 
         Parameters
         ----------
@@ -55,19 +195,70 @@ def getHash(image):
                     
         Returns
         -------
-        m : array_like
-                    The hash value of image
+        m : ndarray
+                    The hash bits of image, 1 if the pixel is greater than the average
     """
 
-    avreage = np.mean(image)
-    hash = []
-    for i in range(image.shape[0]):
-        for j in range(image.shape[1]):
-            if image[i, j] > avreage:
-                hash.append(1)
-            else:
-                hash.append(0)
-    return hash
+    return (image > np.mean(image)).reshape(-1).astype(np.uint8)
+
+
+def packHash(bits):
+    """
+        Pack 64 hash bits into an integer, the first bit is the most significant one
+
+        Parameters
+        ----------
+        bits : array_like
+                    The 64 hash bits
+
+        Returns
+        -------
+        m : int
+                    The packed hash value
+    """
+
+    return int(packHashes(np.asarray(bits).reshape((1, -1)))[0])
+
+
+def packHashes(bits):
+    """
+        Pack the hash bits of N images into uint64 values
+
+        Parameters
+        ----------
+        bits : ndarray
+                    The hash bits with shape (N, 64)
+
+        Returns
+        -------
+        m : ndarray
+                    The uint64 hash values with shape (N,)
+    """
+
+    packed = np.packbits(np.asarray(bits, np.uint8), axis=1)
+    return np.ascontiguousarray(packed).view('>u8').reshape(-1).astype(np.uint64)
+
+
+def popcount(values):
+    """
+        Count the number of 1 bits of uint64 values
+
+        Parameters
+        ----------
+        values : ndarray
+                    The uint64 values
+
+        Returns
+        -------
+        m : ndarray
+                    The number of 1 bits of each value
+    """
+
+    values = np.ascontiguousarray(values, np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    counts = _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,))
+    return counts.sum(axis=-1, dtype=np.int64)
 
 
 def calculateHammingDistance(hash1, hash2):
@@ -76,22 +267,39 @@ def calculateHammingDistance(hash1, hash2):
 
         Parameters
         ----------
-        hash1 : array_like
-                    The first hash value
-        hash2 : array_like
-                    The second hash value
+        hash1 : int or ndarray
+                    The first hash value, or uint64 hash values
+        hash2 : int or ndarray
+                    The second hash value, or uint64 hash values
                     
         Returns
         -------
-        m : int
-                    The hamming distance value
+        m : int or ndarray
+                    The hamming distance value, an ndarray for ndarray inputs
+    """
+
+    if isinstance(hash1, np.ndarray) or isinstance(hash2, np.ndarray):
+        return popcount(np.bitwise_xor(np.asarray(hash1, np.uint64), np.asarray(hash2, np.uint64)))
+    return bin(int(hash1) ^ int(hash2)).count('1')
+
+
+def calculateAdjacentDistances(hashes):
+    """
+        Calculate the Hamming distance between every two adjacent hashes
+
+        Parameters
+        ----------
+        hashes : ndarray
+                    The uint64 hash values with shape (N,)
+
+        Returns
+        -------
+        m : ndarray
+                    The hamming distances with shape (N - 1,)
     """
 
-    num = 0
-    for index in range(len(hash1)):
-        if hash1[index] != hash2[index]:
-            num += 1
-    return num
+    hashes = np.asarray(hashes, np.uint64)
+    return calculateHammingDistance(hashes[1:], hashes[:-1])
 
 
 def getROI(image, points):
@@ -111,22 +319,237 @@ def getROI(image, points):
                     ROI data
     """
 
-    mask = np.zeros(image.shape, np.uint8)
-    pts = np.array(points, np.int32)
-    col0 = pts[:, 0]
-    col1 = pts[:, 1]
-    x1 = np.min(col0)
-    y1 = np.min(col1)
-    x2 = np.max(col0)
-    y2 = np.max(col1)
-    # reshape的第一个参数为-1，表明这一维的长度是根据后面的维度的计算出来的
-    # opencv中徐娅先将多边形的顶点坐标变成顶点数 x 1 x 2维的矩阵，再来绘制
-    pts = pts.reshape((-1, 1, 2))
-
-    # 画多边形
-    mask = cv2.polylines(mask, [pts], True, (255, 255, 255))
-    # 填充多边形
-    mask2 = cv2.fillPoly(mask, [pts], (255, 255, 255))
-    ROI = cv2.bitwise_and(mask2, image)
-
-    return ROI[y1:y2, x1:x2]
+    return ROI(points).apply(image)
+
+
+class ROI(object):
+    """
+        ROI(Region of Interest) which is built once and applied to every frame
+        The frame is cropped to the bounding box first, then only the small region is masked
+    """
+
+    def __init__(self, regions):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            regions : array_like
+                        Vertex coordinates of one polygon [[x, y], ...],
+                        or a list of polygons [[[x, y], ...], ...]
+
+            Returns
+            -------
+        """
+        # 统一转换为多边形列表
+        if isPolygonList(regions):
+            polygons = regions
+        else:
+            polygons = [regions]
+        self.polygons = [np.array(polygon, np.int32).reshape((-1, 2)) for polygon in polygons]
+        # 按图像的形状缓存裁剪区域和掩码
+        self.cache = {}
+
+    def getBoundingBox(self, shape):
+        """
+            Get the bounding box of all polygons in the image
+
+            Parameters
+            ----------
+            shape : tuple
+                        The shape of image
+
+            Returns
+            -------
+            box : tuple
+                        (x1, y1, x2, y2)
+        """
+
+        return self.getMask(shape)[0]
+
+    def getMask(self, shape):
+        """
+            Get the bounding box and the mask cropped to it
+
+            Parameters
+            ----------
+            shape : tuple
+                        The shape of image
+
+            Returns
+            -------
+            box : tuple
+                        (x1, y1, x2, y2)
+            mask : ndarray
+                        The mask of the bounding box, with the same channels as image
+        """
+
+        shape = tuple(shape)
+        if shape in self.cache:
+            return self.cache[shape]
+
+        height, width = shape[0:2]
+        pts = np.concatenate(self.polygons)
+        left, top = np.min(pts, axis=0)
+        right, bottom = np.max(pts, axis=0)
+
+        # 只在包围盒上绘制多边形，包含右下边界，保证所有顶点都在画布内不被裁剪
+        canvas = np.zeros((bottom - top + 1, right - left + 1), np.uint8)
+        # reshape的第一个参数为-1，表明这一维的长度是根据后面的维度的计算出来的
+        # opencv中徐娅先将多边形的顶点坐标变成顶点数 x 1 x 2维的矩阵，再来绘制
+        offset = np.array([left, top], np.int32)
+        polygons = [(polygon - offset).reshape((-1, 1, 2)) for polygon in self.polygons]
+        # 画多边形
+        canvas = cv2.polylines(canvas, polygons, True, 255)
+        # 填充多边形
+        canvas = cv2.fillPoly(canvas, polygons, 255)
+
+        # 包围盒限制在图像内
+        x1 = int(np.clip(left, 0, width))
+        y1 = int(np.clip(top, 0, height))
+        x2 = int(np.clip(right, 0, width))
+        y2 = int(np.clip(bottom, 0, height))
+        mask = canvas[y1 - top:y2 - top, x1 - left:x2 - left]
+        # 掩码的通道数与图像一致
+        if len(shape) == 3:
+            mask = np.repeat(mask[:, :, np.newaxis], shape[2], axis=2)
+        mask = np.ascontiguousarray(mask)
+
+        self.cache[shape] = ((x1, y1, x2, y2), mask)
+        return self.cache[shape]
+
+    def apply(self, image, dst=None):
+        """
+            Get the ROI data of image
+
+            Parameters
+            ----------
+            image : ndarray
+                        The numpy data of image
+            dst : ndarray, optional
+                        Reused output buffer
+                        Default value is None
+
+            Returns
+            -------
+            image : ndarray
+                        ROI data
+        """
+
+        (x1, y1, x2, y2), mask = self.getMask(image.shape)
+        if mask.size == 0:
+            return image[y1:y2, x1:x2].copy()
+        return cv2.bitwise_and(image[y1:y2, x1:x2], mask, dst=dst)
+
+    def scale(self, scaleX, scaleY):
+        """
+            Get the ROI of the resized image
+
+            Parameters
+            ----------
+            scaleX : float
+                        The scale of width
+            scaleY : float
+                        The scale of height
+
+            Returns
+            -------
+            roi : ROI
+                        The scaled ROI
+        """
+
+        return ROI([np.round(polygon * [scaleX, scaleY]).astype(np.int32).tolist() for polygon in self.polygons])
+
+
+def isPolygonList(regions):
+    """
+        Check whether the regions is a list of polygons
+
+        Parameters
+        ----------
+        regions : array_like
+                    Vertex coordinates of one polygon or a list of polygons
+
+        Returns
+        -------
+        m : bool
+                    True if it is a list of polygons
+    """
+
+    try:
+        return np.ndim(regions[0][0]) > 0
+    except (TypeError, IndexError):
+        return False
+
+
+class FrameBuffers(object):
+    """
+        Two sets of reused output arrays used by turns, e.g. for capture.read(image) and cv2.resize(dst)
+        The arrays of the last frame stay valid while the current frame is produced into the other set,
+        so the scan loop keeps the last frame without copying it and allocates no new frames in the steady state
+    """
+
+    def __init__(self):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+        self.buffers = [{}, {}]
+        self.current = 0
+
+    def swap(self):
+        """
+            Switch to the other set of arrays for the next frame
+
+            Parameters
+            ----------
+
+            Returns
+            -------
+        """
+
+        self.current = 1 - self.current
+
+    def get(self, name):
+        """
+            Get the reused array of the current frame
+
+            Parameters
+            ----------
+            name : string
+                        The name of the array, e.g. 'frame'
+
+            Returns
+            -------
+            array : ndarray
+                        None if the array is not allocated yet
+        """
+
+        return self.buffers[self.current].get(name)
+
+    def put(self, name, array):
+        """
+            Keep the output array for the next use, it is reallocated by opencv if the shape changes
+
+            Parameters
+            ----------
+            name : string
+                        The name of the array
+            array : ndarray
+                        The output array
+
+            Returns
+            -------
+            array : ndarray
+                        The output array
+        """
+
+        if array is not None:
+            self.buffers[self.current][name] = array
+        return array
+
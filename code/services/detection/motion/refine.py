@@ -0,0 +1,187 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Motion Boundary Refinement
+
+"""
+
+import cv2
+
+from services.detection.motion import motionutils
+
+
+class BoundaryRefiner(object):
+    """
+        Find the frame-accurate onset and end of the motion between two coarse samples by bisection
+        The frames are read by a second capture which seeks to the probed frames,
+        so the coarse scan is not disturbed and only about log2(step) frames are decoded per boundary
+    """
+
+    def __init__(self, videoFile, degree, roi=None, downsample=None, hashBackend=motionutils.HASH_BACKEND_NUMPY):
+        """
+            Initialization function
+
+            Parameters
+            ----------
+            videoFile : string
+                        The video file
+            degree : int
+                        Threshold of image similarity
+            roi : ROI, optional
+                        The detection area of the analysed frames
+                        Default value is None
+            downsample : callable, optional
+                        Downsample the decoded frame to the analysis resolution
+                        Default value is None
+            hashBackend : string, optional
+                        The p-hash backend
+                        Default value is 'numpy'
+
+            Returns
+            -------
+        """
+        self.videoFile = videoFile
+        self.degree = degree
+        self.roi = roi
+        self.downsample = downsample
+        self.hashBackend = hashBackend
+        self.capture = None
+        self.fps = None
+        # 细化时解码的帧数
+        self.decoded = 0
+
+    def getTime(self, frameIndex):
+        """
+            Get the time of frame
+
+            Parameters
+            ----------
+            frameIndex : int
+                        The index of frame, start with 1
+
+            Returns
+            -------
+            milliseconds : float
+                        The time of frame
+        """
+
+        self.open()
+        return (frameIndex - 1) * 1000.0 / self.fps
+
+    def open(self):
+        if self.capture is None:
+            self.capture = cv2.VideoCapture(self.videoFile)
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 25.0
+
+    def getHash(self, frameIndex):
+        """
+            Decode the frame and calculate its p-hash
+
+            Parameters
+            ----------
+            frameIndex : int
+                        The index of frame, start with 1
+
+            Returns
+            -------
+            hash : int
+                        The p-hash of the analysed frame, None if the frame can not be read
+        """
+
+        self.open()
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frameIndex - 1)
+        (ret, frame) = self.capture.read()
+        self.decoded += 1
+        if (not ret) or (frame is None):
+            return None
+        if self.downsample is not None:
+            frame = self.downsample(frame)
+        if self.roi is not None:
+            frame = self.roi.apply(frame)
+        return motionutils.calculatePHash(frame, self.hashBackend)
+
+    def bisect(self, lastIndex, currentIndex, predicate):
+        """
+            Find the first frame after lastIndex which satisfies the predicate,
+            assuming the predicate of currentIndex is True
+
+            Parameters
+            ----------
+            lastIndex : int
+                        The last coarse sample
+            currentIndex : int
+                        The current coarse sample
+            predicate : callable
+                        Be called with the p-hash of frame
+
+            Returns
+            -------
+            frameIndex : int
+                        The first frame satisfying the predicate
+        """
+
+        low, high = lastIndex, currentIndex
+        while high - low > 1:
+            middle = (low + high) // 2
+            currentHash = self.getHash(middle)
+            if (currentHash is not None) and predicate(currentHash):
+                high = middle
+            else:
+                low = middle
+        return high
+
+    def findOnset(self, lastIndex, lastHash, currentIndex):
+        """
+            Find the first frame which differs from the last coarse sample
+
+            Parameters
+            ----------
+            lastIndex : int
+                        The last coarse sample, without motion
+            lastHash : int
+                        The p-hash of the last coarse sample
+            currentIndex : int
+                        The current coarse sample, with motion
+
+            Returns
+            -------
+            frameIndex : int
+                        The first frame of the motion
+            milliseconds : float
+                        The time of the frame
+        """
+
+        frameIndex = self.bisect(lastIndex, currentIndex, lambda currentHash: motionutils.calculateHammingDistance(
+            lastHash, currentHash) >= self.degree)
+        return frameIndex, self.getTime(frameIndex)
+
+    def findEnd(self, lastIndex, currentIndex, currentHash):
+        """
+            Find the last frame which still differs from the current coarse sample
+
+            Parameters
+            ----------
+            lastIndex : int
+                        The coarse sample before the last sample with motion, the motion may end anywhere after it
+            currentIndex : int
+                        The current coarse sample, without motion
+            currentHash : int
+                        The p-hash of the current coarse sample
+
+            Returns
+            -------
+            frameIndex : int
+                        The last frame of the motion
+            milliseconds : float
+                        The time of the frame
+        """
+
+        frameIndex = self.bisect(lastIndex, currentIndex, lambda middleHash: motionutils.calculateHammingDistance(
+            middleHash, currentHash) < self.degree) - 1
+        return frameIndex, self.getTime(frameIndex)
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
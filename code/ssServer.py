@@ -1,3 +1,7 @@
+import asyncio
+import collections
+import hashlib
+import importlib
 import queue
 import threading
 import time
@@ -9,14 +13,17 @@ import json
 import uuid
 import sqlite3
 import sys
+import weakref
 from tornado import httpserver
-from services.detection.motion import motion
-from messager import WSSender, TornadoSender
+from messager import WSSender, TornadoSender, BatchSender, OutboundQueue
+from scheduler import TaskScheduler
+from resultcache import ResultCache, CacheRecorder
+from metrics import StageTimer, formatMetrics
 from jose import jwt
 import utils
 
 ENV = 'Production_dnh'
-USAGE = {'help': {'url': 'ws://server_ip:7000/websocket/', 'path': ['add', 'stop', 'cancel']}}
+USAGE = {'help': {'url': 'ws://server_ip:7000/websocket/', 'path': ['add', 'live', 'stop', 'cancel']}}
 # service listen port
 G_LISTEN_PORT = 7000
 # DNH-200 config database
@@ -26,18 +33,67 @@ AES_KEY = '9cd5b4cfa1048596'
 AES_IV = b'e6db271db12d4d47'
 
 RELEASE = False
-# ws clients sessions
-SESSIONS = []
+# jwt key derived from CONFIG_WEB, {'mtime': mtime of CONFIG_WEB, 'key': key}
+JWT_KEY_CACHE = {}
+# verified tokens, sha256 of token -> exp of token
+TOKEN_CACHE = collections.OrderedDict()
+TOKEN_CACHE_SIZE = 256
+# outbound queue cap of every ws connection
+OUTBOUND_MAX_BYTES = 1024 * 1024
+OUTBOUND_MAX_MESSAGES = 1000
+# motion detection results cache
+RESULT_CACHE = ResultCache(maxEntries=256, maxBytes=64 * 1024 * 1024, maxAge=7 * 24 * 3600)
+# analysis backends of every task type, imported on the first task of the type
+BACKENDS = {0: 'services.detection.motion.motion', 'live': 'services.detection.motion.live'}
+# backends imported in the background after the server starts listening, disabled by SS_WARM_UP=0
+WARM_UP_BACKENDS = [0] if os.getenv('SS_WARM_UP', '1') != '0' else []
+# 已经导入完成的分析模块，导入过程中的模块不在其中
+LOADED_BACKENDS = {}
+# maximum number of live streams detected at the same time
+MAX_LIVE_STREAMS = 8
+# analysis tasks scheduler, runs one task per CPU core at the same time
+SCHEDULER = TaskScheduler(maxTasks=os.cpu_count(), maxWaiting=32)
+
+# 所有任务各阶段的累计耗时，只在事件循环中更新
+STAGES = StageTimer()
+# 各种结果的任务数
+TASK_COUNTS = collections.Counter()
+# 打开的连接的发送队列
+OUTBOUND_QUEUES = weakref.WeakSet()
 
 
 def sendMsg(websocket, msg):
     try:
-        websocket.write_message(msg)
+        # 有发送队列时通过队列发送
+        outbound = getattr(websocket, 'outbound', None)
+        if outbound is not None:
+            outbound.put(msg)
+        else:
+            websocket.write_message(msg)
     except Exception as ex:
         print('Error:WebSocketClosedError')
         # raise Exception('WebSocketClosedError')
 
 
+async def closeWithMsg(websocket, msg, code, reason):
+    """直接发送消息后关闭连接，不经过发送队列，保证关闭前消息已经写出
+
+    :param websocket: 连接
+    :type websocket: WebSocketHandler
+    :param msg: 消息
+    :type msg: str
+    :param code: 关闭码
+    :type code: int
+    :param reason: 关闭原因
+    :type reason: str
+    """
+    try:
+        await websocket.write_message(msg)
+    except Exception:
+        print('Error:WebSocketClosedError')
+    websocket.close(code, reason)
+
+
 def checkToken(paras: dict) -> bool:
     """校验客户端token
 
@@ -57,15 +113,21 @@ def checkToken(paras: dict) -> bool:
                 token = token[pos + 1:]
     try:
         if len(token) > 0:
-            crypt = utils.SCrypt(AES_KEY, AES_IV)
-            # done 从config/systemconfig.json获取jwt_token
-            cfgFd = open(CONFIG_WEB, 'r', encoding='utf-8')
-            webCfg = json.load(cfgFd)
-            cfgFd.close()
-            originKey = webCfg.get(ENV, {}).get('jwt_secret', 'b3eaad0a469d13a884f3d09e0952b72b')
-            key = crypt.encrypt(originKey)
-            jwt.decode(token, key, algorithms=['HS256'])
-            verified = True
+            key = getJwtKey()
+            digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+            # 已经校验过并且没有过期的token
+            exp = TOKEN_CACHE.get(digest, 0)
+            if digest in TOKEN_CACHE and (exp is None or exp > time.time()):
+                TOKEN_CACHE.move_to_end(digest)
+                verified = True
+            else:
+                TOKEN_CACHE.pop(digest, None)
+                claims = jwt.decode(token, key, algorithms=['HS256'])
+                verified = True
+                # 缓存校验结果，超出数量时移除最久未使用的token
+                TOKEN_CACHE[digest] = claims.get('exp') if isinstance(claims, dict) else None
+                while len(TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+                    TOKEN_CACHE.popitem(last=False)
             # 解密测试
             # plain = crypt.decrypt(key)
             # print(plain)
@@ -75,11 +137,112 @@ def checkToken(paras: dict) -> bool:
         return verified
 
 
+def getJwtKey() -> str:
+    """获取jwt的密钥，配置文件修改后重新计算
+
+    :return: jwt密钥
+    :rtype: str
+    """
+    mtime = os.stat(CONFIG_WEB).st_mtime
+    if JWT_KEY_CACHE.get('mtime') != mtime:
+        crypt = utils.SCrypt(AES_KEY, AES_IV)
+        # done 从config/systemconfig.json获取jwt_token
+        cfgFd = open(CONFIG_WEB, 'r', encoding='utf-8')
+        webCfg = json.load(cfgFd)
+        cfgFd.close()
+        originKey = webCfg.get(ENV, {}).get('jwt_secret', 'b3eaad0a469d13a884f3d09e0952b72b')
+        JWT_KEY_CACHE['key'] = crypt.encrypt(originKey)
+        JWT_KEY_CACHE['mtime'] = mtime
+        # 密钥变化后之前校验过的token全部失效
+        TOKEN_CACHE.clear()
+    return JWT_KEY_CACHE['key']
+
+
+def loadBackend(analysisType):
+    """导入分析类型对应的模块
+
+    :param analysisType: 分析类型
+    :type analysisType: int
+    :return: 分析模块
+    :rtype: module
+    """
+    return importlib.import_module(BACKENDS[analysisType])
+
+
+async def getBackend(analysisType):
+    """获取分析类型对应的模块，在线程池中导入，不阻塞事件循环
+    预热正在导入时，import_module等待导入锁，不会返回未初始化完成的模块
+
+    :param analysisType: 分析类型
+    :type analysisType: int
+    :return: 分析模块
+    :rtype: module
+    """
+    module = await asyncio.get_event_loop().run_in_executor(None, loadBackend, analysisType)
+    LOADED_BACKENDS[analysisType] = module
+    return module
+
+
+async def warmUp():
+    """服务启动后在后台预先导入分析模块
+    """
+    for analysisType in WARM_UP_BACKENDS:
+        try:
+            started = time.time()
+            await getBackend(analysisType)
+            print('Backend warmed up:', BACKENDS[analysisType], round(time.time() - started, 3))
+        except Exception as ex:
+            print('Failed to warm up the backend:', BACKENDS[analysisType], ex)
+
+
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
         self.write(json.dumps(USAGE))
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(collectMetrics())
+
+
+def collectMetrics():
+    """收集服务的运行指标，格式为Prometheus文本格式
+
+    :return: 指标文本
+    :rtype: str
+    """
+    stages = STAGES.report()
+    queues = [outbound for outbound in list(OUTBOUND_QUEUES) if not outbound.closed]
+    metrics = [
+        ('ss_stage_seconds_total', 'counter', 'Cumulative time of every analysis stage',
+         [({'stage': name}, stage['totalMs'] / 1000.0) for (name, stage) in sorted(stages.items())]),
+        ('ss_stage_calls_total', 'counter', 'Number of calls of every analysis stage',
+         [({'stage': name}, stage['count']) for (name, stage) in sorted(stages.items())]),
+        ('ss_tasks_total', 'counter', 'Number of analysis tasks by result',
+         [({'result': result}, count) for (result, count) in sorted(TASK_COUNTS.items())]),
+        ('ss_tasks_running', 'gauge', 'Number of running analysis tasks', [({}, SCHEDULER.running)]),
+        ('ss_tasks_waiting', 'gauge', 'Number of waiting analysis tasks', [({}, len(SCHEDULER.waiting))]),
+        ('ss_tasks_max', 'gauge', 'Number of slots shared by the running analysis tasks', [({}, SCHEDULER.maxTasks)]),
+        ('ss_tasks_slots_used', 'gauge', 'Number of slots taken by the running analysis tasks',
+         [({}, SCHEDULER.used)]),
+        ('ss_connections', 'gauge', 'Number of open websocket connections', [({}, len(queues))]),
+        ('ss_outbound_messages', 'gauge', 'Number of queued outbound messages',
+         [({}, sum(len(outbound.items) for outbound in queues)),
+          ({'aggregate': 'max'}, max([len(outbound.items) for outbound in queues] or [0]))]),
+        ('ss_outbound_bytes', 'gauge', 'Bytes of queued outbound messages',
+         [({}, sum(outbound.size for outbound in queues)),
+          ({'aggregate': 'max'}, max([outbound.size for outbound in queues] or [0]))]),
+    ]
+    # 直播模块未加载时没有直播流
+    live = LOADED_BACKENDS.get('live')
+    streams = list(live.STREAMS.values()) if live is not None else []
+    metrics.append(('ss_live_streams', 'gauge', 'Number of live streams being detected', [({}, len(streams))]))
+    metrics.append(('ss_live_subscribers', 'gauge', 'Number of subscribers of live streams',
+                    [({}, sum(len(stream.subscribers) for stream in streams))]))
+    return formatMetrics(metrics)
+
+
 class Helper(tornado.websocket.WebSocketHandler):
     def open(self):
         print("WebSocket opened")
@@ -102,13 +265,70 @@ async def addCommand(taskBody, websocket):
         sendMsg(websocket, json.dumps(dic))
         if (dic.get('type') == 0):
             print('Motion detection')
-            messager = TornadoSender(taskId=taskId, msger=websocket)
-            motionDetector = motion.Motion(msger=messager, heatmap=dic.get('heatmap'), regions=dic.get('regions'),
+            outbound = getattr(websocket, 'outbound', None)
+            if dic.get('batch'):
+                messager = BatchSender(taskId=taskId, msger=websocket, outbound=outbound,
+                                       window=dic.get('batchWindow'), size=dic.get('batchSize'),
+                                       progressRate=dic.get('progressRate'), encoding=dic.get('encoding'))
+            else:
+                messager = TornadoSender(taskId=taskId, msger=websocket, outbound=outbound)
+
+            # 相同的任务直接返回缓存的结果
+            # 查询缓存需要读取源文件的信息和缓存文件，在线程池中执行
+            cacheKey, cached = None, None
+            if dic.get('cache', True):
+                cacheKey, cached = await asyncio.get_event_loop().run_in_executor(None, RESULT_CACHE.find, dic)
+            if cached is not None:
+                print('Result cache hit:', cacheKey)
+                TASK_COUNTS['cached'] += 1
+                for msg in cached:
+                    messager.send(msg)
+                    await messager.drain()
+                return
+
+            if SCHEDULER.isFull():
+                TASK_COUNTS['rejected'] += 1
+                sendMsg(websocket, json.dumps(
+                    {"taskId": taskId, "status": "error", "code": 41143,
+                     "message": "Too many analysis tasks are waiting. Please try again later."}))
+                return
+            # 记录发送的消息，用于缓存结果
+            recorder = CacheRecorder(taskId=taskId, msger=messager)
+            motion = await getBackend(0)
+            # 检查检测策略，检测开始后的异常不会返回给客户端
+            try:
+                motion.detectors.createDetectorChain(dic.get('detector'))
+            except (ValueError, TypeError) as ex:
+                sendMsg(websocket, json.dumps(
+                    {"taskId": taskId, "status": "error", "code": 41146, "message": str(ex)}))
+                return
+            motionDetector = motion.Motion(msger=recorder, heatmap=dic.get('heatmap'), regions=dic.get('regions'),
                                            degree=dic.get('degree'), threshold=dic.get('threshold'),
                                            maxValue=dic.get('maxValue'), sleepTimes=dic.get('sleepTimes'),
-                                           heatmapDir=dic.get('heatmapDir'), )
-
-            await motionDetector.motionDetect(sources=dic.get('sources'))
+                                           heatmapDir=dic.get('heatmapDir'), hashBackend=dic.get('hashBackend'),
+                                           sampleInterval=dic.get('sampleInterval'),
+                                           samplingMode=dic.get('samplingMode'), workers=dic.get('workers'),
+                                           segments=dic.get('segments'), progressStep=dic.get('progressStep'),
+                                           index=dic.get('index'), indexDir=dic.get('indexDir'),
+                                           indexRegions=dic.get('indexRegions'),
+                                           heatmapDecay=dic.get('heatmapDecay'),
+                                           heatmapCompression=dic.get('heatmapCompression'),
+                                           analysisWidth=dic.get('analysisWidth'), detector=dic.get('detector'),
+                                           scan=dic.get('scan'), refine=dic.get('refine'),
+                                           prefetch=dic.get('prefetch'), reducedDecode=dic.get('reducedDecode'),
+                                           maxWorkers=SCHEDULER.maxTasks, )
+
+            finished = await SCHEDULER.run(lambda: motionDetector.motionDetect(sources=dic.get('sources')),
+                                           owner=websocket, priority=dic.get('priority') or 0,
+                                           onQueued=lambda position: sendMsg(websocket, json.dumps(
+                                               {"taskId": taskId, "status": "queued", "position": position})),
+                                           slots=motionDetector.getProcesses(len(dic.get('sources') or [])))
+            TASK_COUNTS['finished' if finished else 'cancelled'] += 1
+            STAGES.merge(motionDetector.timer.report())
+            # 缓存完整的结果
+            if finished and (cacheKey is not None) and (not recorder.failed) and (not motionDetector.failed) and \
+                    len(recorder.messages) > 0:
+                await asyncio.get_event_loop().run_in_executor(None, RESULT_CACHE.put, cacheKey, recorder.messages)
         elif (dic.get('type') == 1):
             print('Face recognition')
         else:
@@ -122,22 +342,21 @@ async def addCommand(taskBody, websocket):
 
 class AddTask(tornado.websocket.WebSocketHandler):
     async def open(self):
-        # print('before:', len(SESSIONS))
+        # 有上限的发送队列，客户端接收慢时暂停分析
+        self.outbound = OutboundQueue(websocket=self, maxBytes=OUTBOUND_MAX_BYTES, maxMessages=OUTBOUND_MAX_MESSAGES,
+                                      timer=STAGES)
+        OUTBOUND_QUEUES.add(self.outbound)
         verified = checkToken(self.request.arguments)
         if verified:
-            SESSIONS.append(self)
-            if len(SESSIONS) > 1:
-                sendMsg(self, json.dumps(
+            if SCHEDULER.isFull():
+                await closeWithMsg(self, json.dumps(
                     {"status": "error", "code": 41143,
-                     "message": "There is already a running analysis task. Please try again later."}))
-                self.close(1013, 'busy')
+                     "message": "Too many analysis tasks are waiting. Please try again later."}), 1013, 'busy')
             else:
                 print("WebSocket opened:", id(self))
         else:
-            sendMsg(self, json.dumps(
-                {"status": "error", "code": 41139, "message": "Illegal token."}))
-            self.close(1008, 'Unauthorized')
-        # print('after:', len(SESSIONS))
+            await closeWithMsg(self, json.dumps(
+                {"status": "error", "code": 41139, "message": "Illegal token."}), 1008, 'Unauthorized')
 
     async def on_message(self, message):
         verified = checkToken(self.request.arguments)
@@ -145,7 +364,6 @@ class AddTask(tornado.websocket.WebSocketHandler):
             try:
                 await addCommand(message, self)
             except Exception as ex:
-                SESSIONS.remove(self)
                 print(ex.__str__())
 
     async def on_ping(self, data):
@@ -158,7 +376,10 @@ class AddTask(tornado.websocket.WebSocketHandler):
             self.ping(byte_ping)
 
     def on_close(self):
-        SESSIONS.remove(self)
+        # 取消等待中的任务
+        SCHEDULER.cancel(self)
+        if getattr(self, 'outbound', None) is not None:
+            self.outbound.close()
         print("WebSocket closed, code:{0} reason:{1}.".format(self.close_code, self.close_reason))
 
     # 允许所有跨域通讯，解决403问题
@@ -166,11 +387,82 @@ class AddTask(tornado.websocket.WebSocketHandler):
         return True
 
 
+async def addLiveCommand(taskBody, websocket):
+    dic = json.loads(taskBody)
+    sources = dic.get('sources') if dic else None
+    if not sources:
+        print('Missing live sources')
+        sendMsg(websocket, json.dumps({"status": "error", "code": 41140, "message": "Missing live sources"}))
+        return
+
+    taskId = str(uuid.uuid4())
+    dic['taskId'] = taskId
+    dic['status'] = 'added'
+    sendMsg(websocket, json.dumps(dic))
+    live = await getBackend('live')
+    params = {'degree': dic.get('degree'), 'regions': dic.get('regions'), 'sampleInterval': dic.get('sampleInterval'),
+              'bufferSize': dic.get('bufferSize'), 'bufferWidth': dic.get('bufferWidth'),
+              'contextFrames': dic.get('contextFrames'), 'hashBackend': dic.get('hashBackend'),
+              'analysisWidth': dic.get('analysisWidth')}
+    for source in sources:
+        if not live.isLiveSource(source):
+            sendMsg(websocket, json.dumps({"taskId": taskId, "source": source, "status": "error", "code": 41145,
+                                           "message": "Live source is not supported"}))
+            continue
+        # 相同参数的直播源共用一个检测线程
+        if (live.buildStreamKey(source, **params) not in live.STREAMS) and len(live.STREAMS) >= MAX_LIVE_STREAMS:
+            sendMsg(websocket, json.dumps({"taskId": taskId, "source": source, "status": "error", "code": 41144,
+                                           "message": "Too many live streams. Please try again later."}))
+            continue
+        messager = TornadoSender(taskId=taskId, msger=websocket, outbound=websocket.outbound)
+        stream = live.subscribe(source, messager, asyncio.get_event_loop(), **params)
+        websocket.streams.append((stream, messager))
+
+
+class LiveTask(tornado.websocket.WebSocketHandler):
+    async def open(self):
+        self.outbound = OutboundQueue(websocket=self, maxBytes=OUTBOUND_MAX_BYTES, maxMessages=OUTBOUND_MAX_MESSAGES,
+                                      timer=STAGES)
+        OUTBOUND_QUEUES.add(self.outbound)
+        # 订阅的直播流，[(LiveStream, Messager)]
+        self.streams = []
+        verified = checkToken(self.request.arguments)
+        if verified:
+            print("Live webSocket opened:", id(self))
+        else:
+            await closeWithMsg(self, json.dumps(
+                {"status": "error", "code": 41139, "message": "Illegal token."}), 1008, 'Unauthorized')
+
+    async def on_message(self, message):
+        verified = checkToken(self.request.arguments)
+        if verified:
+            try:
+                await addLiveCommand(message, self)
+            except Exception as ex:
+                print(ex.__str__())
+
+    def on_close(self):
+        # 取消订阅，没有订阅者的直播流停止检测，有订阅时直播模块已经导入完成
+        live = LOADED_BACKENDS.get('live')
+        for (stream, messager) in self.streams:
+            live.unsubscribe(stream, messager)
+        self.streams = []
+        if getattr(self, 'outbound', None) is not None:
+            self.outbound.close()
+        print("Live webSocket closed, code:{0} reason:{1}.".format(self.close_code, self.close_reason))
+
+    # 允许所有跨域通讯，解决403问题
+    def check_origin(self, origin):
+        return True
+
+
 def make_app():
     app = tornado.web.Application([
         (r"/", MainHandler),
         (r"/websocket", Helper),
         (r"/websocket/add", AddTask),
+        (r"/websocket/live", LiveTask),
+        (r"/metrics", MetricsHandler),
     ],
         # websocket_ping_interval=10,
         # websocket_ping_timeout=5,
@@ -226,4 +518,6 @@ if __name__ == "__main__":
     else:
         app.listen(G_LISTEN_PORT, add)
     app.listen(G_LISTEN_PORT + 1)
+    # 开始监听后再预先导入分析模块
+    tornado.ioloop.IOLoop.current().spawn_callback(warmUp)
     tornado.ioloop.IOLoop.current().start()